@@ -12,12 +12,41 @@ import pickle as pkl
 
 import monkfish.lvd.models.dist_autoencoding_diffusion as daed
 import monkfish.lvd.models.dist_utils as du
+import monkfish.lvd.models.grad_compression as gc
 import monkfish.lvd.shrd_data_loader as sdl
 import monkfish.lvd.diffusion_core as dc
 
 
 DAEModel = collections.namedtuple('DAEModel', ['encoder', 'decoder'])
 
+def make_dae(dist_manager, model_conf, key):
+    enc_conf = model_conf["encoder"]
+    dec_conf = model_conf["decoder"]
+    enc_key, dec_key = jax.random.split(key)
+    return DAEModel(
+        encoder=daed.Encoder(
+            dist_manager, 
+            key=enc_key, 
+            k =enc_conf["k"],
+            n_layers=enc_conf["n_layers"],
+            remat_policy=model_conf.get("remat_policy")
+        ),
+        decoder=daed.Decoder(
+            dist_manager, 
+            key=dec_key, 
+            k =dec_conf["k"],
+            n_layers=dec_conf["n_layers"],
+            remat_policy=model_conf.get("remat_policy")
+        )
+    )
+
+def dae_loss(model, data, subkey):
+    latents = jax.vmap(model.encoder)(data)
+    diff_data = (latents, data)
+    loss = dc.diffusion_loss(
+        model.decoder, diff_data, dc.f_neg_gamma, subkey)
+    return loss
+
 class DiffAEHarness:
     """Sharded Diffusion autoencoder harness"""
 
@@ -32,6 +61,7 @@ class DiffAEHarness:
         self.credentials_path = None
         self.worker_fs_args = None
         self.ckpt_fs = None
+        self.checkpointer = None
 
         print("Parsing arguments...")
         self.parse_args()
@@ -90,7 +120,7 @@ class DiffAEHarness:
             self.ckpt_fs = sdl.gcp_filesystem(
                 gcp_bucket_name, 
                 root_path=ckpt_root_directory, 
-                gcp_credentials_path=gcp_credentials_path)
+                credentials_path=gcp_credentials_path)
         else:
             raise Exception(f"Invalid fs_type provided, provided {ckpt_root_directory}")
 
@@ -98,7 +128,15 @@ class DiffAEHarness:
         operation = self.args.operation
         dl_conf = self.cfg["diffusion_auto_encoder"]["data_loader"]
 
-        if operation == "train_dae":
+        if operation == "train_dae" and dl_conf.get("preprocessed", False):
+            # Tensor shards written by the preprocess command
+            worker_interface_cls = sdl.TensorWorkerInterface
+            
+            def shard_interface_factory():
+                tsi = sdl.TensorShardInterface(self.dist_manager)
+                return tsi
+
+        elif operation == "train_dae":
             worker_interface_cls = sdl.ImageWorkerInterface
             
             def shard_interface_factory():
@@ -123,51 +161,68 @@ class DiffAEHarness:
             workers_per_node=dl_conf["workers_per_node"],
             batch_size=dl_conf["batch_size"],
             queue_depth=dl_conf["queue_depth"],
+            cache_bytes=dl_conf.get("cache_bytes", 0),
         )
 
     def init_dist_manager(self):
         dm_cfg = self.cfg["diffusion_auto_encoder"]["dist_manager"]
 
         mesh_shape = dm_cfg["mesh_shape"]
+        chunk_bytes = dm_cfg.get("chunk_bytes", du.DEFAULT_CHUNK_BYTES)
+        compression = dm_cfg.get("compression", None)
 
-        self.dist_manager = du.DistManager(mesh_shape, self.ckpt_fs)
+        self.dist_manager = du.DistManager(
+            mesh_shape, self.ckpt_fs, chunk_bytes=chunk_bytes, compression=compression)
+
+        ckpt_conf = self.cfg["diffusion_auto_encoder"]["checkpoints"]
+        if ckpt_conf.get("async", False):
+            self.checkpointer = du.AsyncCheckpointer(
+                self.dist_manager, max_in_flight=ckpt_conf.get("max_in_flight", 1))
     
     def make_model(self):
         model_conf = self.cfg["diffusion_auto_encoder"]["model"]
-        enc_conf = model_conf["encoder"]
-        dec_conf = model_conf["decoder"]
 
         seed = self.cfg["seed"]
         self.state["prng_key"] = self.dist_manager.get_key(seed)
         
-        self.state["prng_key"], enc_key, dec_key = jax.random.split(self.state["prng_key"],3)
-
-        self.state["model"] = DAEModel(
-            encoder=daed.Encoder(
-                self.dist_manager, 
-                key=enc_key, 
-                k =enc_conf["k"],
-                n_layers=enc_conf["n_layers"]
-            ),
-            decoder=daed.Decoder(
-                self.dist_manager, 
-                key=dec_key, 
-                k =dec_conf["k"],
-                n_layers=dec_conf["n_layers"]
-            )
-        )
+        self.state["prng_key"], model_key = jax.random.split(self.state["prng_key"], 2)
+
+        # Parameters are generated on device, shard by shard, in one program
+        self.state["model"] = self.dist_manager.init_model(
+            lambda key: make_dae(self.dist_manager, model_conf, key), model_key)
     
     def make_optimizer(self):
         opt_cfg = self.cfg["diffusion_auto_encoder"]["train"]
         
         self.optimizer = optax.adam(learning_rate=opt_cfg["lr"])
+        if opt_cfg.get("zero1", False):
+            # Adam moments partitioned along dp rather than replicated
+            self.optimizer = self.dist_manager.zero1(self.optimizer)
+        if opt_cfg.get("offload_optimizer", False):
+            # Optimizer state kept in host memory, streamed to the devices during the update
+            self.optimizer = du.OffloadedOptimizer(
+                self.dist_manager, self.optimizer, 
+                group_bytes=opt_cfg.get("offload_group_bytes", du.DEFAULT_CHUNK_BYTES))
         self.state["opt_state"] = self.optimizer.init(self.state["model"])
+
+        comp_cfg = opt_cfg.get("grad_compression")
+        self.grad_compressor = None
+        if comp_cfg is not None:
+            if isinstance(self.optimizer, du.OffloadedOptimizer):
+                raise ValueError("grad_compression isn't supported with offload_optimizer")
+            # Gradients reduced across dp in bf16/int8, with error feedback
+            self.grad_compressor = gc.GradCompressor(
+                self.dist_manager, comp_cfg["mode"], comp_cfg.get("min_bytes", 2**16))
+            self.state["grad_error"] = self.grad_compressor.init(self.state["model"])
     
     def list_checkpoints(self):
         """List all checkpoint directories."""
         try:
             directories = [d for d in self.ckpt_fs.listdir('/') if self.ckpt_fs.isdir(d)]
             checkpoint_dirs = [f"/{d}" for d in directories if d.startswith('ckpt_')]
+            # Skip sharded checkpoints that are still being written
+            checkpoint_dirs = [d for d in checkpoint_dirs 
+                               if self.dist_manager.is_committed(d) or self.ckpt_fs.exists(f"{d}/ckpt.pkl")]
             return sorted(checkpoint_dirs, key=lambda x: int(x.split('_')[1]))
         except fs.errors.ResourceNotFound:
             return []
@@ -175,15 +230,29 @@ class DiffAEHarness:
     def save_checkpoint(self, path):
         """Save a checkpoint at the given step."""
         
-        ckpt_file_path = f"{path}/ckpt.pkl"
+        ckpt_conf = self.cfg["diffusion_auto_encoder"]["checkpoints"]
         sharding_pytree = self.dist_manager.get_pytree_sharding(self.state)
-        self.dist_manager.save_pytree(self.state, sharding_pytree, ckpt_file_path)
+        if self.checkpointer is not None:
+            self.checkpointer.save(self.state, sharding_pytree, path)
+        elif ckpt_conf.get("format", "pickle") == "sharded":
+            self.dist_manager.save_pytree_sharded(self.state, sharding_pytree, path)
+        else:
+            ckpt_file_path = f"{path}/ckpt.pkl"
+            self.dist_manager.save_pytree(self.state, sharding_pytree, ckpt_file_path)
 
-    def load_checkpoint(self, path):
-        """Load a checkpoint from the given path"""
-        ckpt_file_path = f"{path}/ckpt.pkl"
+    def load_checkpoint(self, path, path_filter=None):
+        """Load a checkpoint from the given path. With a `path_filter` (e.g. 
+        "model") only the matching part of the state is loaded, the rest keeps
+        its current value."""
         sharding_pytree = self.dist_manager.get_pytree_sharding(self.state)
-        self.state = self.dist_manager.load_pytree(sharding_pytree, ckpt_file_path)
+        if self.dist_manager.is_sharded_checkpoint(path):
+            loaded = self.dist_manager.load_pytree_sharded(sharding_pytree, path, path_filter)
+        else:
+            ckpt_file_path = f"{path}/ckpt.pkl"
+            loaded = self.dist_manager.load_pytree(sharding_pytree, ckpt_file_path, path_filter)
+        self.state = jtu.tree_map(
+            lambda new, old: old if new is None else new, loaded, self.state,
+            is_leaf=lambda x: x is None)
     
     def latest_ckpt_step(self):
         """Get the most recent checkpoint number."""
@@ -215,12 +284,7 @@ class DiffAEHarness:
     
 
     def train(self):
-        def loss_fn(model, data, subkey):
-            latents = jax.vmap(model.encoder)(data)
-            diff_data = (latents, data)
-            loss = dc.diffusion_loss(
-                model.decoder, diff_data, dc.f_neg_gamma, subkey)
-            return loss
+        loss_fn = dae_loss
         
         args = self.args
         cfg = self.cfg
@@ -250,6 +314,10 @@ class DiffAEHarness:
         try:
             total_loss = 0
             log_start_step = step
+            # Compiled on the first step, its collectives are read from the
+            # HLO once, right after
+            update_step = None
+            collectives = None
             while step < total_steps:
                 
                 #Save checkpoint 
@@ -270,7 +338,26 @@ class DiffAEHarness:
                 print("a")
 
                 # Update the model
-                loss, self.state = dc.update_state_dict(self.state, data, self.optimizer, loss_fn)
+                if isinstance(self.optimizer, du.OffloadedOptimizer):
+                    if update_step is None:
+                        update_step = dc.loss_and_grads.lower(
+                            self.state["model"], self.state["prng_key"], data, loss_fn).compile()
+                    loss, grads, self.state["prng_key"] = update_step(
+                        self.state["model"], self.state["prng_key"], data)
+                    self.state["model"], self.state["opt_state"] = self.optimizer.update(
+                        grads, self.state["opt_state"], self.state["model"])
+                elif self.grad_compressor is not None:
+                    if update_step is None:
+                        update_step = dc.update_state_dict_compressed.lower(
+                            self.state, data, self.optimizer, loss_fn, self.grad_compressor).compile()
+                    loss, self.state = update_step(self.state, data)
+                else:
+                    if update_step is None:
+                        update_step = dc.update_state_dict.lower(
+                            self.state, data, self.optimizer, loss_fn).compile()
+                    loss, self.state = update_step(self.state, data)
+                if collectives is None:
+                    collectives = du.collective_stats(update_step.as_text())
                 print("b")
                 print(loss)
 
@@ -291,6 +378,15 @@ class DiffAEHarness:
                 self.sharded_data_downloader.ack()
                 print("c")
 
+                if step % log_freq == 0:
+                    # A round trip to the cache's manager, so only when logging
+                    cache_stats = self.sharded_data_downloader.cache_stats()
+                    if cache_stats is not None:
+                        print(f"Step {step}, example cache hit rate: {cache_stats['hit_rate']:.2%}")
+                    comm_report = self.dist_manager.comm_report(collectives)
+                    print(f"Step {step}, communication since the last report:")
+                    print(du.format_comm_report(comm_report))
+
         except KeyboardInterrupt:
             print("Training interrupted.")
         finally:
@@ -298,6 +394,9 @@ class DiffAEHarness:
             print("d")
             self.sharded_data_downloader.stop()
             print("e")
+            if self.checkpointer is not None:
+                print("Waiting for checkpoints to finish writing...")
+                self.checkpointer.wait()
 
         print("Training completed.")
 
@@ -306,7 +405,7 @@ class DiffAEHarness:
         cfg = self.cfg
 
         latest_ckpt_path = self.latest_ckpt_path()
-        self.load_checkpoint(latest_ckpt_path)
+        self.load_checkpoint(latest_ckpt_path, path_filter="model")
 
     
 
@@ -12,9 +12,93 @@ import pickle as pkl
 
 import monkfish.lvd.models.dist_autoreg_diffusion as dard
 import monkfish.lvd.models.dist_utils as du
+import monkfish.lvd.models.grad_compression as gc
 import monkfish.lvd.shrd_data_loader as sdl
 import monkfish.lvd.diffusion_core as dc
 
+def make_ardm(dist_manager, model_conf, key):
+    return dard.TransformerARDM(
+        dist_manager,
+        key=key,
+        res_dim=model_conf["res_dim"],
+        io_dim=model_conf["io_dim"],
+        vocab=model_conf["vocab"],
+        n_layers=model_conf["n_layers"],
+        mlp_dim=model_conf["mlp_dim"],
+        qk_dim=model_conf["qk_dim"],
+        v_dim=model_conf["v_dim"],
+        n_head=model_conf["n_head"],
+        n_microbatches=model_conf.get("n_microbatches", 1),
+        attn_block_size=model_conf.get("attn_block_size"),
+        remat_policy=model_conf.get("remat_policy")
+    )
+
+def ardm_loss(model, data, subkey):
+    """Denoising loss of a batch of (true_x, txt) sequences."""
+    true_x, txt = data
+    noise = jax.random.normal(subkey, true_x.shape)
+    noise_hat = model.apply_batch(true_x, noise, txt)
+    return jnp.mean((noise_hat - noise)**2)
+
+def make_optimizer(dist_manager, opt_cfg):
+    """Adam, with its state partitioned along dp (zero1) or kept in host 
+    memory (offload_optimizer) as the train config opt_cfg sets."""
+    optimizer = optax.adam(learning_rate=opt_cfg["lr"])
+    if opt_cfg.get("zero1", False):
+        # Adam moments partitioned along dp rather than replicated
+        optimizer = dist_manager.zero1(optimizer)
+    if opt_cfg.get("offload_optimizer", False):
+        # Optimizer state kept in host memory, streamed to the devices during the update
+        optimizer = du.OffloadedOptimizer(
+            dist_manager, optimizer, 
+            group_bytes=opt_cfg.get("offload_group_bytes", du.DEFAULT_CHUNK_BYTES))
+    return optimizer
+
+def make_grad_compressor(dist_manager, optimizer, opt_cfg):
+    """The GradCompressor of the train config opt_cfg, None without one."""
+    comp_cfg = opt_cfg.get("grad_compression")
+    if comp_cfg is None:
+        return None
+    if isinstance(optimizer, du.OffloadedOptimizer):
+        raise ValueError("grad_compression isn't supported with offload_optimizer")
+    # Gradients reduced across dp in bf16/int8, with error feedback
+    return gc.GradCompressor(
+        dist_manager, comp_cfg["mode"], comp_cfg.get("min_bytes", 2**16))
+
+def init_state(dist_manager, cfg):
+    """A fresh training state laid out as DiffARHarness builds it, e.g. the
+    tree to read a pickle checkpoint into."""
+    model_conf = cfg["transformer_ardm"]["model"]
+    opt_cfg = cfg["transformer_ardm"]["train"]
+
+    state = {"prng_key": dist_manager.get_key(cfg["seed"])}
+    state["prng_key"], model_key = jax.random.split(state["prng_key"], 2)
+    state["model"] = dist_manager.init_model(
+        lambda key: make_ardm(dist_manager, model_conf, key), model_key)
+    optimizer = make_optimizer(dist_manager, opt_cfg)
+    state["opt_state"] = optimizer.init(state["model"])
+    grad_compressor = make_grad_compressor(dist_manager, optimizer, opt_cfg)
+    if grad_compressor is not None:
+        state["grad_error"] = grad_compressor.init(state["model"])
+    return state
+
+def ckpt_filesystem(cfg):
+    """The filesystem holding the checkpoints of the transformer_ardm section."""
+    gcp_conf = cfg["gcp"]
+    ckpt_conf = cfg["transformer_ardm"]["checkpoints"]
+    ckpt_fs_type = ckpt_conf["fs_type"]
+    ckpt_root_directory = ckpt_conf["ckpt_root_directory"]
+    
+    if ckpt_fs_type == "local":
+        return sdl.os_filesystem(ckpt_root_directory)
+    elif ckpt_fs_type == "gcp":
+        return sdl.gcp_filesystem(
+            gcp_conf["gcp_bucket_name"], 
+            root_path=ckpt_root_directory, 
+            credentials_path=gcp_conf["gcp_credentials_path"])
+    else:
+        raise Exception(f"Invalid fs_type provided, provided {ckpt_fs_type}")
+
 class DiffARHarness:
     """Sharded Diffusion autoencoder harness"""
 
@@ -29,6 +113,7 @@ class DiffARHarness:
         self.credentials_path = None
         self.worker_fs_args = None
         self.ckpt_fs = None
+        self.checkpointer = None
 
         print("Parsing arguments...")
         self.parse_args()
@@ -77,19 +162,7 @@ class DiffARHarness:
             raise Exception(f"Invalid fs_type provided, provided {dl_fs_type}")
         
         #Initialize checkpoint filesystem
-        ckpt_conf = self.cfg["transformer_ardm"]["checkpoints"]
-        ckpt_fs_type = ckpt_conf["fs_type"]
-        ckpt_root_directory = ckpt_conf["ckpt_root_directory"]
-        
-        if ckpt_fs_type == "local":
-            self.ckpt_fs = sdl.os_filesystem(ckpt_root_directory)
-        elif ckpt_fs_type == "gcp":
-            self.ckpt_fs = sdl.gcp_filesystem(
-                gcp_bucket_name, 
-                root_path=ckpt_root_directory, 
-                gcp_credentials_path=gcp_credentials_path)
-        else:
-            raise Exception(f"Invalid fs_type provided, provided {ckpt_root_directory}")
+        self.ckpt_fs = ckpt_filesystem(self.cfg)
 
     def init_data_loader(self):
         operation = self.args.operation
@@ -120,14 +193,23 @@ class DiffARHarness:
             workers_per_node=dl_conf["workers_per_node"],
             batch_size=dl_conf["batch_size"],
             queue_depth=dl_conf["queue_depth"],
+            cache_bytes=dl_conf.get("cache_bytes", 0),
         )
 
     def init_dist_manager(self):
         dm_cfg = self.cfg["transformer_ardm"]["dist_manager"]
 
         mesh_shape = dm_cfg["mesh_shape"]
+        chunk_bytes = dm_cfg.get("chunk_bytes", du.DEFAULT_CHUNK_BYTES)
+        compression = dm_cfg.get("compression", None)
+
+        self.dist_manager = du.DistManager(
+            mesh_shape, self.ckpt_fs, chunk_bytes=chunk_bytes, compression=compression)
 
-        self.dist_manager = du.DistManager(mesh_shape, self.ckpt_fs)
+        ckpt_conf = self.cfg["transformer_ardm"]["checkpoints"]
+        if ckpt_conf.get("async", False):
+            self.checkpointer = du.AsyncCheckpointer(
+                self.dist_manager, max_in_flight=ckpt_conf.get("max_in_flight", 1))
     
     def make_model(self):
         model_conf = self.cfg["transformer_ardm"]["model"]
@@ -137,30 +219,35 @@ class DiffARHarness:
         
         self.state["prng_key"], model_key = jax.random.split(self.state["prng_key"], 2)
 
-        self.state["model"] = dard.TransformerARDM(
-            self.dist_manager,
-            key=model_key,
-            res_dim=model_conf["res_dim"],
-            io_dim=model_conf["io_dim"],
-            vocab=model_conf["vocab"],
-            n_layers=model_conf["n_layers"],
-            mlp_dim=model_conf["mlp_dim"],
-            qk_dim=model_conf["qk_dim"],
-            v_dim=model_conf["v_dim"],
-            n_dim=model_conf["n_dim"]
-        )
+        # Parameters are generated on device, shard by shard, in one program
+        self.state["model"] = self.dist_manager.init_model(
+            lambda key: make_ardm(self.dist_manager, model_conf, key), model_key)
+
+        model = self.state["model"]
+        if model.pipelined:
+            pp = self.dist_manager.axis_size("pp")
+            bubble = du.bubble_fraction(pp, model.n_microbatches)
+            print(f"Pipeline: {pp} stages of {model_conf['n_layers'] // pp} layers, "
+                  f"{model.n_microbatches} microbatches, bubble fraction {bubble:.1%}")
     
     def make_optimizer(self):
         opt_cfg = self.cfg["transformer_ardm"]["train"]
         
-        self.optimizer = optax.adam(learning_rate=opt_cfg["lr"])
+        self.optimizer = make_optimizer(self.dist_manager, opt_cfg)
         self.state["opt_state"] = self.optimizer.init(self.state["model"])
+
+        self.grad_compressor = make_grad_compressor(self.dist_manager, self.optimizer, opt_cfg)
+        if self.grad_compressor is not None:
+            self.state["grad_error"] = self.grad_compressor.init(self.state["model"])
     
     def list_checkpoints(self):
         """List all checkpoint directories."""
         try:
             directories = [d for d in self.ckpt_fs.listdir('/') if self.ckpt_fs.isdir(d)]
             checkpoint_dirs = [f"/{d}" for d in directories if d.startswith('ckpt_')]
+            # Skip sharded checkpoints that are still being written
+            checkpoint_dirs = [d for d in checkpoint_dirs 
+                               if self.dist_manager.is_committed(d) or self.ckpt_fs.exists(f"{d}/ckpt.pkl")]
             return sorted(checkpoint_dirs, key=lambda x: int(x.split('_')[1]))
         except fs.errors.ResourceNotFound:
             return []
@@ -168,15 +255,29 @@ class DiffARHarness:
     def save_checkpoint(self, path):
         """Save a checkpoint at the given step."""
         
-        ckpt_file_path = f"{path}/ckpt.pkl"
+        ckpt_conf = self.cfg["transformer_ardm"]["checkpoints"]
         sharding_pytree = self.dist_manager.get_pytree_sharding(self.state)
-        self.dist_manager.save_pytree(self.state, sharding_pytree, ckpt_file_path)
+        if self.checkpointer is not None:
+            self.checkpointer.save(self.state, sharding_pytree, path)
+        elif ckpt_conf.get("format", "pickle") == "sharded":
+            self.dist_manager.save_pytree_sharded(self.state, sharding_pytree, path)
+        else:
+            ckpt_file_path = f"{path}/ckpt.pkl"
+            self.dist_manager.save_pytree(self.state, sharding_pytree, ckpt_file_path)
 
-    def load_checkpoint(self, path):
-        """Load a checkpoint from the given path"""
-        ckpt_file_path = f"{path}/ckpt.pkl"
+    def load_checkpoint(self, path, path_filter=None):
+        """Load a checkpoint from the given path. With a `path_filter` (e.g. 
+        "model") only the matching part of the state is loaded, the rest keeps
+        its current value."""
         sharding_pytree = self.dist_manager.get_pytree_sharding(self.state)
-        self.state = self.dist_manager.load_pytree(sharding_pytree, ckpt_file_path)
+        if self.dist_manager.is_sharded_checkpoint(path):
+            loaded = self.dist_manager.load_pytree_sharded(sharding_pytree, path, path_filter)
+        else:
+            ckpt_file_path = f"{path}/ckpt.pkl"
+            loaded = self.dist_manager.load_pytree(sharding_pytree, ckpt_file_path, path_filter)
+        self.state = jtu.tree_map(
+            lambda new, old: old if new is None else new, loaded, self.state,
+            is_leaf=lambda x: x is None)
     
     def latest_ckpt_step(self):
         """Get the most recent checkpoint number."""
@@ -243,6 +344,10 @@ class DiffARHarness:
         try:
             total_loss = 0
             log_start_step = step
+            # Compiled on the first step, its collectives are read from the
+            # HLO once, right after
+            update_step = None
+            collectives = None
             while step < total_steps:
                 
                 #Save checkpoint 
@@ -263,7 +368,26 @@ class DiffARHarness:
                 print("a")
 
                 # Update the model
-                loss, self.state = dc.update_state_dict(self.state, data, self.optimizer, loss_fn)
+                if isinstance(self.optimizer, du.OffloadedOptimizer):
+                    if update_step is None:
+                        update_step = dc.loss_and_grads.lower(
+                            self.state["model"], self.state["prng_key"], data, loss_fn).compile()
+                    loss, grads, self.state["prng_key"] = update_step(
+                        self.state["model"], self.state["prng_key"], data)
+                    self.state["model"], self.state["opt_state"] = self.optimizer.update(
+                        grads, self.state["opt_state"], self.state["model"])
+                elif self.grad_compressor is not None:
+                    if update_step is None:
+                        update_step = dc.update_state_dict_compressed.lower(
+                            self.state, data, self.optimizer, loss_fn, self.grad_compressor).compile()
+                    loss, self.state = update_step(self.state, data)
+                else:
+                    if update_step is None:
+                        update_step = dc.update_state_dict.lower(
+                            self.state, data, self.optimizer, loss_fn).compile()
+                    loss, self.state = update_step(self.state, data)
+                if collectives is None:
+                    collectives = du.collective_stats(update_step.as_text())
                 print("b")
                 print(loss)
 
@@ -284,6 +408,15 @@ class DiffARHarness:
                 self.sharded_data_downloader.ack()
                 print("c")
 
+                if step % log_freq == 0:
+                    # A round trip to the cache's manager, so only when logging
+                    cache_stats = self.sharded_data_downloader.cache_stats()
+                    if cache_stats is not None:
+                        print(f"Step {step}, example cache hit rate: {cache_stats['hit_rate']:.2%}")
+                    comm_report = self.dist_manager.comm_report(collectives)
+                    print(f"Step {step}, communication since the last report:")
+                    print(du.format_comm_report(comm_report))
+
         except KeyboardInterrupt:
             print("Training interrupted.")
         finally:
@@ -291,6 +424,9 @@ class DiffARHarness:
             print("d")
             self.sharded_data_downloader.stop()
             print("e")
+            if self.checkpointer is not None:
+                print("Waiting for checkpoints to finish writing...")
+                self.checkpointer.wait()
 
         print("Training completed.")
 
@@ -299,4 +435,4 @@ class DiffARHarness:
         cfg = self.cfg
 
         latest_ckpt_path = self.latest_ckpt_path()
-        self.load_checkpoint(latest_ckpt_path)
\ No newline at end of file
+        self.load_checkpoint(latest_ckpt_path, path_filter="model")
\ No newline at end of file
@@ -87,6 +87,14 @@ def update_state(state, data, optimizer, loss_fn):
     
     return loss,new_state
 
+@functools.partial(jax.jit, static_argnums=(3,))
+def loss_and_grads(model, key, data, loss_fn):
+    """The first half of update_state, for optimizers applied outside of jit
+    (see dist_utils.OffloadedOptimizer)."""
+    new_key, subkey = jax.random.split(key)
+    loss, grads = jax.value_and_grad(loss_fn)(model, data, subkey)
+    return loss, grads, new_key
+
 @functools.partial(jax.jit, static_argnums=(2, 3))
 def update_state_dict(state_dict, data, optimizer, loss_fn):
     state = (
@@ -101,3 +109,21 @@ def update_state_dict(state_dict, data, optimizer, loss_fn):
         "prng_key": new_state[2]
     }
     return loss, new_state_dict
+
+@functools.partial(jax.jit, static_argnums=(2, 3, 4))
+def update_state_dict_compressed(state_dict, data, optimizer, loss_fn, compressor):
+    """update_state_dict with the gradients reduced across dp by `compressor`
+    (see grad_compression.GradCompressor), whose error feedback state is kept
+    in state_dict["grad_error"]."""
+    new_key, subkey = jax.random.split(state_dict["prng_key"])
+    loss, grads, grad_error = compressor.value_and_grad(
+        loss_fn, state_dict["model"], data, subkey, state_dict["grad_error"])
+
+    updates, new_opt_state = optimizer.update(grads, state_dict["opt_state"])
+    new_state_dict = {
+        "model": eqx.apply_updates(state_dict["model"], updates),
+        "opt_state": new_opt_state,
+        "prng_key": new_key,
+        "grad_error": grad_error
+    }
+    return loss, new_state_dict
@@ -0,0 +1,177 @@
+"""Estimate the per-device memory of a training configuration before launch.
+
+The model is built abstractly (DistManager.eval_model), so every parameter is a
+jax.ShapeDtypeStruct with the sharding its layer's _f_dict gives it and nothing
+is allocated. Parameters, optimizer state and error feedback state are
+counted exactly from their shards. Activations are estimated from the
+residuals the backward pass keeps, split over dp. When the training step can
+be compiled, XLA's memory analysis of it is reported as well. tune_remat
+plans and times a training step under each remat policy of the model's
+blocks.
+"""
+import copy
+import math
+
+import fs.memoryfs
+import jax
+import jax.numpy as jnp
+import jax.sharding as shrd
+import jax.tree_util as jtu
+import optax
+
+import monkfish.lvd.models.dist_layers as dl
+import monkfish.lvd.models.dist_utils as du
+import monkfish.lvd.models.grad_compression as gc
+import monkfish.lvd.diffusion_core as dc
+import monkfish.lvd.mesh_tuner as mt
+
+def device_bytes(pytree):
+    """Bytes of the abstract leaves of `pytree` held by one device (the most
+    loaded one, for shardings that don't divide evenly)."""
+    total = 0
+    for x in jtu.tree_leaves(pytree):
+        if not isinstance(x, jax.ShapeDtypeStruct):
+            continue
+        shape = x.shape
+        if isinstance(x.sharding, shrd.NamedSharding):
+            mesh = x.sharding.mesh
+            for dim, entry in enumerate(x.sharding.spec):
+                axes = () if entry is None else entry if isinstance(entry, tuple) else (entry,)
+                split = math.prod(mesh.shape[axis] for axis in axes)
+                shape = shape[:dim] + (-(-shape[dim] // split),) + shape[dim + 1:]
+        total += math.prod(shape) * x.dtype.itemsize
+    return total
+
+def activation_bytes(loss_fn, params, data, key):
+    """Bytes of the intermediate values loss_fn's backward pass keeps, per
+    device, taking them to be split over dp with the batch."""
+    def residuals(params, data, key):
+        _, vjp_fn = jax.vjp(lambda params: loss_fn(params, data, key), params)
+        param_leaves = jtu.tree_leaves(params)
+        return [x for x in jtu.tree_leaves(vjp_fn)
+                if not any(x is p for p in param_leaves)]
+    shapes = jax.eval_shape(residuals, params, data, key)
+    dp = params_dp(params)
+    return sum(math.prod(x.shape) * x.dtype.itemsize for x in shapes) // dp
+
+def params_dp(params):
+    for x in jtu.tree_leaves(params):
+        if isinstance(getattr(x, "sharding", None), shrd.NamedSharding):
+            return x.sharding.mesh.shape["dp"]
+    return 1
+
+def plan_memory(model, cfg, batch_size=None, compile=True, seq_len=256, txt_len=64):
+    """Per-device memory of training `model` ("dae" or "ardm") as configured
+    in `cfg`, from its dist_manager mesh_shape and train section. Nothing
+    is allocated on the devices."""
+    section = cfg[mt.CONFIG_SECTIONS[model]]
+    train_cfg = section["train"]
+    if batch_size is None:
+        batch_size = section["data_loader"]["batch_size"]
+    dist_manager = du.DistManager(section["dist_manager"]["mesh_shape"], fs.memoryfs.MemoryFS())
+
+    key = jax.ShapeDtypeStruct((2,), jnp.uint32, sharding=dist_manager.uniform_sharding)
+    make_model, loss_fn = mt.model_and_loss(dist_manager, model, cfg)
+    params = dist_manager.eval_model(make_model, key)
+
+    optimizer = optax.adam(learning_rate=train_cfg["lr"])
+    if train_cfg.get("zero1", False):
+        optimizer = dist_manager.zero1(optimizer)
+        opt_state = optimizer.init(params)
+    else:
+        opt_state = dist_manager.abstract_state(optimizer.init, params)
+    state = {"model": params, "opt_state": opt_state, "prng_key": key}
+
+    compressor = None
+    if train_cfg.get("grad_compression") is not None:
+        comp_cfg = train_cfg["grad_compression"]
+        compressor = gc.GradCompressor(
+            dist_manager, comp_cfg["mode"], comp_cfg.get("min_bytes", 2**16))
+        state["grad_error"] = compressor.init(params)
+
+    batch_sharding = dist_manager.sharding(shrd.PartitionSpec("dp"))
+    data = jtu.tree_map(
+        lambda x: jax.ShapeDtypeStruct(x.shape, x.dtype, sharding=batch_sharding),
+        mt.data_shapes(model, cfg, batch_size, seq_len, txt_len))
+
+    offload = train_cfg.get("offload_optimizer", False)
+    plan = {
+        "mesh_shape": list(section["dist_manager"]["mesh_shape"]),
+        "batch_size": batch_size,
+        "params": device_bytes(params),
+        # Offloaded optimizer state lives in host memory, see OffloadedOptimizer
+        "opt_state": 0 if offload else device_bytes(opt_state),
+        "host_opt_state": device_bytes(opt_state) if offload else 0,
+        "grad_error": device_bytes(state.get("grad_error")),
+        # Gradients are the size of the parameters
+        "grads": device_bytes(params),
+        "activations": activation_bytes(loss_fn, params, data, key),
+    }
+    plan["estimate"] = sum(plan[name] for name in
+                           ["params", "opt_state", "grad_error", "grads", "activations"])
+
+    plan["compiled"] = None
+    if compile and not offload:
+        if compressor is None:
+            lowered = dc.update_state_dict.lower(state, data, optimizer, loss_fn)
+        else:
+            lowered = dc.update_state_dict_compressed.lower(state, data, optimizer, loss_fn, compressor)
+        memory = lowered.compile().memory_analysis()
+        if memory is not None:
+            plan["compiled"] = (memory.argument_size_in_bytes + memory.output_size_in_bytes
+                                + memory.temp_size_in_bytes - memory.alias_size_in_bytes)
+
+    stats = jax.devices()[0].memory_stats()
+    plan["device_limit"] = None if stats is None else stats.get("bytes_limit")
+    return plan
+
+def tune_remat(model, cfg, batch_size=None, steps=3, policies=None, seq_len=256, txt_len=64):
+    """Plan the memory of `model` and time a training step of it under each
+    remat policy of its blocks (by default every one in 
+    dl.REMAT_POLICIES), on the configured mesh shape, to weigh the
+    activation memory a policy saves against the step time it costs.
+    Returns the plans in policy order, with the step times added."""
+    section = cfg[mt.CONFIG_SECTIONS[model]]
+    if batch_size is None:
+        batch_size = section["data_loader"]["batch_size"]
+    if policies is None:
+        policies = dl.REMAT_POLICIES
+
+    plans = []
+    for policy in policies:
+        policy_cfg = copy.deepcopy(cfg)
+        policy_cfg[mt.CONFIG_SECTIONS[model]]["model"]["remat_policy"] = policy
+        plan = plan_memory(model, policy_cfg, batch_size, compile=False, 
+                           seq_len=seq_len, txt_len=txt_len)
+        timing = mt.time_mesh(section["dist_manager"]["mesh_shape"], model, policy_cfg, 
+                              batch_size, steps=steps, seq_len=seq_len, txt_len=txt_len)
+        plan["remat_policy"] = policy
+        plan["compiled"] = timing["memory_bytes"]
+        plan["step_time"] = timing["step_time"]
+        plans.append(plan)
+    return plans
+
+def format_remat_plans(plans):
+    mib = lambda n: "n/a" if n is None else f"{n / 2**20:.1f}MiB"
+    lines = [f"mesh_shape {plans[0]['mesh_shape']}, batch size {plans[0]['batch_size']}, per device:"]
+    for plan in plans:
+        lines.append(f"  {plan['remat_policy']:12s} step {plan['step_time']*1000:.1f}ms, "
+                     f"activations {mib(plan['activations'])}, estimate {mib(plan['estimate'])}, "
+                     f"compiled {mib(plan['compiled'])}")
+    return "\n".join(lines)
+
+def format_plan(plan):
+    mib = lambda n: f"{n / 2**20:.1f}MiB"
+    lines = [f"mesh_shape {plan['mesh_shape']}, batch size {plan['batch_size']}, per device:"]
+    for name in ["params", "grads", "opt_state", "grad_error", "activations"]:
+        lines.append(f"  {name:12s} {mib(plan[name])}")
+    if plan["host_opt_state"]:
+        lines.append(f"  {'host_opt_state':12s} {mib(plan['host_opt_state'])} (host memory)")
+    lines.append(f"  {'estimate':12s} {mib(plan['estimate'])}")
+    if plan["compiled"] is not None:
+        lines.append(f"  {'compiled':12s} {mib(plan['compiled'])} (XLA memory analysis)")
+    if plan["device_limit"] is not None:
+        peak = plan["compiled"] if plan["compiled"] is not None else plan["estimate"]
+        fits = "fits" if peak <= plan["device_limit"] else "does NOT fit"
+        lines.append(f"  {'device limit':12s} {mib(plan['device_limit'])}, {fits}")
+    return "\n".join(lines)
@@ -0,0 +1,164 @@
+"""Pick the dp/mp/fsdp mesh shape that trains fastest on the available devices.
+
+Every factorization of the device count is tried in turn: the model is built
+under that mesh, a training step on synthetic data is compiled and timed, and
+the per-device memory and collective traffic of the step are read from the
+compiled program.
+"""
+import json
+import re
+import time
+
+import fs.memoryfs
+import jax
+import jax.numpy as jnp
+import jax.sharding as shrd
+import jax.tree_util as jtu
+import optax
+from jaxlib.xla_extension import XlaRuntimeError
+
+import monkfish.lvd.models.dist_utils as du
+import monkfish.lvd.diffusion_ae as dae
+import monkfish.lvd.diffusion_ar as dar
+import monkfish.lvd.diffusion_core as dc
+
+CONFIG_SECTIONS = {"dae": "diffusion_auto_encoder", "ardm": "transformer_ardm"}
+
+def mesh_factorizations(n_devices):
+    """All (dp, mp, fsdp) with dp * mp * fsdp == n_devices."""
+    shapes = []
+    for dp in range(1, n_devices + 1):
+        if n_devices % dp:
+            continue
+        for mp in range(1, n_devices // dp + 1):
+            if (n_devices // dp) % mp:
+                continue
+            shapes.append((dp, mp, n_devices // (dp * mp)))
+    return shapes
+
+def model_and_loss(dist_manager, model, cfg):
+    """make_model(key) and the loss of `model` ("dae" or "ardm"), as the 
+    harnesses build them from the config."""
+    model_conf = cfg[CONFIG_SECTIONS[model]]["model"]
+    if model == "dae":
+        return lambda key: dae.make_dae(dist_manager, model_conf, key), dae.dae_loss
+    return lambda key: dar.make_ardm(dist_manager, model_conf, key), dar.ardm_loss
+
+def data_shapes(model, cfg, batch_size, seq_len=256, txt_len=64):
+    """Shapes of one training batch of `model`."""
+    section = cfg[CONFIG_SECTIONS[model]]
+    if model == "dae":
+        width, height = section["resolution"]
+        return jax.ShapeDtypeStruct((batch_size, 3, width, height), jnp.float32)
+    return (jax.ShapeDtypeStruct((batch_size, seq_len, section["model"]["io_dim"]), jnp.float32),
+            jax.ShapeDtypeStruct((batch_size, txt_len), jnp.int32))
+
+def make_training_step(dist_manager, model, cfg, batch_size, seq_len=256, txt_len=64):
+    """State, synthetic batch and loss of one training step of `model` ("dae"
+    or "ardm"), laid out the way the harnesses lay them out."""
+    section = cfg[CONFIG_SECTIONS[model]]
+    if batch_size % dist_manager.mesh.shape["dp"]:
+        raise ValueError(f"Batch size {batch_size} doesn't split over dp={dist_manager.mesh.shape['dp']}")
+    batch_sharding = dist_manager.sharding(shrd.PartitionSpec("dp"))
+
+    key = dist_manager.get_key(cfg["seed"])
+    key, model_key, data_key = jax.random.split(key, 3)
+    make_model, loss_fn = model_and_loss(dist_manager, model, cfg)
+    params = dist_manager.init_model(make_model, model_key)
+
+    def fill(shape):
+        if jnp.issubdtype(shape.dtype, jnp.integer):
+            vocab = section["model"]["vocab"]
+            return jax.random.randint(data_key, shape.shape, 0, vocab, shape.dtype)
+        return jax.random.normal(data_key, shape.shape, shape.dtype)
+    data = jtu.tree_map(
+        lambda shape: jax.device_put(fill(shape), batch_sharding),
+        data_shapes(model, cfg, batch_size, seq_len, txt_len))
+
+    optimizer = optax.adam(learning_rate=section["train"]["lr"])
+    if section["train"].get("zero1", False):
+        optimizer = dist_manager.zero1(optimizer)
+    state = {"model": params, "opt_state": optimizer.init(params), "prng_key": key}
+    return state, data, optimizer, loss_fn
+
+def time_mesh(mesh_shape, model, cfg, batch_size, steps=3, **kwargs):
+    """Compile and time `steps` training steps under `mesh_shape`."""
+    dist_manager = du.DistManager(mesh_shape, fs.memoryfs.MemoryFS())
+    state, data, optimizer, loss_fn = make_training_step(
+        dist_manager, model, cfg, batch_size, **kwargs)
+
+    t1 = time.perf_counter()
+    step = dc.update_state_dict.lower(state, data, optimizer, loss_fn).compile()
+    compile_time = time.perf_counter() - t1
+    memory = step.memory_analysis()
+    collectives = du.collective_stats(step.as_text())
+
+    # The first step is a warm up, the best of the rest is reported
+    step_time = float("inf")
+    for i in range(steps + 1):
+        t1 = time.perf_counter()
+        loss, state = step(state, data)
+        jax.block_until_ready(loss)
+        if i > 0:
+            step_time = min(step_time, time.perf_counter() - t1)
+
+    return {
+        "mesh_shape": list(mesh_shape),
+        "step_time": step_time,
+        "compile_time": compile_time,
+        "memory_bytes": None if memory is None else (
+            memory.argument_size_in_bytes + memory.output_size_in_bytes
+            + memory.temp_size_in_bytes - memory.alias_size_in_bytes),
+        "collective_bytes": sum(entry["bytes"] for entry in collectives.values()),
+        "collectives": collectives,
+        "loss": float(loss),
+    }
+
+def tune_mesh(model, cfg, batch_size=None, steps=3, mesh_shapes=None, **kwargs):
+    """Time a training step under each mesh shape (by default every
+    factorization of the device count). Returns the results fastest first;
+    shapes the model or batch can't be split over are left out."""
+    if batch_size is None:
+        batch_size = cfg[CONFIG_SECTIONS[model]]["data_loader"]["batch_size"]
+    if mesh_shapes is None:
+        mesh_shapes = mesh_factorizations(len(jax.devices()))
+
+    results = []
+    for mesh_shape in mesh_shapes:
+        try:
+            result = time_mesh(mesh_shape, model, cfg, batch_size, steps=steps, **kwargs)
+        except (ValueError, XlaRuntimeError) as e:
+            # Only shapes the model or batch don't divide over (ValueError)
+            # or that run out of device memory are skipped
+            if isinstance(e, XlaRuntimeError) and "RESOURCE_EXHAUSTED" not in str(e):
+                raise
+            print(f"mesh_shape {list(mesh_shape)}: skipped, {type(e).__name__}: {e}")
+            continue
+        memory = "n/a" if result["memory_bytes"] is None else f"{result['memory_bytes'] / 2**20:.1f}MiB"
+        print(f"mesh_shape {result['mesh_shape']}: step {result['step_time']*1000:.1f}ms, "
+              f"compile {result['compile_time']:.1f}s, memory per device {memory}, "
+              f"collectives {result['collective_bytes'] / 2**20:.1f}MiB")
+        results.append(result)
+    return sorted(results, key=lambda result: result["step_time"])
+
+def write_mesh_shape(config_path, model, mesh_shape):
+    """Set the mesh_shape of `model`'s dist_manager in the config file.
+
+    Only that entry's text is replaced, the rest of the file is left as it
+    is. If the config has no such entry yet the whole file is rewritten."""
+    with open(config_path, 'r') as f:
+        text = f.read()
+    cfg = json.loads(text)
+    cfg[CONFIG_SECTIONS[model]]["dist_manager"]["mesh_shape"] = list(mesh_shape)
+
+    # Every section has a mesh_shape, the right one is the match that
+    # parses to the updated config
+    value = json.dumps(list(mesh_shape), separators=(",", ":"))
+    for match in re.finditer(r'("mesh_shape"\s*:\s*)\[[^\]]*\]', text):
+        new_text = text[:match.start()] + match.group(1) + value + text[match.end():]
+        if json.loads(new_text) == cfg:
+            break
+    else:
+        new_text = json.dumps(cfg, indent=4) + "\n"
+    with open(config_path, 'w') as f:
+        f.write(new_text)
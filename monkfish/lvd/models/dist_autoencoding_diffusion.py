@@ -44,7 +44,7 @@ def reconstruct_from_patches(patches, patch_width=16, patch_height=8):
 class Encoder(eqx.Module):
     layers: list
     
-    def __init__(self, dist_manager, key,  k, n_layers):
+    def __init__(self, dist_manager, key,  k, n_layers, remat_policy=None):
         keys = jax.random.split(key,n_layers + 2)
         
         layers = []
@@ -52,7 +52,7 @@ class Encoder(eqx.Module):
         embedding = dl.ShrdConv(dist_manager, keys[0], 1,1, 384,128*k)
         layers.append(embedding)
         for i in range(n_layers):
-            res_block = dl.ConvResBlock(dist_manager, keys[i], 128*k, 4*128*k)
+            res_block = dl.ConvResBlock(dist_manager, keys[i], 128*k, 4*128*k, remat_policy)
             layers.append(res_block)
         unembedding = dl.ShrdConv(dist_manager, keys[-1], 1,1, 128*k, 32)
         layers.append(unembedding)
@@ -74,7 +74,7 @@ class Decoder(eqx.Module):
     layers: list
     decode_embed:  dl.ShrdConv
     
-    def __init__(self, dist_manager, key, k, n_layers):
+    def __init__(self, dist_manager, key, k, n_layers, remat_policy=None):
         keys = jax.random.split(key,n_layers + 3)
         
         layers = []
@@ -82,7 +82,7 @@ class Decoder(eqx.Module):
         embedding = dl.ShrdConv(dist_manager, keys[0], 1, 1, 384, 128*k)
         layers.append(embedding)
         for i in range(n_layers):
-            res_block = dl.ConvResBlock(dist_manager, keys[0], 128*k, 4*128*k)
+            res_block = dl.ConvResBlock(dist_manager, keys[0], 128*k, 4*128*k, remat_policy)
             layers.append(res_block)
         unembedding = dl.ShrdConv(dist_manager, keys[-2], 1, 1, 128*k, 384)
         layers.append(unembedding)
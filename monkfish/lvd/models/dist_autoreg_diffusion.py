@@ -2,21 +2,29 @@ import os
 
 import jax
 import jax.numpy as jnp
+import jax.lax as lax
+import jax.sharding as shrd
 import equinox as eqx
 
 import monkfish.lvd.models.dist_layers as dl
+import monkfish.lvd.models.dist_utils as du
 
 class TransformerARDM(eqx.Module):
-    
-    layers: list
+    dist_manager: du.DistManager = eqx.field(static=True)
+    # A list of blocks, or with a pp mesh axis one block of stacked stages
+    layers: list | dl.TransformerBlock
     true_x_enc:  dl.ShrdLinear
     noise_x_enc:  dl.ShrdLinear
     txt_enc:  dl.ShrdLinear
     x_decode:  dl.ShrdLinear
+    n_microbatches: int = eqx.field(static=True)
     
     def __init__(self, dist_manager, key, res_dim, 
                  io_dim, vocab, n_layers,
-                 mlp_dim, qk_dim, v_dim, n_head):
+                 mlp_dim, qk_dim, v_dim, n_head, n_microbatches=1,
+                 attn_block_size=None, remat_policy=None):
+        self.dist_manager = dist_manager
+        self.n_microbatches = n_microbatches
         keys = jax.random.split(key,n_layers + 4)
         
         layers = []
@@ -24,27 +32,133 @@ class TransformerARDM(eqx.Module):
         for i in range(n_layers):
             res_block = dl.TransformerBlock(
                 dist_manager, keys[i], res_dim,
-                mlp_dim, qk_dim, v_dim, n_head)
+                mlp_dim, qk_dim, v_dim, n_head, attn_block_size, remat_policy)
             layers.append(res_block)
         
-        self.layers = layers
+        if dist_manager.axis_size("pp") > 1:
+            # Split into pipeline stages, see apply_batch
+            self.layers = dist_manager.stack_stages(layers)
+        else:
+            self.layers = layers
         
         self.true_x_enc = dl.ShrdLinear(dist_manager, keys[-4], io_dim, res_dim)
         self.noise_x_enc = dl.ShrdLinear(dist_manager, keys[-3], io_dim, res_dim)
         self.txt_enc = dl.ShrdLinear(dist_manager, keys[-2], vocab, res_dim)
         self.x_decode = dl.ShrdLinear(dist_manager, keys[-1], res_dim, io_dim)
 
-    #[txt_pos] x [x_pos x d_io] x [x_pos x d_io] -> [x_pos x d_io]
-    def __call__(self, true_x, noise_x, txt):
+    @property
+    def pipelined(self):
+        return not isinstance(self.layers, list)
+
+    @property
+    def sequence_parallel(self):
+        return self.dist_manager.axis_size("sp") > 1
+
+    def _vmap(self, f, **kwargs):
+        # Split over dp rather than replicated by shardings inside f
+        spmd_axis_name = "dp" if self.sequence_parallel else None
+        return jax.vmap(f, spmd_axis_name=spmd_axis_name, **kwargs)
+
+    def _embed_txt(self, txt):
         vocab = self.txt_enc.weight.shape[0]
+        return jax.vmap(self.txt_enc)(jax.nn.one_hot(txt, vocab))
 
-        h_suffix = (jax.vmap(self.true_x_enc)(true_x) +
+    def _embed_x(self, true_x, noise_x):
+        return (jax.vmap(self.true_x_enc)(true_x) +
             jax.vmap(self.noise_x_enc)(noise_x))
-        h_prefix = jax.vmap(self.txt_enc)(jax.nn.one_hot(txt, vocab))
+
+    def _embed(self, true_x, noise_x, txt):
+        h_suffix = self._embed_x(true_x, noise_x)
+        h_prefix = self._embed_txt(txt)
         h = jnp.concatenate([h_prefix, h_suffix], axis=0)
+        if self.sequence_parallel:
+            # Positions stay split over sp between the attention layers
+            h = lax.with_sharding_constraint(
+                h, self.dist_manager.sharding(shrd.PartitionSpec("sp", None)))
+        return h
+
+    def _decode(self, h, txt_len):
+        return jax.vmap(self.x_decode)(h[txt_len:])
 
-        for i in range(1,len(self.layers)):
-            h = self.layers[i](h)
+    #[txt_pos] x [x_pos x d_io] x [x_pos x d_io] -> [x_pos x d_io]
+    def __call__(self, true_x, noise_x, txt):
+        h = self._embed(true_x, noise_x, txt)
+
+        if self.pipelined:
+            # One example doesn't microbatch, the stages are run in sequence
+            layers = jax.tree_util.tree_map(
+                lambda x: x.reshape((-1,) + x.shape[2:]), self.layers)
+            h, _ = lax.scan(lambda h, layer: (layer(h), None), h, layers)
+        else:
+            for layer in self.layers:
+                h = layer(h)
         
-        y = jax.vmap(self.x_decode)(h[len(h_suffix):])
-        return y
\ No newline at end of file
+        y = self._decode(h, txt.shape[0])
+        return y
+
+    def init_cache(self, max_len):
+        """An empty cache for up to max_len text and x positions."""
+        if self.pipelined:
+            # The stages run in sequence, as in __call__, with a cache per layer
+            n_layers = self.layers.attn.qkv.shape[0] * self.layers.attn.qkv.shape[1]
+            layers = self.layers.init_cache(max_len, (n_layers,))
+        else:
+            layers = [layer.init_cache(max_len) for layer in self.layers]
+        return {"layers": layers, "length": jnp.zeros((), jnp.int32)}
+
+    def _extend_layers(self, h, cache):
+        start = cache["length"]
+        if self.pipelined:
+            layers = jax.tree_util.tree_map(
+                lambda x: x.reshape((-1,) + x.shape[2:]), self.layers)
+            layer_fn = lambda h, layer_cache: layer_cache[0].extend(h, layer_cache[1], start)
+            h, layer_caches = lax.scan(layer_fn, h, (layers, cache["layers"]))
+        else:
+            layer_caches = []
+            for layer, layer_cache in zip(self.layers, cache["layers"]):
+                h, layer_cache = layer.extend(h, layer_cache, start)
+                layer_caches.append(layer_cache)
+        # The layers leave their caches unchanged on an overflow, so does length
+        length = start + h.shape[0]
+        max_len = jax.tree_util.tree_leaves(cache["layers"])[0].shape[-2]
+        length = jnp.where(length > max_len, start, length)
+        return h, {"layers": layer_caches, "length": length}
+
+    #[txt_pos] -> cache
+    def prefill(self, txt, max_len):
+        """A cache of the text prefix, with room for max_len positions in all."""
+        if txt.shape[0] > max_len:
+            raise ValueError(f"A text prefix of {txt.shape[0]} doesn't fit in a cache of {max_len}")
+        _, cache = self._extend_layers(self._embed_txt(txt), self.init_cache(max_len))
+        return cache
+
+    #cache x [x_pos x d_io] x [x_pos x d_io] -> [x_pos x d_io], cache
+    def extend(self, cache, true_x, noise_x):
+        """The outputs for x positions following those in cache, and the cache
+        with them appended. Each layer attends to the earlier positions 
+        through their cached keys and values, so the outputs are those of 
+        __call__ on the whole sequence at a cost in the new positions only.
+        The returned cache can be dropped to run the same positions again, 
+        e.g. at each denoising step of a frame, keeping the one from the
+        frame's final inputs. Positions past the cache's max_len give NaN, and
+        the cache back unchanged."""
+        h, cache = self._extend_layers(self._embed_x(true_x, noise_x), cache)
+        return jax.vmap(self.x_decode)(h), cache
+
+    #[batch x txt_pos] x [batch x x_pos x d_io] x [batch x x_pos x d_io] -> [batch x x_pos x d_io]
+    def apply_batch(self, true_x, noise_x, txt):
+        """The model vmapped over a batch. With pipeline stages the batch
+        goes through them in n_microbatches microbatches (see 
+        DistManager.pipeline)."""
+        if not self.pipelined:
+            return self._vmap(self)(true_x, noise_x, txt)
+
+        h = self._vmap(self._embed)(true_x, noise_x, txt)
+
+        def stage_fn(stage, h):
+            layer_fn = lambda h, layer: (self._vmap(layer)(h), None)
+            h, _ = lax.scan(layer_fn, h, stage)
+            return h
+        h = self.dist_manager.pipeline(stage_fn, self.layers, h, self.n_microbatches)
+
+        return jax.vmap(self._decode, in_axes=(0, None))(h, txt.shape[1])
@@ -1,16 +1,56 @@
 import os
+import json
+import math
 import functools
 
 import jax
 import jax.numpy as jnp
 import jax.sharding as shrd
 import jax.lax as lax
+import jax.ad_checkpoint as ad_checkpoint
+import jax.experimental.shard_map as shard_map
 import equinox as eqx
 
 import monkfish.lvd.models.dist_utils as du
 
 #TODO: Subclass eqx.Module properly
 
+# Policies of remat, a config's remat_policy may also be null for "none"
+REMAT_POLICIES = ["none", "full", "save_matmuls", "offload"]
+# Name the outputs of ShrdLinear, ShrdConv and the attention projections 
+# are tagged with, for the remat policies that keep them
+MATMUL_NAME = "matmul"
+
+def check_remat_policy(policy):
+    """Raise ValueError unless policy is one of REMAT_POLICIES or None."""
+    if policy is not None and policy not in REMAT_POLICIES:
+        raise ValueError(f"Unknown remat policy {policy}, expected one of {REMAT_POLICIES}")
+
+def remat(f, policy):
+    """f, with what its backward pass keeps set by policy:
+    "none" (or None) keeps every intermediate value; "full" keeps only f's
+    arguments and recomputes the rest; "save_matmuls" also keeps the 
+    outputs of the linear, convolution and attention projections, 
+    recomputing only the elementwise ops and attention scores between 
+    them; "offload" keeps the same outputs in pinned host memory, or on
+    the device where there is none (e.g. on CPU), as save_matmuls."""
+    if policy is None or policy == "none":
+        return f
+    if policy == "full":
+        return jax.checkpoint(f)
+    save_matmuls = jax.checkpoint_policies.save_only_these_names(MATMUL_NAME)
+    if policy == "save_matmuls":
+        return jax.checkpoint(f, policy=save_matmuls)
+    if policy == "offload":
+        memory_kinds = {memory.kind for memory in jax.devices()[0].addressable_memories()}
+        if "pinned_host" not in memory_kinds:
+            return jax.checkpoint(f, policy=save_matmuls)
+        offload = jax.checkpoint_policies.save_and_offload_only_these_names(
+            names_which_can_be_saved=[], names_which_can_be_offloaded=[MATMUL_NAME],
+            offload_src="device", offload_dst="pinned_host")
+        return jax.checkpoint(f, policy=offload)
+    check_remat_policy(policy)
+
 def make_f_dict(pre_dict, dist_manager):
     f_dict = {}
     for name, (p_spec, path) in pre_dict.items():
@@ -24,20 +64,185 @@ def make_f_dict(pre_dict, dist_manager):
         }
     return f_dict
 
+#[n_blocks*b x d] -> [n_blocks x b x d]
+def _blocks(x, block_size):
+    return x.reshape(x.shape[0] // block_size, block_size, x.shape[1])
+
+def _causal_tiles(visible, body, init, xs):
+    """Scan body over the blocks in xs, whose first entry is the block index,
+    skipping those for which visible(index) is False. The index isn't 
+    batched under a vmap over heads or examples, so the skip stays a branch
+    rather than becoming a select."""
+    skip = lambda carry, *xs: carry
+    step = lambda carry, xs: (lax.cond(visible(xs[0]), body, skip, carry, *xs), None)
+    carry, _ = lax.scan(step, init, xs)
+    return carry
+
+def _tile_probs(i, j, q, k, lse):
+    # Softmax weights of a tile from the log sum exp of each query's scores
+    diagonal_mask = jnp.tril(jnp.ones((q.shape[0], k.shape[0]), dtype=bool))
+    p = jnp.exp(jnp.einsum("ik,jk->ij", q, k) - lse[:, jnp.newaxis])
+    return jnp.where((j < i) | diagonal_mask, p, 0)
+
+def _attend_init(q, vs):
+    # Running max, sum and weighted sum of values of each query's scores
+    return (jnp.full((q.shape[0],), -jnp.inf, q.dtype),
+            jnp.zeros((q.shape[0],), q.dtype),
+            jnp.zeros((q.shape[0], vs.shape[-1]), vs.dtype))
+
+def _tile_softmax(i, j, q, k, v):
+    # Max, sum and weighted sum of values of the scores of query block i 
+    # with key block j, j <= i
+    diagonal_mask = jnp.tril(jnp.ones((q.shape[0], k.shape[0]), dtype=bool))
+    #[b x d_qk] x [b x d_qk] -> [b x b]
+    s = jnp.einsum("ik,jk->ij", q, k)
+    s = jnp.where((j < i) | diagonal_mask, s, -jnp.inf)
+    m = jnp.max(s, axis=1)
+    p = jnp.exp(s - m[:, jnp.newaxis])
+    return m, jnp.sum(p, axis=1), jnp.einsum("ij,jk->ik", p, v)
+
+def _attend_tile(carry, i, j, q, k, v):
+    # Online softmax update of query block i with key block j
+    m, l, acc = carry
+    tile_m, tile_l, tile_acc = _tile_softmax(i, j, q, k, v)
+    new_m = jnp.maximum(m, tile_m)
+    rescale, tile_rescale = jnp.exp(m - new_m), jnp.exp(tile_m - new_m)
+    l = rescale*l + tile_rescale*tile_l
+    acc = rescale[:, jnp.newaxis]*acc + tile_rescale[:, jnp.newaxis]*tile_acc
+    return new_m, l, acc
+
+@functools.partial(jax.custom_vjp, nondiff_argnums=(3,))
+def blockwise_attention(qs, ks, vs, block_size):
+    """Causal softmax(qs ks^T) vs in block_size x block_size tiles, with a 
+    running max and sum of each query's scores (online softmax), so the
+    [pos x pos] scores are never held at once. Tiles above the diagonal are
+    skipped. The backward pass recomputes each tile's weights from the saved
+    log sum exp instead of keeping them. pos must be a multiple of 
+    block_size."""
+    return _blockwise_attention_fwd(qs, ks, vs, block_size)[0]
+
+def _blockwise_attention_fwd(qs, ks, vs, block_size):
+    pos = qs.shape[0]
+    n_blocks = pos // block_size
+    q_blocks, k_blocks, v_blocks = (_blocks(x, block_size) for x in (qs, ks, vs))
+
+    def query_block(i, q):
+        attend = lambda carry, j, k, v: _attend_tile(carry, i, j, q, k, v)
+        m, l, acc = _causal_tiles(lambda j: j <= i, attend, _attend_init(q, vs),
+                                  (jnp.arange(n_blocks), k_blocks, v_blocks))
+        return acc / l[:, jnp.newaxis], m + jnp.log(l)
+
+    y, lse = lax.map(lambda args: query_block(*args), (jnp.arange(n_blocks), q_blocks))
+    y = y.reshape(pos, vs.shape[1])
+    return y, (qs, ks, vs, y, lse)
+
+def _blockwise_attention_bwd(block_size, residuals, dy):
+    qs, ks, vs, y, lse = residuals
+    n_blocks = qs.shape[0] // block_size
+    q_blocks, k_blocks, v_blocks, dy_blocks = (
+        _blocks(x, block_size) for x in (qs, ks, vs, dy))
+    # d(softmax)/d(scores) term shared by every tile of a query
+    delta = jnp.sum(dy_blocks * _blocks(y, block_size), axis=2)
+
+    def dq_block(i, q, dy, lse, delta):
+        def attend(dq, j, k, v):
+            p = _tile_probs(i, j, q, k, lse)
+            ds = p * (jnp.einsum("ik,jk->ij", dy, v) - delta[:, jnp.newaxis])
+            return dq + jnp.einsum("ij,jk->ik", ds, k)
+        return _causal_tiles(lambda j: j <= i, attend, jnp.zeros_like(q),
+                             (jnp.arange(n_blocks), k_blocks, v_blocks))
+
+    def dkv_block(j, k, v):
+        def attend(carry, i, q, dy, lse, delta):
+            dk, dv = carry
+            p = _tile_probs(i, j, q, k, lse)
+            ds = p * (jnp.einsum("ik,jk->ij", dy, v) - delta[:, jnp.newaxis])
+            return dk + jnp.einsum("ij,ik->jk", ds, q), dv + jnp.einsum("ij,ik->jk", p, dy)
+        init = (jnp.zeros_like(k), jnp.zeros_like(v))
+        return _causal_tiles(lambda i: j <= i, attend, init,
+                             (jnp.arange(n_blocks), q_blocks, dy_blocks, lse, delta))
+
+    dqs = lax.map(lambda args: dq_block(*args),
+                  (jnp.arange(n_blocks), q_blocks, dy_blocks, lse, delta))
+    dks, dvs = lax.map(lambda args: dkv_block(*args), (jnp.arange(n_blocks), k_blocks, v_blocks))
+    return dqs.reshape(qs.shape), dks.reshape(ks.shape), dvs.reshape(vs.shape)
+
+blockwise_attention.defvjp(_blockwise_attention_fwd, _blockwise_attention_bwd)
+
+@functools.partial(jax.custom_vjp, nondiff_argnums=(3, 4))
+def ring_attention(q, k, v, axis_name, axis_size):
+    """Causal attention of a sequence split in axis_size blocks over the mesh
+    axis axis_name, for use inside shard_map. q, k and v are this device's
+    block, the key and value blocks are passed around the ring with ppermute
+    and attended with the same online softmax as blockwise_attention, so no
+    device holds more than two blocks of keys and values. Blocks after the
+    device's own are skipped. The backward pass sends the key and value 
+    gradients around with their blocks, ending on the device they came 
+    from."""
+    return _ring_attention_fwd(q, k, v, axis_name, axis_size)[0]
+
+def _ring_perm(axis_size):
+    return [(i, (i + 1) % axis_size) for i in range(axis_size)]
+
+def _ring_attention_fwd(q, k, v, axis_name, axis_size):
+    i = lax.axis_index(axis_name)
+    attend = lambda carry, j, k, v: _attend_tile(carry, i, j, q, k, v)
+    # Starting from this device's own block rather than an empty carry
+    # keeps XLA:CPU from folding the empty carry into a slow fused matmul
+    carry = _tile_softmax(i, i, q, k, v)
+
+    # After t steps this device holds block i - t
+    def step(carry, t):
+        carry, k, v = carry
+        k, v = lax.ppermute((k, v), axis_name, _ring_perm(axis_size))
+        j = (i - t) % axis_size
+        return (lax.cond(j <= i, attend, lambda carry, *xs: carry, carry, j, k, v), k, v), None
+    (carry, _, _), _ = lax.scan(step, (carry, k, v), jnp.arange(1, axis_size))
+
+    m, l, acc = carry
+    y = acc / l[:, jnp.newaxis]
+    return y, (q, k, v, y, m + jnp.log(l))
+
+def _ring_attention_bwd(axis_name, axis_size, residuals, dy):
+    q, k, v, y, lse = residuals
+    i = lax.axis_index(axis_name)
+    delta = jnp.sum(dy * y, axis=1)
+
+    def attend(carry, j):
+        dq, k, v, dk, dv = carry
+        p = _tile_probs(i, j, q, k, lse)
+        ds = p * (jnp.einsum("ik,jk->ij", dy, v) - delta[:, jnp.newaxis])
+        return (dq + jnp.einsum("ij,jk->ik", ds, k), k, v,
+                dk + jnp.einsum("ij,ik->jk", ds, q), dv + jnp.einsum("ij,ik->jk", p, dy))
+    carry = attend((jnp.zeros_like(q), k, v, jnp.zeros_like(k), jnp.zeros_like(v)), i)
+
+    def step(carry, t):
+        dq, *kv = carry
+        kv = lax.ppermute(tuple(kv), axis_name, _ring_perm(axis_size))
+        j = (i - t) % axis_size
+        return lax.cond(j <= i, attend, lambda carry, j: carry, (dq, *kv), j), None
+    (dq, _, _, dk, dv), _ = lax.scan(step, carry, jnp.arange(1, axis_size))
+
+    # One more step brings the key and value gradients home
+    dk, dv = lax.ppermute((dk, dv), axis_name, _ring_perm(axis_size))
+    return dq, dk, dv
+
+ring_attention.defvjp(_ring_attention_fwd, _ring_attention_bwd)
+
 class ShrdMHAttention(eqx.Module):
     dist_manager: du.DistManager = eqx.field(static=True)
-    q: jax.Array
-    k: jax.Array
-    v: jax.Array
+    # The q, k and v projections of every head, concatenated on the last axis
+    qkv: jax.Array
     o: jax.Array
     qk_layer_norm: jax.Array | None
     theta_factor: jax.Array
+    # Query and key block size of the blockwise attention, None for dense
+    block_size: int | None = eqx.field(static=True)
+    d_qk: int = eqx.field(static=True)
     
     def _f_dict(self):
         pre_dict = {
-            "q": ((("mp","fsdp"), None, None), "q.pkl"),
-            "k": ((("mp","fsdp"), None, None), "k.pkl"),
-            "v": ((("mp","fsdp"), None, None), "v.pkl"),
+            "qkv": ((("mp","fsdp"), None, None), "qkv.pkl"),
             "o": ((("mp","fsdp"), None, None), "o.pkl"),
             "qk_layer_norm": ((None,), "qk_layer_norm.pkl"),
             "theta_factor":((), "theta_factor.pkl")
@@ -45,29 +250,20 @@ class ShrdMHAttention(eqx.Module):
         return make_f_dict(pre_dict, self.dist_manager)
     
     def __init__(self, dist_manager, key, d_model, 
-                 n_head, d_qk, d_v, qk_layer_norm=False, theta_factor=10000):
+                 n_head, d_qk, d_v, qk_layer_norm=False, theta_factor=10000,
+                 block_size=None):
         keys = jax.random.split(key, 6)
 
 
         self.dist_manager = dist_manager
+        self.block_size = block_size
+        self.d_qk = d_qk
 
-        #Init q 
-        shape = (n_head, d_model, d_qk)
-        std = 1
-        self.q = self.dist_manager.init_randn_array(
-            shape, std, self._f_dict()["q"]["sharding"], keys[0])
-        
-        #Init k
-        shape = (n_head, d_model, d_qk)
-        std = 1
-        self.k = self.dist_manager.init_randn_array(
-            shape, std, self._f_dict()["k"]["sharding"], keys[1])
-        
-        #Init v
-        shape = (n_head, d_model, d_v)
+        #Init qkv
+        shape = (n_head, d_model, 2*d_qk + d_v)
         std = 1
-        self.v = self.dist_manager.init_randn_array(
-            shape, std, self._f_dict()["v"]["sharding"], keys[2])
+        self.qkv = self.dist_manager.init_randn_array(
+            shape, std, self._f_dict()["qkv"]["sharding"], keys[0])
         
         #Init o
         shape = (n_head, d_v, d_model)
@@ -91,70 +287,99 @@ class ShrdMHAttention(eqx.Module):
         else:
             self.qk_layer_norm = None
     
-    def _mha(self, x, q, k, v, o, mask):
-        par_sha = jax.vmap(self._sha, in_axes=(None, 0, 0, 0, None))
+    #[pos x d_model] -> [head x pos x d_qk] x [head x pos x d_qk] x [head x pos x d_v]
+    def _qkv(self, x, rope_tables):
+        #[pos x d_model] x [head x d_model x 2 d_qk + d_v] -> [head x pos x 2 d_qk + d_v]
+        qkv = ad_checkpoint.checkpoint_name(jnp.einsum("ij,hjk->hik", x, self.qkv), MATMUL_NAME)
+        qs, ks, vs = jnp.split(qkv, [self.d_qk, 2*self.d_qk], axis=2)
+        return self._rope_embed(qs, rope_tables), self._rope_embed(ks, rope_tables), vs
+
+    def _mha(self, x, mask):
+        # Shared by the queries and keys of every head
+        rope_tables = self._rope_tables(x.shape[0])
+        rot_qs, rot_ks, vs = self._qkv(x, rope_tables)
+
+        # With an sp mesh axis the positions are split over it, otherwise a
+        # sequence that fits in one block is one tile, attended densely
+        if self.dist_manager.axis_size("sp") > 1:
+            y = self._ring_attention(rot_qs, rot_ks, vs)
+        elif self.block_size is not None and x.shape[0] > self.block_size:
+            y = jax.vmap(self._blockwise_attention)(rot_qs, rot_ks, vs)
+        else:
+            #[head x pos x d_qk] x [head x pos x d_qk] -> [head x pos x pos]
+            unmasked_attention = jnp.einsum("hik,hjk->hij", rot_qs, rot_ks)
+            masked_attention = unmasked_attention-mask
+            attention_weights = jax.nn.softmax(masked_attention)
 
-        #[pos x d_model] x [head x d_model x d_qk] x 
-        #[head x d_model x d_qk] x [head x d_model x d_v] -> 
-        #[head x pos x d_v]
-        y = par_sha(x, q, k, v, mask)
+            #[head x pos x pos] x [head x pos x d_v] -> [head x pos x d_v]
+            y = jnp.einsum("hij,hjk->hik", attention_weights, vs)
         
         #[head x pos x d_v] x [head x d_v x d_model] -> [pos x d_model]
-        z = jnp.einsum("ijk,ikl->jl", y, o)
-        return z
-        
-    def _sha(self, x,  q, k, v, mask):
-        
-        #[pos x d_model] x [d_model x d_qk] -> [pos x d_qk]
-        pre_qs = jnp.einsum("ij,jk->ik", x, q)
-        rot_qs = self._rope_embed(pre_qs)
-        
-        #[pos x d_model] x [d_model x d_qk] -> [pos x d_qk]
-        pre_ks = jnp.einsum("ij,jk->ik", x, k)
-        rot_ks = self._rope_embed(pre_ks)
-        
-        #[pos x d_model] x [d_model x d_v] -> [pos x d_v]
-        vs = jnp.einsum("ij,jk->ik", x, v)
-
-        #[pos x d_qk] x [pos x d_qk] -> [pos x pos]
-        unmasked_attention = jnp.einsum("ik,jk->ij", rot_qs, rot_ks)
-        masked_attention = unmasked_attention-mask
-        attention_weights = jax.nn.softmax(masked_attention)
-
-        #[pos x pos] x [pos x d_v] -> [pos x d_model]
-        y = jnp.einsum("ij,jk->ik", attention_weights, vs)
-        
-        return y
-    #[pos x d_qk] -> [pos x d_qk]
-    def _rope_embed(self, x):
-        d_qk = self.q.shape[2]
-        d_pos = x.shape[0]
-        d_rope = x.shape[1] // 2
+        z = jnp.einsum("ijk,ikl->jl", y, self.o)
+        return ad_checkpoint.checkpoint_name(z, MATMUL_NAME)
+
+    #[pos x d_qk] x [pos x d_qk] x [pos x d_v] -> [pos x d_v]
+    def _blockwise_attention(self, qs, ks, vs):
+        b = self.block_size
+        pos = qs.shape[0]
+        # Padded keys come after every query, so the causal mask drops them
+        pad = lambda x: jnp.pad(x, ((0, -pos % b), (0, 0)))
+        y = blockwise_attention(pad(qs), pad(ks), pad(vs), b)
+        return y[:pos]
+
+    #[head x pos x d_qk] x [head x pos x d_qk] x [head x pos x d_v] -> [head x pos x d_v]
+    def _ring_attention(self, qs, ks, vs):
+        """Attention with the positions split over the sp mesh axis, see
+        ring_attention. Each device holds pos / sp positions of its heads, so
+        the longest sequence that fits grows with sp."""
+        sp = self.dist_manager.axis_size("sp")
+        pos = qs.shape[1]
+        # As in _blockwise_attention, padded keys follow every query
+        pad = lambda x: jnp.pad(x, ((0, 0), (0, -pos % sp), (0, 0)))
+        spec = shrd.PartitionSpec(("mp","fsdp"), "sp", None)
+        attend = jax.vmap(lambda q, k, v: ring_attention(q, k, v, "sp", sp))
+        f = shard_map.shard_map(
+            attend, mesh=self.dist_manager.mesh, in_specs=(spec, spec, spec),
+            out_specs=spec, check_rep=False)
+        return f(pad(qs), pad(ks), pad(vs))[:, :pos]
+
+    def _rope_tables(self, length, start=0):
+        """Rotary embedding tables of positions start ... start + length - 1,
+        [pos x d_qk] each, with the qk norm folded in. Made once per call 
+        and shared by the queries and keys of every head, theta_factor 
+        being per layer."""
+        d_qk = self.d_qk
+        d_rope = d_qk // 2
         rate_vector = self.theta_factor*(-jnp.arange(0,d_rope)/d_rope)
-        pos_vector = jnp.arange(0, d_pos)
+        pos_vector = start + jnp.arange(0, length)
 
         rot_factor = jnp.einsum("i,j->ij", pos_vector, rate_vector)
         sin_factor, cos_factor = jnp.sin(rot_factor),jnp.cos(rot_factor)
 
-        x1,x2 = x[:,:d_rope],x[:,d_rope:]
-
-        y1 = cos_factor*x1 - sin_factor*x2
-        y2 = sin_factor*x1 + cos_factor*x2
-
-        y = jnp.concatenate([y1, y2], axis=1)
-        
         #Norm step
         if self.qk_layer_norm is None:
-            y = y/(d_qk**(1/4))
+            scale = 1/(d_qk**(1/4))
         else:
             raise NotImplementedError
-        
-        return y
+
+        # [x1, x2] -> [cos*x1 - sin*x2, sin*x1 + cos*x2] is
+        # [x1, x2]*cos_table + [x2, x1]*sin_table
+        cos_table = scale*jnp.concatenate([cos_factor, cos_factor], axis=1)
+        sin_table = scale*jnp.concatenate([-sin_factor, sin_factor], axis=1)
+        return cos_table, sin_table
+
+    #[... x pos x d_qk] -> [... x pos x d_qk]
+    def _rope_embed(self, x, rope_tables):
+        cos_table, sin_table = rope_tables
+        d_rope = x.shape[-1] // 2
+        swapped = jnp.concatenate([x[...,d_rope:], x[...,:d_rope]], axis=-1)
+        return x*cos_table + swapped*sin_table
 
     def _causal_mask(self, size):
         # Creating a lower triangular matrix of ones (including diagonal)
         mask = jnp.tril(jnp.ones((size, size)))
-        mask = mask - 1
+        # 0 on and below the diagonal, 1 above, and subtracted from the scores
+        mask = 1 - mask
         #TODO: Less hacky
         mask = mask * 1000000000
         return mask
@@ -163,9 +388,161 @@ class ShrdMHAttention(eqx.Module):
     def __call__(self, x):
         seq_length = x.shape[0]  # Get the sequence length
         causal_mask = self._causal_mask(seq_length)  # Create the causal mask for the sequence
-        y = self._mha(x, self.q, self.k, self.v, self.o, causal_mask)
+        y = self._mha(x, causal_mask)
         return y
 
+    def init_cache(self, max_len, leading_shape=()):
+        """Empty keys and values of max_len positions for extend, sharded
+        like the heads. leading_shape stacks caches, e.g. one per layer."""
+        n_head, d_qk, d_v = self.qkv.shape[-3], self.d_qk, self.o.shape[-2]
+        spec = self._f_dict()["qkv"]["sharding"].spec
+        sharding = self.dist_manager.sharding(
+            shrd.PartitionSpec(*(None,)*len(leading_shape), *spec))
+        zeros = lambda d: lax.with_sharding_constraint(
+            jnp.zeros(leading_shape + (n_head, max_len, d)), sharding)
+        return {"k": zeros(d_qk), "v": zeros(d_v)}
+
+    #[pos x d_model] -> [pos x d_model]
+    def extend(self, x, cache, start):
+        """Attention of positions start, start + 1, ... in x to themselves 
+        and the positions before start in cache, as __call__ on the whole 
+        sequence would give. Returns the output and the cache with the keys 
+        and values of x written at start, which must leave them within its
+        max_len. If they don't the output is NaN and the cache is returned
+        unchanged."""
+        max_len = cache["k"].shape[-2]
+        if x.shape[0] > max_len:
+            raise ValueError(f"{x.shape[0]} positions don't fit in a cache of {max_len}")
+        rope_tables = self._rope_tables(x.shape[0], start)
+        rot_qs, rot_ks, vs = self._qkv(x, rope_tables)
+
+        #[head x max_len x d_qk], [head x max_len x d_v]
+        sharding = self._f_dict()["qkv"]["sharding"]
+        k_cache = lax.with_sharding_constraint(
+            lax.dynamic_update_slice(cache["k"], rot_ks, (0, start, 0)), sharding)
+        v_cache = lax.with_sharding_constraint(
+            lax.dynamic_update_slice(cache["v"], vs, (0, start, 0)), sharding)
+
+        #[head x pos x d_qk] x [head x max_len x d_qk] -> [head x pos x max_len]
+        scores = jnp.einsum("hik,hjk->hij", rot_qs, k_cache)
+        # Positions after each query, cached or not yet written, are masked
+        visible = (jnp.arange(k_cache.shape[1])[jnp.newaxis, :] <=
+                   start + jnp.arange(x.shape[0])[:, jnp.newaxis])
+        attention_weights = jax.nn.softmax(jnp.where(visible, scores, -jnp.inf))
+
+        #[head x pos x max_len] x [head x max_len x d_v] -> [head x pos x d_v]
+        y = jnp.einsum("hij,hjk->hik", attention_weights, v_cache)
+
+        #[head x pos x d_v] x [head x d_v x d_model] -> [pos x d_model]
+        z = jnp.einsum("ijk,ikl->jl", y, self.o)
+        # dynamic_update_slice clamps a start past max_len - pos, overwriting
+        # cached positions, so an overflow poisons the output instead and
+        # leaves the cache as it was
+        overflow = start + x.shape[0] > max_len
+        z = jnp.where(overflow, jnp.nan, z)
+        k_cache = jnp.where(overflow, cache["k"], k_cache)
+        v_cache = jnp.where(overflow, cache["v"], v_cache)
+        return z, {"k": k_cache, "v": v_cache}
+
+def fuse_qkv_checkpoint(dist_manager, src_dir, dst_dir, state=None):
+    """Copy the checkpoint src_dir to dst_dir with the attention weights of 
+    the earlier ShrdMHAttention layout, separate q, k and v arrays, 
+    concatenated into its qkv. State kept per parameter, such as optimizer
+    moments, is fused the same way. Returns the names of the fused arrays.
+
+    A sharded checkpoint (see DistManager.save_pytree_sharded) finds the q, 
+    k and v arrays by name. A pickle checkpoint (src_dir/ckpt.pkl) only has
+    the leaves in order, so `state` must be the state it was saved from as
+    built now, with fused qkv weights: its tree, with each qkv split back 
+    into q, k and v, is the order the old leaves were written in. The 
+    result is written in the same format as src_dir."""
+    if dist_manager.fs.exists(f"{src_dir}/ckpt.pkl"):
+        if state is None:
+            raise ValueError(f"{src_dir} is a pickle checkpoint, converting it needs the state it was saved from")
+        return _fuse_qkv_pickle(dist_manager, f"{src_dir}/ckpt.pkl", f"{dst_dir}/ckpt.pkl", state)
+    if not dist_manager.is_sharded_checkpoint(src_dir):
+        raise ValueError(f"{src_dir} is not a sharded checkpoint")
+    with dist_manager.fs.open(f"{src_dir}/{du.SHARDED_INDEX}", 'r') as f:
+        arrays = json.load(f)["arrays"]
+
+    # Every ".../q" with a ".../k" and ".../v" beside it
+    prefixes = [name[:-1] for name in arrays 
+                if (name == "q" or name.endswith("/q")) 
+                and name[:-1] + "k" in arrays and name[:-1] + "v" in arrays]
+    separate = {prefix + part for prefix in prefixes for part in "qkv"}
+    if not dist_manager.prepare_sharded(dst_dir):
+        raise ValueError(f"{dst_dir} already holds a checkpoint")
+
+    if dist_manager.pid == 0:
+        for name in arrays:
+            if name not in separate:
+                dist_manager.fs.makedirs(f"{dst_dir}/{name}", recreate=True)
+                dist_manager.fs.copydir(f"{src_dir}/{name}", f"{dst_dir}/{name}")
+
+    fused = {}
+    for prefix in prefixes:
+        sharding = _saved_sharding(dist_manager, arrays[prefix + "q"])
+        parts = [dist_manager.load_array_chunked(sharding, f"{src_dir}/{prefix}{part}")
+                 for part in "qkv"]
+        concatenate = jax.jit(lambda *parts: jnp.concatenate(parts, axis=-1),
+                              out_shardings=sharding)
+        name = prefix + "qkv"
+        snapshot = dist_manager.snapshot_pytree_sharded(
+            {name: concatenate(*parts)}, {name: sharding})
+        dist_manager.write_shards(snapshot, dst_dir)
+        fused.update(snapshot["arrays"])
+    dist_manager.barrier("fuse_qkv_checkpoint_sync")
+
+    if dist_manager.pid == 0:
+        kept = {name: meta for name, meta in arrays.items() if name not in separate}
+        dist_manager.commit_sharded({"arrays": {**kept, **fused}, "shards": []}, dst_dir)
+    dist_manager.barrier("commit_fuse_qkv_checkpoint_sync")
+    return sorted(fused)
+
+def _fuse_qkv_pickle(dist_manager, src_file, dst_file, state):
+    # The leaves of the old tree: where state has a qkv, the old module had
+    # q, k and v as its first three fields
+    flat_state, tree_def = jax.tree_util.tree_flatten_with_path(state)
+    is_qkv = [_is_qkv(du.leaf_path(path)) for path, _ in flat_state]
+    shardings = []
+    for (_, leaf), qkv in zip(flat_state, is_qkv):
+        shardings.extend([leaf.sharding] * (3 if qkv else 1))
+    loaded = iter(dist_manager.load_pytree(shardings, src_file))
+
+    leaves = []
+    for (path, leaf), qkv in zip(flat_state, is_qkv):
+        parts = [next(loaded) for _ in range(3 if qkv else 1)]
+        shape = parts[0].shape
+        if qkv:
+            shape = shape[:-1] + (sum(part.shape[-1] for part in parts),)
+        if shape != leaf.shape:
+            raise ValueError(f"{src_file} doesn't match state at {du.leaf_path(path)}: "
+                             f"{shape} saved, {leaf.shape} expected")
+        if qkv:
+            concatenate = jax.jit(lambda *parts: jnp.concatenate(parts, axis=-1).astype(leaf.dtype),
+                                  out_shardings=leaf.sharding)
+            leaves.append(concatenate(*parts))
+        else:
+            leaves.append(parts[0].astype(leaf.dtype))
+    fused_state = jax.tree_util.tree_unflatten(tree_def, leaves)
+    dist_manager.save_pytree(fused_state, dist_manager.get_pytree_sharding(fused_state), dst_file)
+    return sorted(du.leaf_path(path) for (path, _), qkv in zip(flat_state, is_qkv) if qkv)
+
+def _is_qkv(name):
+    return name == "qkv" or name.endswith("/qkv")
+
+def _saved_sharding(dist_manager, meta):
+    # The partition spec an array was saved with, if this mesh has its axes
+    spec = meta.get("spec")
+    if spec is None:
+        return dist_manager.uniform_sharding
+    spec = du.spec_from_json(spec)
+    axes = [axis for entry in spec if entry is not None
+            for axis in (entry if isinstance(entry, tuple) else (entry,))]
+    if not all(axis in dist_manager.mesh.axis_names for axis in axes):
+        return dist_manager.uniform_sharding
+    return dist_manager.sharding(spec)
+
 #TODO: Support dilation
 class ShrdConv(eqx.Module):
     dist_manager: du.DistManager = eqx.field(static=True)
@@ -187,7 +564,7 @@ class ShrdConv(eqx.Module):
         key1,key2 = jax.random.split(key)
         self.dist_manager = dist_manager
         
-        self.scale = 1/jax.numpy.sqrt(h*w*in_dim)
+        self.scale = 1/math.sqrt(h*w*in_dim)
 
         self.padding = padding
         
@@ -213,6 +590,7 @@ class ShrdConv(eqx.Module):
             x[jnp.newaxis,:,:], self.kernel, 
             window_strides=(1,1), padding=self.padding, 
             lhs_dilation=None, rhs_dilation=None)[0,:,:,:]
+        y = ad_checkpoint.checkpoint_name(y, MATMUL_NAME)
         y = y*self.scale
         if self.bias is not None:
             y = y + self.bias
@@ -236,7 +614,7 @@ class ShrdLinear(eqx.Module):
         self.dist_manager = dist_manager
         key1,key2 = jax.random.split(key)
 
-        self.scale = 1/jnp.sqrt(out_dim)
+        self.scale = 1/math.sqrt(out_dim)
 
         #Init weight
         shape = (in_dim, out_dim)
@@ -255,7 +633,8 @@ class ShrdLinear(eqx.Module):
     
     #[h] -> [h]
     def __call__(self, x):
-        y = jnp.einsum("i,ij->j",x, self.weight)*self.scale
+        y = ad_checkpoint.checkpoint_name(jnp.einsum("i,ij->j",x, self.weight), MATMUL_NAME)
+        y = y*self.scale
         if self.bias is not None:
             y = y + self.bias
         return y
@@ -263,15 +642,22 @@ class ShrdLinear(eqx.Module):
 class ConvResBlock(eqx.Module):
     layer1: ShrdConv
     layer2: ShrdConv
+    # What the backward pass keeps of the block, see remat
+    remat_policy: str | None = eqx.field(static=True)
 
-    def __init__(self, dist_manager, key,  in_dim, latent_dim):
+    def __init__(self, dist_manager, key,  in_dim, latent_dim, remat_policy=None):
+        check_remat_policy(remat_policy)
         key1, key2 = jax.random.split(key)
 
         self.layer1 = ShrdConv(dist_manager, key1, 3, 3, in_dim, latent_dim)
         self.layer2 = ShrdConv(dist_manager, key2, 3, 3, latent_dim, in_dim)
+        self.remat_policy = remat_policy
 
     #[in_dim x height x width] -> [in_dim x height x width]
     def __call__(self, x):
+        return remat(type(self)._forward, self.remat_policy)(self, x)
+
+    def _forward(self, x):
         h = self._norm(x)
         h = self.layer1(h)
         h = self.layer2(h)
@@ -288,12 +674,17 @@ class TransformerBlock(eqx.Module):
     mlpl1: ShrdLinear
     mlpl2: ShrdLinear
     attn: ShrdMHAttention
+    # What the backward pass keeps of the block, see remat
+    remat_policy: str | None = eqx.field(static=True)
 
     def __init__(self, dist_manager, key, res_dim, mlp_dim, 
-                 qk_dim, v_dim, n_head):
+                 qk_dim, v_dim, n_head, attn_block_size=None, remat_policy=None):
+        check_remat_policy(remat_policy)
         self.mlpl1 = ShrdLinear(dist_manager, key, res_dim, mlp_dim)
         self.mlpl2 = ShrdLinear(dist_manager, key, mlp_dim, res_dim)
-        self.attn = ShrdMHAttention(dist_manager, key, res_dim, n_head, qk_dim, v_dim)
+        self.attn = ShrdMHAttention(dist_manager, key, res_dim, n_head, qk_dim, v_dim,
+                                    block_size=attn_block_size)
+        self.remat_policy = remat_policy
     
     def _norm(self, x):
         m = jnp.mean(x, axis=1)
@@ -303,12 +694,29 @@ class TransformerBlock(eqx.Module):
     
     #[pos x res_dim] -> [pos x res_dim]
     def __call__(self, x):
+        return remat(type(self)._forward, self.remat_policy)(self, x)
+
+    def _forward(self, x):
         h1 = self._norm(x)
         h2 = jax.vmap(self.mlpl1)(h1)
         h3 = jax.vmap(self.mlpl2)(h2)
         h4 = self.attn(h1)
         y = h3 + h4 + x
         return y
+
+    def init_cache(self, max_len, leading_shape=()):
+        return self.attn.init_cache(max_len, leading_shape)
+
+    #[pos x res_dim] -> [pos x res_dim]
+    def extend(self, x, cache, start):
+        """__call__ on positions start, start + 1, ... with the earlier 
+        ones' attention keys and values in cache, see ShrdMHAttention.extend."""
+        h1 = self._norm(x)
+        h2 = jax.vmap(self.mlpl1)(h1)
+        h3 = jax.vmap(self.mlpl2)(h2)
+        h4, cache = self.attn.extend(h1, cache, start)
+        y = h3 + h4 + x
+        return y, cache
         
 
 
@@ -1,5 +1,16 @@
 import functools
+import collections
+import io
+import itertools
+import concurrent.futures
+import contextlib
+import json
+import math
 import os
+import re
+import threading
+import time
+import zlib
 
 import google.cloud.storage as gcs
 
@@ -13,10 +24,178 @@ import jax.experimental.shard_map as shard_map
 import jax.sharding as shrd
 
 import jax.numpy as jnp
+import jax.lax as lax
 import jax.tree_util as jtu
 
+import numpy as np
+import optax
+
+# Host memory budget for a single transfer chunk
+DEFAULT_CHUNK_BYTES = 64 * 2**20
+
+# Metadata file of a sharded checkpoint directory, and the marker written
+# once all of its shards have landed
+SHARDED_INDEX = "index.json"
+COMMIT_MARKER = "COMMIT"
+
+# Collective ops counted by collective_stats. Asynchronous collectives are 
+# counted at their "-done" op, whose shape is the result's
+COLLECTIVE_OPS = ("all-gather", "all-reduce", "reduce-scatter", "all-to-all", "collective-permute")
+_COLLECTIVE_RE = re.compile(
+    r"=\s*(\(.*?\)|\S+)\s+(" + "|".join(COLLECTIVE_OPS) + r")(-done)?\(")
+# Computation headers, e.g. "%name (p: f32[]) -> f32[] {", the loops' body
+# and condition computations, and any computation referenced by an op
+_HLO_COMPUTATION_RE = re.compile(r"^(?:ENTRY\s+)?%([^\s(]+)\s.*\{\s*$")
+_HLO_LOOP_RE = re.compile(r"\b(?:body|condition)=%([^\s,)}]+)")
+_HLO_REF_RE = re.compile(r"%([^\s,)}]+)")
+_HLO_ARRAY_RE = re.compile(r"([a-z]+[0-9]*[a-z0-9]*)\[([0-9,]*)\]")
+_HLO_DTYPE_BYTES = {"pred": 1, "s8": 1, "u8": 1, "s16": 2, "u16": 2, "f16": 2, "bf16": 2,
+                    "s32": 4, "u32": 4, "f32": 4, "s64": 8, "u64": 8, "f64": 8, "c64": 8, "c128": 16}
+
+def hlo_shape_bytes(shape):
+    """Size in bytes of an HLO shape such as "f32[128,64]{1,0}" or a tuple of them."""
+    nbytes = 0
+    for dtype, dims in _HLO_ARRAY_RE.findall(shape):
+        # fp8 types (f8e4m3fn, ...) are a byte per element
+        itemsize = _HLO_DTYPE_BYTES.get(dtype, 1)
+        nbytes += itemsize * math.prod(int(d) for d in dims.split(",") if d)
+    return nbytes
+
+def hlo_computations(hlo_text):
+    """Lines of each computation of an HLO module's text, by name."""
+    computations = {}
+    lines = None
+    for line in hlo_text.splitlines():
+        match = _HLO_COMPUTATION_RE.match(line)
+        if match:
+            lines = computations[match.group(1)] = []
+        elif line.startswith("}"):
+            lines = None
+        elif lines is not None:
+            lines.append(line)
+    return computations
+
+def loop_computations(computations):
+    """Names of the while loop bodies and conditions of an HLO module, and
+    of everything they call."""
+    pending = [name for lines in computations.values() for line in lines
+               for name in _HLO_LOOP_RE.findall(line)]
+    loops = set()
+    while pending:
+        name = pending.pop()
+        if name in loops or name not in computations:
+            continue
+        loops.add(name)
+        pending.extend(ref for line in computations[name] 
+                       for ref in _HLO_REF_RE.findall(line))
+    return loops
+
+def collective_stats(hlo_text):
+    """Count and per-device result bytes of each kind of collective in the
+    text of an optimized HLO module, e.g. `compiled.as_text()`.
+
+    These are static counts of the ops in the program: an op inside a loop
+    body is counted once however many times the loop runs. "in_loop" is how
+    many of them are in loop bodies, their bytes are a lower bound on what
+    a step moves."""
+    computations = hlo_computations(hlo_text)
+    loops = loop_computations(computations)
+    stats = {}
+    for name, lines in computations.items():
+        for shape, op, _ in _COLLECTIVE_RE.findall("\n".join(lines)):
+            entry = stats.setdefault(op, {"count": 0, "bytes": 0, "in_loop": 0})
+            entry["count"] += 1
+            entry["bytes"] += hlo_shape_bytes(shape)
+            entry["in_loop"] += name in loops
+    return stats
+
+def format_comm_report(report):
+    """Human readable lines of a DistManager.comm_report."""
+    lines = []
+    for op, entry in sorted(report.get("collectives", {}).items()):
+        line = f"{op}: {entry['count']} ops in the step, {entry['bytes'] / 2**20:.2f}MiB per device"
+        if entry["in_loop"]:
+            line += f" ({entry['in_loop']} ops in loop bodies counted once)"
+        lines.append(line)
+    for kind in ["barriers", "transfers"]:
+        for name, entry in sorted(report[kind].items()):
+            line = f"{name}: {entry['count']} calls, {entry['seconds']:.3f}s"
+            if entry["bytes"]:
+                line += f", {entry['bytes'] / 2**20:.1f}MiB"
+            lines.append(line)
+    return "\n".join(lines)
+
+def bubble_fraction(n_stages, n_microbatches):
+    """Fraction of the stage steps of a GPipe schedule spent idle (on padding):
+    each stage runs n_microbatches + n_stages - 1 steps, n_stages - 1 of them
+    while the pipeline fills or drains."""
+    return (n_stages - 1) / (n_microbatches + n_stages - 1)
+
+def leaf_path(path):
+    """'/'-joined name of a pytree key path, e.g. "model/encoder/layers/0/weight"."""
+    parts = []
+    for k in path:
+        if isinstance(k, jtu.GetAttrKey):
+            parts.append(k.name)
+        elif isinstance(k, jtu.SequenceKey):
+            parts.append(str(k.idx))
+        else:
+            parts.append(str(k.key))
+    return "/".join(parts)
+
+def spec_to_json(spec):
+    if spec is None:
+        return None
+    return [list(axis) if isinstance(axis, tuple) else axis for axis in spec]
+
+def spec_from_json(spec):
+    return shrd.PartitionSpec(*[tuple(axis) if isinstance(axis, list) else axis for axis in spec])
+
+def shard_bounds(index, shape):
+    """[[start, stop], ...] of a shard index (a tuple of slices) into `shape`."""
+    return [list(s.indices(n)[:2]) for s, n in zip(index, shape)]
+
+def chunk_key(bounds, chunks):
+    """Name of the chunk starting at `bounds` in a grid of `chunks` sized chunks."""
+    if len(bounds) == 0:
+        return "0"
+    return ".".join(str(start // size) for (start, _), size in zip(bounds, chunks))
+
+def chunk_file(key, compression=None):
+    return f"{key}.npy" if compression is None else f"{key}.npy.{compression}"
+
+def compressor(name):
+    """(compress, decompress) functions of a lossless block compression codec:
+    "zlib", or "lz4" / "zstd" if the lz4 / zstandard packages are installed."""
+    if name == "zlib":
+        return functools.partial(zlib.compress, level=1), zlib.decompress
+    elif name == "lz4":
+        try:
+            import lz4.frame
+        except ImportError:
+            raise RuntimeError("lz4 compression requires the lz4 package.")
+        return lz4.frame.compress, lz4.frame.decompress
+    elif name == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd compression requires the zstandard package.")
+        return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+    else:
+        raise ValueError(f"Unsupported compression {name}")
+
+def match_path(path_filter, name):
+    """Whether the leaf path `name` passes `path_filter`: None passes everything,
+    a string passes that path and everything under it, and a callable is
+    called with the path."""
+    if path_filter is None:
+        return True
+    if callable(path_filter):
+        return path_filter(name)
+    return name == path_filter or name.startswith(path_filter.rstrip("/") + "/")
+
 class DistManager:
-    def __init__(self, mesh_shape, filesystem):
+    def __init__(self, mesh_shape, filesystem, chunk_bytes=DEFAULT_CHUNK_BYTES, compression=None):
         self.pid = jax.process_index()
         self.nodes = jax.process_count()
         self.cpu_device = jax.local_devices(backend="cpu")[0]
@@ -26,11 +205,28 @@ class DistManager:
         self.physical_mesh = mesh_utils.create_device_mesh(
             mesh_shape, allow_split_physical_axes=True)
 
-        self.mesh = shrd.Mesh(self.physical_mesh, ("dp", "mp", "fsdp"))
+        # A leading fourth entry of mesh_shape adds a pipeline axis, and a
+        # fifth, after dp, a sequence axis (see ShrdMHAttention._ring_attention)
+        axis_names = {3: ("dp", "mp", "fsdp"), 4: ("pp", "dp", "mp", "fsdp"),
+                      5: ("pp", "dp", "sp", "mp", "fsdp")}[len(mesh_shape)]
+        self.mesh = shrd.Mesh(self.physical_mesh, axis_names)
 
         self.uniform_sharding = shrd.NamedSharding(self.mesh, shrd.PartitionSpec())
 
         self.fs = filesystem
+        self.chunk_bytes = chunk_bytes
+        # Block compression applied to checkpoints written by this manager
+        self.compression = compression
+
+        self._gather_rows_fns = {}
+        # Parameters created while tracing init_model
+        self._init_trace = None
+        # Compiled transfer programs, keyed by the signature they were built for
+        self._transfer_cache = {}
+        # Time spent in barriers and host transfers since the last comm_report,
+        # writes may come from an AsyncCheckpointer's thread
+        self._comm_timings = {"barriers": {}, "transfers": {}}
+        self._comm_lock = threading.Lock()
     
     def get_key(self, seed):
         uniform_sharding = shrd.NamedSharding(self.mesh, shrd.PartitionSpec())
@@ -46,22 +242,597 @@ class DistManager:
     
     def sharding(self, partition_spec):
         return shrd.NamedSharding(self.mesh, partition_spec)
+
+    def axis_size(self, name):
+        """Size of the mesh axis `name`, 1 if the mesh doesn't have it."""
+        return self.mesh.shape.get(name, 1)
+
+    def zero1_sharding(self, sharding, shape):
+        """`sharding` with the first axis of `shape` that still divides evenly 
+        also split over dp. Returned unchanged if it already uses dp, lies off
+        the mesh, or no axis divides."""
+        if not isinstance(sharding, shrd.NamedSharding) or not self._on_mesh(sharding):
+            return sharding
+        spec = list(sharding.spec) + [None] * (len(shape) - len(sharding.spec))
+        entries = [() if entry is None else entry if isinstance(entry, tuple) else (entry,) 
+                   for entry in spec]
+        if any("dp" in axes for axes in entries):
+            return sharding
+
+        dp = self.mesh.shape["dp"]
+        for i, (axes, n) in enumerate(zip(entries, shape)):
+            split = math.prod(self.mesh.shape[axis] for axis in axes)
+            if n % (split * dp) == 0:
+                spec[i] = ("dp",) + axes if axes else "dp"
+                return self.sharding(shrd.PartitionSpec(*spec))
+        return sharding
+
+    def zero1(self, optimizer):
+        """Wrap an optax optimizer so its state is partitioned along dp 
+        (ZeRO stage 1). Gradients are reduce-scattered onto the state's 
+        shards, the update is computed per shard, and the updates are 
+        all-gathered back to the parameters' sharding. Cuts optimizer state
+        memory per device by the dp factor.
+
+        init must be called outside of jit, on concrete parameters or on 
+        eval_model's abstract ones (returning abstract state), since the
+        layout is taken from their shardings. It may be called on several 
+        sets of parameters (e.g. OffloadedOptimizer's groups), update 
+        using the layout of the set with the same structure and shapes as 
+        its updates."""
+        # Layouts of each init call, keyed by the parameters' signature
+        layouts = {}
+
+        def signature(tree):
+            leaves, tree_def = jtu.tree_flatten(tree)
+            return tree_def, tuple(tuple(x.shape) for x in leaves)
+
+        def constrain(tree, shardings):
+            return jtu.tree_map(
+                lambda x, sharding: x if sharding is None else lax.with_sharding_constraint(x, sharding),
+                tree, shardings, is_leaf=lambda x: x is None)
+
+        def init_fn(params):
+            param_shardings = self.get_pytree_sharding(params)
+            layout = layouts[signature(params)] = {}
+            layout["params"] = param_shardings
+            layout["grads"] = jtu.tree_map(
+                lambda x, sharding: None if sharding is None else self.zero1_sharding(sharding, x.shape),
+                params, param_shardings)
+
+            if any(isinstance(x, jax.ShapeDtypeStruct) for x in jtu.tree_leaves(params)):
+                opt_state = self.abstract_state(optimizer.init, params)
+                place = lambda x, sharding: jax.ShapeDtypeStruct(x.shape, x.dtype, sharding=sharding)
+            else:
+                opt_state = optimizer.init(params)
+                place = jax.device_put
+            # Leaves off the mesh (e.g. the uncommitted step count) are left alone
+            layout["opt_state"] = jtu.tree_map(
+                lambda x: self.zero1_sharding(x.sharding, x.shape) 
+                if isinstance(x, (jax.Array, jax.ShapeDtypeStruct)) and self._on_mesh(x.sharding) else None,
+                opt_state)
+            return jtu.tree_map(
+                lambda x, sharding: x if sharding is None else place(x, sharding),
+                opt_state, layout["opt_state"], is_leaf=lambda x: x is None)
+
+        def update_fn(updates, state, params=None):
+            if signature(updates) not in layouts:
+                raise ValueError("zero1 update of parameters its init wasn't called on")
+            layout = layouts[signature(updates)]
+            grads = constrain(updates, layout["grads"])
+            updates, state = optimizer.update(grads, state, params)
+            return constrain(updates, layout["params"]), constrain(state, layout["opt_state"])
+
+        return optax.GradientTransformation(init_fn, update_fn)
+
+    @contextlib.contextmanager
+    def timed(self, kind, name, nbytes=0):
+        """Add the time spent in the block to the "barriers" or "transfers" 
+        entry `name` of the next comm_report."""
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - t1
+            with self._comm_lock:
+                entry = self._comm_timings[kind].setdefault(
+                    name, {"count": 0, "seconds": 0.0, "bytes": 0})
+                entry["count"] += 1
+                entry["seconds"] += seconds
+                entry["bytes"] += int(nbytes)
+
+    def barrier(self, name):
+        """mhu.sync_global_devices, timed."""
+        with self.timed("barriers", name):
+            mhu.sync_global_devices(name)
+
+    def comm_report(self, collectives=None, reset=True):
+        """`collectives`, the collective_stats of a compiled program (e.g. the
+        training step), and the barrier and host transfer timings accumulated
+        since the last report. See format_comm_report."""
+        with self._comm_lock:
+            report = {kind: {name: dict(entry) for name, entry in entries.items()}
+                      for kind, entries in self._comm_timings.items()}
+            if reset:
+                self._comm_timings = {"barriers": {}, "transfers": {}}
+        if collectives is not None:
+            report["collectives"] = collectives
+        return report
     
     def scatter(self, sharding, dtype):
-        g = lambda x: x.astype(dtype)
-        f = jax.jit(g, in_shardings=None, out_shardings=sharding)
-        return f
+        key = ("scatter", sharding, np.dtype(dtype))
+        if key not in self._transfer_cache:
+            g = lambda x: x.astype(dtype)
+            self._transfer_cache[key] = jax.jit(g, in_shardings=None, out_shardings=sharding)
+        return self._transfer_cache[key]
     
     def gather(self, sharding, dtype):
-        g = lambda x: x.astype(dtype)
-        f = lambda x: jax.device_get(jax.jit(g, in_shardings=sharding, out_shardings=None))(x)
+        key = ("gather", sharding, np.dtype(dtype))
+
+        def f(x):
+            if self._shardwise(x):
+                return self.gather_shards(x, dtype)
+            # Arrays spanning several processes are replicated to be fetched
+            if key not in self._transfer_cache:
+                g = lambda x: x.astype(dtype)
+                self._transfer_cache[key] = jax.jit(g, in_shardings=sharding, out_shardings=None)
+            return jax.device_get(self._transfer_cache[key](x))
         return f
 
+    def gather_shards(self, x, dtype=None, out=None):
+        """Copy an array this process holds all of to host shard by shard, 
+        without first replicating it across devices, so gathering takes no 
+        extra device memory. Each replicated shard is copied once."""
+        shards = [shard for shard in x.addressable_shards if shard.replica_id == 0]
+        for shard in shards:
+            shard.data.copy_to_host_async()
+        if out is None:
+            out = np.empty(x.shape, dtype=x.dtype if dtype is None else dtype)
+        for shard in shards:
+            out[shard.index] = np.asarray(shard.data)
+        return out
+
+    def _shardwise(self, x):
+        return isinstance(x, jax.Array) and x.is_fully_addressable
+
+    def scatter_pytree(self, pytree, sharding_pytree, dtype=jnp.float32, chunk_bytes=None):
+        """Move a pytree of host arrays onto the mesh. Leaves are grouped into
+        buckets of up to `chunk_bytes`, each moved by one compiled program;
+        larger leaves are streamed with scatter_chunked."""
+        chunk_bytes = chunk_bytes or self.chunk_bytes
+        flat_pytree, tree_def = jtu.tree_flatten(pytree)
+        flat_sharding_pytree, _ = jtu.tree_flatten(sharding_pytree)
+
+        leaves = [None] * len(flat_pytree)
+        nbytes = [np.size(leaf) * np.dtype(dtype).itemsize for leaf in flat_pytree]
+        with self.timed("transfers", "scatter_pytree", sum(nbytes)):
+            for bucket, large in self._buckets(nbytes, chunk_bytes):
+                if large:
+                    i, = bucket
+                    leaves[i] = self.scatter_chunked(flat_sharding_pytree[i], dtype, chunk_bytes)(
+                        flat_pytree[i])
+                    continue
+                arrays = self.scatter_bucket(
+                    [flat_pytree[i] for i in bucket], [flat_sharding_pytree[i] for i in bucket], dtype)
+                for i, array in zip(bucket, arrays):
+                    leaves[i] = array
+            jax.block_until_ready(leaves)
+        return jtu.tree_unflatten(tree_def, leaves)
+
+    def gather_pytree(self, pytree, sharding_pytree, dtype=jnp.float32, chunk_bytes=None):
+        """Inverse of scatter_pytree, returns a pytree of host numpy arrays."""
+        chunk_bytes = chunk_bytes or self.chunk_bytes
+        flat_pytree, tree_def = jtu.tree_flatten(pytree)
+        flat_sharding_pytree, _ = jtu.tree_flatten(sharding_pytree)
+
+        leaves = [None] * len(flat_pytree)
+        nbytes = [jnp.size(leaf) * np.dtype(dtype).itemsize for leaf in flat_pytree]
+        with self.timed("transfers", "gather_pytree", sum(nbytes)):
+            for bucket, large in self._buckets(nbytes, chunk_bytes):
+                if large:
+                    i, = bucket
+                    leaves[i] = self.gather_chunked(flat_sharding_pytree[i], dtype, chunk_bytes)(
+                        flat_pytree[i])
+                    continue
+                arrays = self.gather_bucket(
+                    [flat_pytree[i] for i in bucket], [flat_sharding_pytree[i] for i in bucket], dtype)
+                for i, array in zip(bucket, arrays):
+                    leaves[i] = array
+        return jtu.tree_unflatten(tree_def, leaves)
+
+    def scatter_bucket(self, leaves, shardings, dtype=None):
+        """Transfer a list of host arrays with a single compiled program. A 
+        dtype of None keeps the dtype of each leaf."""
+        leaves = [np.asarray(leaf) if dtype is None else np.asarray(leaf, dtype=dtype) 
+                  for leaf in leaves]
+        out = [None] * len(leaves)
+        on_mesh = [i for i, sharding in enumerate(shardings) if self._on_mesh(sharding)]
+        # Leaves placed off the mesh (e.g. optax's step count) can't share the program
+        for i in set(range(len(leaves))) - set(on_mesh):
+            out[i] = jax.device_put(leaves[i], shardings[i])
+
+        if on_mesh:
+            specs = tuple((leaves[i].shape, leaves[i].dtype, None) for i in on_mesh)
+            out_shardings = tuple(shardings[i] for i in on_mesh)
+            arrays = self._transfer_fn(specs, out_shardings, None)(*[leaves[i] for i in on_mesh])
+            for i, array in zip(on_mesh, arrays):
+                out[i] = array
+        return out
+
+    def gather_bucket(self, leaves, shardings, dtype=None):
+        """Fetch a list of sharded arrays to host. Arrays held entirely by this
+        process are copied shard by shard, the rest with a single compiled 
+        program."""
+        out = [None] * len(leaves)
+        shardwise = [i for i, leaf in enumerate(leaves) if self._shardwise(leaf)]
+        # Start every device to host copy before waiting on any of them
+        for i in shardwise:
+            for shard in leaves[i].addressable_shards:
+                if shard.replica_id == 0:
+                    shard.data.copy_to_host_async()
+        for i in shardwise:
+            out[i] = self.gather_shards(leaves[i], dtype)
+
+        on_mesh = [i for i, sharding in enumerate(shardings) 
+                   if self._on_mesh(sharding) and i not in shardwise]
+        for i in set(range(len(leaves))) - set(on_mesh) - set(shardwise):
+            out[i] = np.asarray(jax.device_get(leaves[i]), dtype=dtype)
+
+        if on_mesh:
+            specs = tuple((jnp.shape(leaves[i]), jnp.result_type(leaves[i]), shardings[i])
+                          for i in on_mesh)
+            out_shardings = (self.uniform_sharding,) * len(on_mesh)
+            arrays = self._transfer_fn(specs, out_shardings, dtype)(*[leaves[i] for i in on_mesh])
+            for i, array in zip(on_mesh, arrays):
+                out[i] = np.asarray(array.addressable_data(0))
+        return out
+
+    def _on_mesh(self, sharding):
+        return sharding.device_set == set(self.mesh.devices.flat)
+
+    def _transfer_fn(self, specs, out_shardings, dtype):
+        # Compiled ahead of time, so a cache hit costs no tracing or lowering
+        key = (specs, out_shardings, None if dtype is None else np.dtype(dtype))
+        if key not in self._transfer_cache:
+            g = lambda *xs: tuple(x if dtype is None else x.astype(dtype) for x in xs)
+            args = [jax.ShapeDtypeStruct(shape, src_dtype, sharding=sharding)
+                    for shape, src_dtype, sharding in specs]
+            self._transfer_cache[key] = jax.jit(
+                g, out_shardings=out_shardings).lower(*args).compile()
+        return self._transfer_cache[key]
+
+    def _buckets(self, nbytes, chunk_bytes):
+        """Group leaf indices, in order, into runs totalling at most
+        `chunk_bytes`. Larger leaves come alone and flagged, and None entries
+        are skipped."""
+        bucket, bucket_bytes = [], 0
+        for i, n in enumerate(nbytes):
+            if n is None:
+                continue
+            if n > chunk_bytes or bucket_bytes + n > chunk_bytes:
+                if bucket:
+                    yield bucket, False
+                bucket, bucket_bytes = [], 0
+            if n > chunk_bytes:
+                yield [i], True
+                continue
+            bucket.append(i)
+            bucket_bytes += n
+        if bucket:
+            yield bucket, False
+
+    def scatter_chunked(self, sharding, dtype, chunk_bytes=None):
+        """Like scatter, but reads the host array (which may be a memmap) one
+        block of rows at a time, so no full-size host copy is ever made."""
+        chunk_bytes = chunk_bytes or self.chunk_bytes
+
+        def f(x):
+            if x.ndim == 0:
+                return self.scatter_chunks(x.shape, sharding, dtype, [x])
+            chunks = (x[start:start + size] 
+                      for start, size in self._row_chunks(x.shape, x.dtype, chunk_bytes))
+            return self.scatter_chunks(x.shape, sharding, dtype, chunks)
+        return f
+
+    def gather_chunked(self, sharding, dtype, chunk_bytes=None):
+        """Like gather, but assembles the host array from bounded-size row 
+        blocks. Pass `out` (e.g. a memmap) to avoid allocating the result."""
+        chunk_bytes = chunk_bytes or self.chunk_bytes
+
+        def f(x, out=None):
+            if out is None:
+                out = np.empty(x.shape, dtype=dtype)
+            if x.ndim == 0:
+                out[...] = next(self.gather_chunks(x, sharding, dtype, chunk_bytes))
+                return out
+            start = 0
+            for chunk in self.gather_chunks(x, sharding, dtype, chunk_bytes):
+                out[start:start + len(chunk)] = chunk
+                start += len(chunk)
+            return out
+        return f
+
+    def scatter_chunks(self, shape, sharding, dtype, chunks):
+        """Build a sharded array of `shape` from `chunks`, consecutive blocks of
+        rows along the leading axis. Each block is split between the local 
+        devices that hold part of it as it arrives, so the host only ever holds
+        one block."""
+        dtype = np.dtype(dtype)
+
+        if len(shape) == 0:
+            chunk = np.asarray(next(iter(chunks)), dtype=dtype)
+            return self.scatter(sharding, dtype)(chunk)
+
+        # Replicated shards are transferred once, then copied device to device
+        index_devices = {}
+        for device, index in sharding.addressable_devices_indices_map(shape).items():
+            bounds = tuple(s.indices(n)[:2] for s, n in zip(index, shape))
+            index_devices.setdefault(bounds, []).append(device)
+        pieces = {bounds: [] for bounds in index_devices}
+
+        row = 0
+        for chunk in chunks:
+            chunk_rows = (row, row + len(chunk))
+            for bounds, devices in index_devices.items():
+                start, stop = max(bounds[0][0], chunk_rows[0]), min(bounds[0][1], chunk_rows[1])
+                if start >= stop:
+                    continue
+                local_index = (slice(start - row, stop - row),) + tuple(
+                    slice(*b) for b in bounds[1:])
+                piece = np.asarray(chunk[local_index], dtype=dtype)
+                pieces[bounds].append(jax.device_put(piece, devices[0]))
+            row += len(chunk)
+        assert row == shape[0], f"Chunks cover {row} rows, expected {shape[0]}"
+
+        device_arrays = []
+        for bounds, devices in index_devices.items():
+            shard = pieces[bounds][0] if len(pieces[bounds]) == 1 else jnp.concatenate(pieces[bounds])
+            device_arrays.append(shard)
+            for device in devices[1:]:
+                device_arrays.append(jax.device_put(shard, device))
+        return jax.make_array_from_single_device_arrays(shape, sharding, device_arrays)
+
+    def gather_chunks(self, x, sharding, dtype, chunk_bytes=None):
+        """Yield `x` as host blocks of rows along the leading axis, each at most
+        `chunk_bytes` (or a single row). Every process must iterate this, only
+        one block is replicated at a time."""
+        chunk_bytes = chunk_bytes or self.chunk_bytes
+
+        if jnp.ndim(x) == 0:
+            yield np.asarray(self.gather(sharding, dtype)(x))
+            return
+
+        if self._shardwise(x):
+            yield from self._gather_shard_rows(x, dtype, chunk_bytes)
+            return
+
+        for start, size in self._row_chunks(jnp.shape(x), dtype, chunk_bytes):
+            f = self._gather_rows_fn(sharding, dtype, size)
+            chunk = f(x, start)
+            yield np.asarray(chunk.addressable_data(0))
+
+    def _gather_shard_rows(self, x, dtype, chunk_bytes):
+        # Each block is cut from the shards overlapping it, on their own devices
+        shards = [shard for shard in x.addressable_shards if shard.replica_id == 0]
+        for start, size in self._row_chunks(x.shape, dtype, chunk_bytes):
+            block = np.empty((size,) + x.shape[1:], dtype=dtype)
+            for shard in shards:
+                shard_start, shard_stop, _ = shard.index[0].indices(x.shape[0])
+                lo, hi = max(start, shard_start), min(start + size, shard_stop)
+                if lo >= hi:
+                    continue
+                rows = shard.data[lo - shard_start:hi - shard_start]
+                block[(slice(lo - start, hi - start),) + shard.index[1:]] = np.asarray(rows)
+            yield block
+
+    def _gather_rows_fn(self, sharding, dtype, size):
+        key = (sharding, np.dtype(dtype), size)
+        if key not in self._gather_rows_fns:
+            g = lambda x, start: lax.dynamic_slice_in_dim(x, start, size).astype(dtype)
+            self._gather_rows_fns[key] = jax.jit(
+                g, in_shardings=(sharding, None), out_shardings=self.uniform_sharding)
+        return self._gather_rows_fns[key]
+
+    def _row_chunks(self, shape, dtype, chunk_bytes):
+        row_bytes = math.prod(shape[1:]) * np.dtype(dtype).itemsize
+        rows_per_chunk = max(1, chunk_bytes // max(row_bytes, 1))
+        for start in range(0, shape[0], rows_per_chunk):
+            yield start, min(rows_per_chunk, shape[0] - start)
+
     def init_randn_array(self, shape, std, sharding, key):
+        if self._init_trace is not None:
+            return self._init_randn_traced(shape, std, sharding)
         cpu_array = self._init_randn_cpu(key, std, shape)
         array = self.scatter(sharding, jnp.float32)(cpu_array)
         return array
 
+    def init_model(self, make_model, key):
+        """Build `make_model(key)` with all of its parameters created in one 
+        jitted program, each device generating only its own shards. Parameters
+        made with init_randn_array keep their sharding, any other array 
+        (e.g. one computed from a parameter) is replicated.
+
+        Parameters of the same shape and sharding are drawn together, so the
+        program holds one random op per distinct parameter layout whatever the
+        depth of the model. The n-th parameter created draws from 
+        fold_in(key, n), and each of its shards from a further fold_in of the 
+        shard's index; the keys make_model passes to init_randn_array are 
+        unused, and the values differ from building the model eagerly."""
+        # Trace once to find every parameter and its sharding
+        layout = self._discover_model(make_model, key)
+
+        def f(key):
+            values = self._init_randn_groups(key, layout["calls"])
+            params, _, _, _ = self._build_model(make_model, key, values)
+            return params
+
+        params = jax.jit(f, out_shardings=layout["shardings"])(key)
+        return eqx.combine(params, layout["static"])
+
+    def eval_model(self, make_model, key):
+        """make_model(key) with nothing allocated: each parameter is a 
+        jax.ShapeDtypeStruct carrying the sharding init_model would give it. 
+        `key` may itself be a jax.ShapeDtypeStruct."""
+        layout = self._discover_model(make_model, key)
+        params = jtu.tree_map(
+            lambda x, sharding: jax.ShapeDtypeStruct(x.shape, x.dtype, sharding=sharding),
+            layout["params"], layout["shardings"])
+        return eqx.combine(params, layout["static"])
+
+    def _discover_model(self, make_model, key):
+        layout = {}
+
+        def discover(key):
+            params, layout["static"], layout["shardings"], layout["calls"] = self._build_model(
+                make_model, key, None)
+            return params
+
+        layout["params"] = jax.eval_shape(discover, key)
+        return layout
+
+    def _build_model(self, make_model, key, values):
+        self._init_trace = {"calls": [], "values": values, "shardings": {}}
+        try:
+            model = make_model(key)
+            params, static = eqx.partition(model, eqx.is_array)
+            shardings = jtu.tree_map(
+                lambda x: self._init_trace["shardings"].get(id(x), self.uniform_sharding), params)
+            calls = self._init_trace["calls"]
+        finally:
+            self._init_trace = None
+        return params, static, shardings, calls
+
+    def abstract_state(self, init, params):
+        """init(params) (e.g. an optimizer's init) as jax.ShapeDtypeStructs, for
+        `params` from eval_model. Subtrees with the structure of `params` are 
+        laid out like them, any other leaf is replicated."""
+        state = jax.eval_shape(init, params)
+        params = eqx.filter(params, lambda x: isinstance(x, jax.ShapeDtypeStruct))
+        params_def = jtu.tree_structure(params)
+
+        def layout(subtree):
+            if jtu.tree_structure(subtree) == params_def:
+                return jtu.tree_map(
+                    lambda x, p: jax.ShapeDtypeStruct(x.shape, x.dtype, sharding=p.sharding), 
+                    subtree, params)
+            return jtu.tree_map(
+                lambda x: jax.ShapeDtypeStruct(x.shape, x.dtype, sharding=self.uniform_sharding), 
+                subtree)
+        return jtu.tree_map(
+            layout, state, is_leaf=lambda x: jtu.tree_structure(x) == params_def)
+
+    def stack_stages(self, layers):
+        """Stack `layers` (modules of identical structure) into one module whose
+        arrays have leading [pp, len(layers) // pp] axes, stage i holding 
+        layers i * len(layers) // pp onwards on the devices of pp index i. 
+        Works both eagerly and under init_model."""
+        pp = self.axis_size("pp")
+        if len(layers) % pp:
+            raise ValueError(f"{len(layers)} layers don't split into {pp} pipeline stages")
+
+        def stack(*xs):
+            spec = tuple(self._param_sharding(xs[0]).spec)
+            x = jnp.stack(xs).reshape((pp, len(xs) // pp) + xs[0].shape)
+            sharding = self.sharding(shrd.PartitionSpec("pp", None, *spec))
+            if self._init_trace is not None:
+                self._init_trace["shardings"][id(x)] = sharding
+                return x
+            return jax.device_put(x, sharding)
+        return jtu.tree_map(stack, *layers)
+
+    def _param_sharding(self, x):
+        if self._init_trace is not None:
+            return self._init_trace["shardings"].get(id(x), self.uniform_sharding)
+        if isinstance(x.sharding, shrd.NamedSharding):
+            return x.sharding
+        return self.uniform_sharding
+
+    def pipeline(self, stage_fn, stages, x, n_microbatches):
+        """stage_fn(stage, h) applied to the batch `x` by each stage of 
+        `stages` (see stack_stages) in turn, with a GPipe schedule: `x` is 
+        split into n_microbatches along its leading axis, and at each of the 
+        n_microbatches + pp - 1 steps every stage runs on the microbatch the 
+        previous stage passed it. Differentiating this runs the backward 
+        passes in the reverse order. A fraction bubble_fraction(pp,
+        n_microbatches) of the stage steps compute on padding."""
+        pp = self.axis_size("pp")
+        if x.shape[0] % n_microbatches:
+            raise ValueError(f"Batch of {x.shape[0]} doesn't split into {n_microbatches} microbatches")
+        microbatches = x.reshape((n_microbatches, x.shape[0] // n_microbatches) + x.shape[1:])
+        # Microbatches are split over dp like the batch, and stacked over pp 
+        # as they move through the stages
+        microbatch_sharding = self.sharding(shrd.PartitionSpec(None, "dp"))
+        microbatches = lax.with_sharding_constraint(microbatches, microbatch_sharding)
+        stage_sharding = self.sharding(shrd.PartitionSpec("pp", "dp"))
+        # Every stage's slice of the vmap runs on the devices of its pp index
+        run_stages = jax.vmap(stage_fn, spmd_axis_name="pp")
+
+        def step(carry, t):
+            # h[i] is the input of stage i
+            h, outputs = carry
+            h = h.at[0].set(microbatches[jnp.minimum(t, n_microbatches - 1)])
+            h = lax.with_sharding_constraint(h, stage_sharding)
+            h = lax.with_sharding_constraint(run_stages(stages, h), stage_sharding)
+            # The last stage finishes microbatch t - (pp - 1)
+            done = t - (pp - 1)
+            index = jnp.maximum(done, 0)
+            outputs = outputs.at[index].set(jnp.where(done >= 0, h[-1], outputs[index]))
+            outputs = lax.with_sharding_constraint(outputs, microbatch_sharding)
+            # Stage i's output moves to stage i + 1, a collective permute over pp
+            h = jnp.roll(h, 1, axis=0)
+            return (h, outputs), None
+
+        h = jnp.zeros((pp,) + microbatches.shape[1:], x.dtype)
+        outputs = jnp.zeros_like(microbatches)
+        (_, outputs), _ = lax.scan(step, (h, outputs), jnp.arange(n_microbatches + pp - 1))
+        return outputs.reshape(x.shape)
+
+    def _init_randn_traced(self, shape, std, sharding):
+        trace = self._init_trace
+        n = len(trace["calls"])
+        trace["calls"].append((tuple(shape), sharding))
+        if trace["values"] is None:
+            array = jnp.zeros(shape)
+        else:
+            array = trace["values"][n] * std
+        trace["shardings"][id(array)] = sharding
+        return array
+
+    def _init_randn_groups(self, key, calls):
+        """Unit normal values for each (shape, sharding) in `calls`, generated 
+        one group of identical layouts at a time."""
+        groups = {}
+        for n, call in enumerate(calls):
+            groups.setdefault(call, []).append(n)
+
+        values = [None] * len(calls)
+        for (shape, sharding), indices in groups.items():
+            keys = jax.vmap(lambda n: jax.random.fold_in(key, n))(jnp.array(indices))
+            stacked = self._init_randn_sharded(keys, shape, sharding)
+            for i, n in enumerate(indices):
+                values[n] = stacked[i]
+        return values
+
+    def _init_randn_sharded(self, keys, shape, sharding):
+        spec = sharding.spec
+        # Shards are numbered by the mesh axes they're split over, so replicas
+        # of a shard draw from the same key
+        axes = [axis for entry in spec if entry is not None 
+                for axis in (entry if isinstance(entry, tuple) else (entry,))]
+        shard_shape = sharding.shard_shape(shape)
+
+        def g(keys):
+            index = 0
+            for axis in axes:
+                index = index * self.mesh.shape[axis] + lax.axis_index(axis)
+            normal = lambda key: jax.random.normal(jax.random.fold_in(key, index), shard_shape)
+            return jax.vmap(normal)(keys)
+
+        f = shard_map.shard_map(
+            g, mesh=self.mesh, in_specs=shrd.PartitionSpec(), 
+            out_specs=shrd.PartitionSpec(None, *spec), check_rep=False)
+        return f(keys)
+
     def init_pytree_cpu(self, closure):
         f = jax.jit(closure, device=self.cpu_device)
         return f()
@@ -76,7 +847,8 @@ class DistManager:
 
     def save_array(self, array, sharding, file_name):
         if array is not None:
-            local_array = self.gather(sharding, jnp.float32)(array)
+            with self.timed("transfers", "save_array", array.nbytes):
+                local_array = self.gather(sharding, array.dtype)(array)
         else:
             local_array = None
         
@@ -89,20 +861,24 @@ class DistManager:
                 self.fs.makedirs(dir_name, recreate=True)
 
             with self.fs.openbin(file_name, 'w') as blob:
-                blob.write(pkl.dumps(local_array))
+                if self.compression is None:
+                    blob.write(pkl.dumps(local_array))
+                else:
+                    blob.write(pkl.dumps(self._compress_record(local_array)))
             print(f"Uploaded {file_name} to {type(self.fs).__name__} at {file_name}")
-        mhu.sync_global_devices("save_sync")
+        self.barrier("save_sync")
 
     def load_array(self, sharding, file_name):
         with self.fs.openbin(file_name, 'r') as blob:
             local_array_pkl = blob.read()
-        local_array = pkl.loads(local_array_pkl)
+        local_array = self._decompress_record(pkl.loads(local_array_pkl))
         
         if local_array is not None:
-            array = self.scatter(sharding, jnp.float32)(local_array)
+            with self.timed("transfers", "load_array", local_array.nbytes):
+                array = jax.block_until_ready(self.scatter(sharding, local_array.dtype)(local_array))
         else:
             array = None 
-        mhu.sync_global_devices("load_sync")
+        self.barrier("load_sync")
         return array
     
     def save_pytree(self, pytree, sharding_pytree, file_name):
@@ -110,49 +886,360 @@ class DistManager:
         flat_pytree, _ = jtu.tree_flatten(pytree)
         flat_sharding_pytree, _ = jtu.tree_flatten(sharding_pytree)
 
-        # Gather each leaf to the host
-        gathered_leaves = [
-            self.gather(sharding, jnp.float32)(leaf) if leaf is not None else None
-            for leaf, sharding in zip(flat_pytree, flat_sharding_pytree)
-        ]
+        header = {
+            "format": "chunked",
+            "compression": self.compression,
+            "leaves": [None if leaf is None else (jnp.shape(leaf), str(jnp.result_type(leaf))) 
+                       for leaf in flat_pytree]
+        }
 
         # Only have the first process write to the filesystem
-        if self.pid == 0:
-            # Ensure directory exists before writing
-            dir_name = os.path.dirname(file_name)
-            if dir_name and not self.fs.exists(dir_name):
-                self.fs.makedirs(dir_name, recreate=True)
+        with contextlib.ExitStack() as stack:
+            if self.pid == 0:
+                # Ensure directory exists before writing
+                dir_name = os.path.dirname(file_name)
+                if dir_name and not self.fs.exists(dir_name):
+                    self.fs.makedirs(dir_name, recreate=True)
+                blob = stack.enter_context(self.fs.openbin(file_name, 'w'))
+                pkl.dump(header, blob)
 
-            with self.fs.openbin(file_name, 'w') as blob:
-                blob.write(pkl.dumps(gathered_leaves))
+            # Small leaves are fetched a bucket at a time, large ones are
+            # streamed in bounded-size chunks
+            nbytes = [None if leaf is None else jnp.size(leaf) * jnp.result_type(leaf).itemsize 
+                      for leaf in flat_pytree]
+            for bucket, large in self._buckets(nbytes, self.chunk_bytes):
+                if large:
+                    i, = bucket
+                    for chunk in self.gather_chunks(
+                            flat_pytree[i], flat_sharding_pytree[i], jnp.result_type(flat_pytree[i])):
+                        if self.pid == 0:
+                            self._dump_chunk(chunk, blob)
+                    continue
+                with self.timed("transfers", "save_pytree", sum(nbytes[i] for i in bucket)):
+                    arrays = self.gather_bucket(
+                        [flat_pytree[i] for i in bucket],
+                        [flat_sharding_pytree[i] for i in bucket])
+                if self.pid == 0:
+                    for array in arrays:
+                        # A leaf is stored as its row chunks, an empty one has none
+                        if array.ndim == 0 or len(array):
+                            self._dump_chunk(array, blob)
+
+        if self.pid == 0:
             print(f"Uploaded {file_name} to {type(self.fs).__name__} at {file_name}")
 
-        mhu.sync_global_devices("save_pytree_sync")
-
-    def load_pytree(self, sharding_pytree, file_name):
-        # Load the gathered leaves
-        with self.fs.openbin(file_name, 'r') as blob:
-            gathered_leaves = pkl.loads(blob.read())
+        self.barrier("save_pytree_sync")
 
+    def load_pytree(self, sharding_pytree, file_name, path_filter=None):
         # Flatten the sharding pytree
         flat_sharding_pytree, tree_def = jtu.tree_flatten(sharding_pytree)
+        # Leaves that fail the path filter are still read past, but not scattered
+        wanted = [match_path(path_filter, leaf_path(path)) 
+                  for path, _ in jtu.tree_flatten_with_path(sharding_pytree)[0]]
 
-        # Scatter each leaf back to the distributed array
-        scattered_leaves = [
-            self.scatter(sharding, jnp.float32)(leaf) if leaf is not None else None
-            for leaf, sharding in zip(gathered_leaves, flat_sharding_pytree)
-        ]
+        with self.fs.openbin(file_name, 'r') as blob:
+            header = pkl.load(blob)
+
+            if isinstance(header, list):
+                # Checkpoint written as a single pickled list of leaves
+                scattered_leaves = [
+                    self.scatter(sharding, jnp.float32)(leaf) if leaf is not None and keep else None
+                    for leaf, sharding, keep in zip(header, flat_sharding_pytree, wanted)
+                ]
+            else:
+                # Small leaves are read and scattered a bucket at a time, large
+                # ones chunk by chunk as they are read
+                metas = header["leaves"]
+                compression = header.get("compression")
+                nbytes = [None if meta is None else math.prod(meta[0]) * np.dtype(meta[1]).itemsize 
+                          for meta in metas]
+                scattered_leaves = [None] * len(metas)
+                for bucket, large in self._buckets(nbytes, self.chunk_bytes):
+                    if large:
+                        i, = bucket
+                        shape, dtype = metas[i]
+                        chunks = self._read_chunks(blob, shape, compression)
+                        if wanted[i]:
+                            scattered_leaves[i] = self.scatter_chunks(
+                                shape, flat_sharding_pytree[i], dtype, chunks)
+                        else:
+                            collections.deque(chunks, maxlen=0)
+                        continue
+                    host_leaves = [self._read_leaf(blob, *metas[i], compression) for i in bucket]
+                    bucket = [(i, leaf) for i, leaf in zip(bucket, host_leaves) if wanted[i]]
+                    if not bucket:
+                        continue
+                    with self.timed("transfers", "load_pytree", sum(nbytes[i] for i, _ in bucket)):
+                        arrays = jax.block_until_ready(self.scatter_bucket(
+                            [leaf for _, leaf in bucket], 
+                            [flat_sharding_pytree[i] for i, _ in bucket]))
+                    for (i, _), array in zip(bucket, arrays):
+                        scattered_leaves[i] = array
 
         # Reconstruct the distributed pytree using the tree structure from sharding_pytree
         distributed_pytree = jtu.tree_unflatten(tree_def, scattered_leaves)
 
-        mhu.sync_global_devices("load_pytree_sync")
+        self.barrier("load_pytree_sync")
+        return distributed_pytree
+
+    def _read_leaf(self, blob, shape, dtype, compression=None):
+        chunks = list(self._read_chunks(blob, shape, compression))
+        if len(shape) == 0 or len(chunks) == 1:
+            return chunks[0]
+        return np.concatenate(chunks) if chunks else np.zeros(shape, dtype=dtype)
+
+    def _read_chunks(self, blob, shape, compression=None):
+        if len(shape) == 0:
+            yield self._load_chunk(blob, compression)
+            return
+        rows = 0
+        while rows < shape[0]:
+            chunk = self._load_chunk(blob, compression)
+            rows += len(chunk)
+            yield chunk
+
+    def _dump_chunk(self, chunk, blob):
+        if self.compression is None:
+            pkl.dump(chunk, blob)
+        else:
+            pkl.dump(compressor(self.compression)[0](pkl.dumps(chunk, protocol=5)), blob)
+
+    def _load_chunk(self, blob, compression):
+        if compression is None:
+            return pkl.load(blob)
+        return pkl.loads(compressor(compression)[1](pkl.load(blob)))
+
+    def _compress_record(self, array):
+        if array is None:
+            return None
+        data = compressor(self.compression)[0](pkl.dumps(array, protocol=5))
+        return {"compression": self.compression, "data": data}
+
+    def _decompress_record(self, record):
+        if not isinstance(record, dict):
+            return record
+        return pkl.loads(compressor(record["compression"])[1](record["data"]))
+
+    def save_pytree_sharded(self, pytree, sharding_pytree, dir_name):
+        """Write a chunked checkpoint directory. Every process writes the shards
+        it holds the first replica of, so no array is ever gathered to one host.
+
+        dir_name/index.json                  mesh and the metadata of every array
+        dir_name/{leaf path}/meta.json       shape, dtype, chunk shape and partition spec
+        dir_name/{leaf path}/{i}.{j}...npy   the chunk at position (i, j, ...) of the chunk grid
+        dir_name/COMMIT                      written last, once every process is done
+
+        Leaf paths come from leaf_path, e.g. "model/encoder/layers/0/weight".
+        Each array is chunked along its shards. A committed checkpoint is never
+        overwritten, see prepare_sharded.
+        """
+        if not self.prepare_sharded(dir_name):
+            return
+        snapshot = self.snapshot_pytree_sharded(pytree, sharding_pytree)
+        self.write_shards(snapshot, dir_name)
+        self.barrier("save_pytree_sharded_sync")
+        if self.pid == 0:
+            self.commit_sharded(snapshot, dir_name)
+        self.barrier("commit_pytree_sharded_sync")
+
+    def prepare_sharded(self, dir_name):
+        """Make dir_name ready to be written by a new checkpoint. Returns False,
+        leaving it as it is, if it already holds a committed one: re-saving
+        e.g. the checkpoint just resumed from would otherwise replace it 
+        chunk by chunk, and a crash part way would lose it. Anything else in
+        dir_name was left by an unfinished attempt (chunks, done markers) and
+        is removed, so the new checkpoint only becomes visible at its COMMIT."""
+        if self.is_committed(dir_name):
+            print(f"{dir_name} is already a committed checkpoint, not saving over it")
+            return False
+        if self.pid == 0 and self.fs.exists(dir_name):
+            self.fs.removetree(dir_name)
+        self.barrier("prepare_sharded_sync")
+        return True
+
+    def snapshot_pytree_sharded(self, pytree, sharding_pytree):
+        """Copy the shards this process writes to host memory, after which the 
+        pytree can be modified (or donated) without affecting the checkpoint."""
+        leaves = {leaf_path(path): leaf for path, leaf in jtu.tree_flatten_with_path(pytree)[0]}
+        shardings = jtu.tree_flatten_with_path(sharding_pytree)[0]
+
+        arrays = {}
+        shards = []
+        for path, sharding in shardings:
+            name = leaf_path(path)
+            leaf = leaves[name]
+            arrays[name] = {
+                "shape": list(leaf.shape),
+                "dtype": str(leaf.dtype),
+                "chunks": list(sharding.shard_shape(leaf.shape)),
+                "spec": spec_to_json(getattr(sharding, "spec", None)),
+                "compression": self.compression
+            }
+            for shard in leaf.addressable_shards:
+                if shard.replica_id == 0:
+                    shards.append((name, shard_bounds(shard.index, leaf.shape), shard.data))
+
+        # Start every device to host copy before waiting on any of them
+        with self.timed("transfers", "snapshot_pytree_sharded", sum(data.nbytes for _, _, data in shards)):
+            for _, _, data in shards:
+                data.copy_to_host_async()
+            shards = [(name, bounds, np.asarray(data)) for name, bounds, data in shards]
+        return {"arrays": arrays, "shards": shards}
+
+    def write_shards(self, snapshot, dir_name):
+        """Write this process's chunks of a snapshot."""
+        for name in {name for name, _, _ in snapshot["shards"]}:
+            self.fs.makedirs(f"{dir_name}/{name}", recreate=True)
+
+        for name, bounds, data in snapshot["shards"]:
+            meta = snapshot["arrays"][name]
+            file_name = f"{dir_name}/{name}/{chunk_file(chunk_key(bounds, meta['chunks']), meta['compression'])}"
+            with self.fs.openbin(file_name, 'w') as blob:
+                if meta["compression"] is None:
+                    np.save(blob, data)
+                else:
+                    with io.BytesIO() as buffer:
+                        np.save(buffer, data)
+                        blob.write(compressor(meta["compression"])[0](buffer.getbuffer()))
+
+    def commit_sharded(self, snapshot, dir_name):
+        """Write the metadata and the commit marker. Call once every process has
+        finished write_shards."""
+        for name, meta in snapshot["arrays"].items():
+            self.fs.makedirs(f"{dir_name}/{name}", recreate=True)
+            with self.fs.open(f"{dir_name}/{name}/meta.json", 'w') as f:
+                json.dump(meta, f)
+
+        index = {
+            "format": "chunked",
+            "mesh_shape": list(self.mesh.devices.shape),
+            "axis_names": list(self.mesh.axis_names),
+            "arrays": snapshot["arrays"]
+        }
+        with self.fs.open(f"{dir_name}/{SHARDED_INDEX}", 'w') as f:
+            json.dump(index, f)
+        self.fs.writetext(f"{dir_name}/{COMMIT_MARKER}", "")
+        print(f"Uploaded {dir_name} to {type(self.fs).__name__} at {dir_name}")
+
+    def load_pytree_sharded(self, sharding_pytree, dir_name, path_filter=None, prefix=""):
+        """Load a checkpoint written by save_pytree_sharded, each process reading 
+        only the chunks its devices hold. The target shardings may come from a
+        different mesh shape or partition specs than the checkpoint was saved
+        with, in which case each shard reads just the rows it needs from the
+        chunks it overlaps.
+
+        Leaves whose path doesn't match `path_filter` (see match_path) are not 
+        read and come back as None. `prefix` restores a subtree: pass the
+        sharding of e.g. the encoder alone with prefix "model/encoder".
+        """
+        flat_sharding_pytree, tree_def = jtu.tree_flatten_with_path(sharding_pytree)
+
+        leaves = []
+        for path, sharding in flat_sharding_pytree:
+            name = "/".join(p for p in (prefix, leaf_path(path)) if p)
+            if not match_path(path_filter, name):
+                leaves.append(None)
+                continue
+            leaves.append(self.load_array_chunked(sharding, f"{dir_name}/{name}"))
+
+        distributed_pytree = jtu.tree_unflatten(tree_def, leaves)
+
+        self.barrier("load_pytree_sharded_sync")
         return distributed_pytree
 
+    def load_array_chunked(self, sharding, array_dir):
+        """Assemble one array of a chunked checkpoint from the chunks under 
+        `array_dir`. The target sharding needn't match the one it was saved 
+        with, each target shard is cut from the chunks it overlaps."""
+        with self.fs.open(f"{array_dir}/meta.json", 'r') as f:
+            meta = json.load(f)
+        shape = tuple(meta["shape"])
+
+        # Replicated shards are read once and copied to each device
+        shard_data = {}
+        placements = []
+        for device, device_index in sharding.addressable_devices_indices_map(shape).items():
+            bounds = shard_bounds(device_index, shape)
+            key = tuple(map(tuple, bounds))
+            if key not in shard_data:
+                shard_data[key] = self._read_region(array_dir, meta, bounds)
+            placements.append((shard_data[key], device))
+
+        with self.timed("transfers", "load_pytree_sharded", sum(data.nbytes for data, _ in placements)):
+            device_arrays = jax.block_until_ready(
+                [jax.device_put(data, device) for data, device in placements])
+        return jax.make_array_from_single_device_arrays(shape, sharding, device_arrays)
+
+    def _read_region(self, array_dir, meta, bounds):
+        """The part of a chunked array within `bounds`, reading only the rows of
+        each chunk it overlaps."""
+        shape, dtype, chunks = meta["shape"], np.dtype(meta["dtype"]), meta["chunks"]
+        compression = meta.get("compression")
+        if all(start % size == 0 and stop - start == size 
+               for (start, stop), size in zip(bounds, chunks)):
+            key = chunk_key(bounds, chunks)
+            return self._read_chunk(f"{array_dir}/{chunk_file(key, compression)}", dtype, compression)
+
+        region = np.empty([stop - start for start, stop in bounds], dtype)
+        grid = [range(start // size, -(-stop // size)) for (start, stop), size in zip(bounds, chunks)]
+        for chunk_index in itertools.product(*grid):
+            chunk_starts = [i * size for i, size in zip(chunk_index, chunks)]
+            lo = [max(start, c) for (start, _), c in zip(bounds, chunk_starts)]
+            hi = [min(stop, c + size, n) for (_, stop), c, size, n in zip(bounds, chunk_starts, chunks, shape)]
+            within_chunk = tuple(slice(l - c, h - c) for l, h, c in zip(lo, hi, chunk_starts))
+            within_region = tuple(slice(l - start, h - start) for l, h, (start, _) in zip(lo, hi, bounds))
+
+            key = ".".join(map(str, chunk_index))
+            region[within_region] = self._read_chunk(
+                f"{array_dir}/{chunk_file(key, compression)}", dtype, compression, within_chunk)
+        return region
+
+    def _read_chunk(self, file_name, dtype, compression=None, index=None):
+        """A chunk file, or the part of it selected by `index` (a tuple of slices)."""
+        # Memory map uncompressed chunks on local disk rather than reading them in
+        if compression is not None:
+            with self.fs.openbin(file_name, 'r') as blob:
+                data = np.load(io.BytesIO(compressor(compression)[1](blob.read())))
+        elif self.fs.hassyspath(file_name):
+            data = np.load(self.fs.getsyspath(file_name), mmap_mode='r')
+        elif index is not None:
+            data, index = self._read_rows(file_name, index)
+        else:
+            with self.fs.openbin(file_name, 'r') as blob:
+                data = np.load(io.BytesIO(blob.read()))
+        if index is not None:
+            data = data[index]
+        # Extension dtypes such as bfloat16 are stored as raw bytes
+        return data.view(dtype) if data.dtype != dtype else data
+
+    def _read_rows(self, file_name, index):
+        """Read only the leading-axis rows of an .npy file that `index` covers.
+        Returns them along with `index` made relative to those rows."""
+        with self.fs.openbin(file_name, 'r') as blob:
+            version = np.lib.format.read_magic(blob)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(blob)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(blob)
+            if fortran_order or len(shape) == 0:
+                blob.seek(0)
+                return np.load(io.BytesIO(blob.read())), index
+
+            start, stop, _ = index[0].indices(shape[0])
+            row_bytes = math.prod(shape[1:]) * dtype.itemsize
+            blob.seek(blob.tell() + start * row_bytes)
+            data = np.frombuffer(blob.read((stop - start) * row_bytes), dtype)
+        return data.reshape((stop - start,) + tuple(shape[1:])), (slice(None),) + tuple(index[1:])
+
+    def is_sharded_checkpoint(self, dir_name):
+        return self.fs.exists(f"{dir_name}/{SHARDED_INDEX}")
+
+    def is_committed(self, dir_name):
+        return self.fs.exists(f"{dir_name}/{COMMIT_MARKER}")
 
     def get_pytree_sharding(self, pytree):
         def get_leaf_sharding(leaf):
-            if isinstance(leaf, jax.Array):
+            if isinstance(leaf, (jax.Array, jax.ShapeDtypeStruct)):
                 return leaf.sharding
             else:
                 return None
@@ -167,4 +1254,143 @@ class DistManager:
                 return None
 
         return jax.tree_util.tree_map(get_leaf_partition_spec, pytree)
-    
\ No newline at end of file
+
+
+class AsyncCheckpointer:
+    """Writes sharded checkpoints from a background thread so training carries 
+    on while they upload. `save` only blocks for the device to host snapshot,
+    or while `max_in_flight` earlier checkpoints are still being written."""
+
+    def __init__(self, dist_manager, max_in_flight=1, poll_interval=0.5, timeout=3600):
+        self.dist_manager = dist_manager
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+        # A single writer, so checkpoints are committed in the order they're saved
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.in_flight = collections.deque()
+
+    def save(self, pytree, sharding_pytree, dir_name):
+        # Bounds the number of snapshots held in host memory
+        while len(self.in_flight) >= self.max_in_flight:
+            self.in_flight.popleft().result()
+
+        # Shards and done markers left in dir_name by an earlier attempt (e.g.
+        # one that crashed) mustn't count towards committing this one, and a
+        # committed checkpoint is kept rather than written over
+        dm = self.dist_manager
+        if not dm.prepare_sharded(dir_name):
+            return
+
+        snapshot = dm.snapshot_pytree_sharded(pytree, sharding_pytree)
+        self.in_flight.append(self.executor.submit(self._write, snapshot, dir_name))
+
+    def _write(self, snapshot, dir_name):
+        dm = self.dist_manager
+        dm.write_shards(snapshot, dir_name)
+        dm.fs.writetext(f"{dir_name}/done_{dm.pid}", "")
+
+        if dm.pid != 0:
+            return
+        # Collectives can't be issued from this thread, so process 0 polls 
+        # for every process's marker before committing
+        deadline = time.monotonic() + self.timeout
+        while not all(dm.fs.exists(f"{dir_name}/done_{i}") for i in range(dm.nodes)):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for all shards of {dir_name}")
+            time.sleep(self.poll_interval)
+        dm.commit_sharded(snapshot, dir_name)
+
+    def wait(self):
+        """Barrier: returns once every checkpoint saved so far is committed, and
+        re-raises any error from writing them. The barrier is reached even
+        then, so the other processes don't wait on this one forever."""
+        try:
+            while self.in_flight:
+                self.in_flight.popleft().result()
+        finally:
+            self.dist_manager.barrier("async_checkpoint_wait")
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+class OffloadedOptimizer:
+    """Keeps the state of an optax optimizer in host memory, and streams it to
+    the accelerators one group of parameters at a time during the update. 
+    The next group's state is prefetched while the current group is updated,
+    and updated state is copied back to host asynchronously, so at most two
+    groups of state are on device at once.
+
+    State lives in pinned host memory next to each device where the backend
+    has it, otherwise on the process's cpu_device. Each group has its own 
+    optimizer state, so this suits optimizers that update every parameter 
+    independently, like Adam. Unlike an optax optimizer, `update` applies the
+    updates and runs eagerly, outside of jit."""
+
+    def __init__(self, dist_manager, optimizer, group_bytes=DEFAULT_CHUNK_BYTES):
+        self.dist_manager = dist_manager
+        self.optimizer = optimizer
+        self.group_bytes = group_bytes
+
+        self.groups = None
+        self.device_shardings = None
+        self._update_group = jax.jit(self._update_group_fn)
+
+    def init(self, params):
+        """Per-group optimizer states of `params`, in host memory. Call on 
+        concrete parameters, outside of jit."""
+        leaves = jtu.tree_leaves(params)
+        nbytes = [leaf.nbytes for leaf in leaves]
+        self.groups = [group for group, _ in self.dist_manager._buckets(nbytes, self.group_bytes)]
+
+        states = []
+        self.device_shardings = []
+        for group in self.groups:
+            state = self.optimizer.init([leaves[i] for i in group])
+            # Off-mesh leaves, like the step count, are replicated when on device
+            self.device_shardings.append(jtu.tree_map(
+                lambda x: x.sharding if self.dist_manager._on_mesh(x.sharding) 
+                else self.dist_manager.uniform_sharding, state))
+            states.append(self.to_host(state))
+        return states
+
+    def update(self, grads, states, params):
+        """Apply one optimizer step. Returns the updated params and states."""
+        grad_leaves = jtu.tree_leaves(grads)
+        param_leaves, tree_def = jtu.tree_flatten(params)
+        new_params = list(param_leaves)
+        new_states = []
+
+        incoming = self.to_device(states[0], self.device_shardings[0])
+        for g, group in enumerate(self.groups):
+            state = incoming
+            # Dispatch is asynchronous, the next group streams in while this one is updated
+            if g + 1 < len(self.groups):
+                incoming = self.to_device(states[g + 1], self.device_shardings[g + 1])
+            group_params, state = self._update_group(
+                state, [grad_leaves[i] for i in group], [param_leaves[i] for i in group])
+            for i, param in zip(group, group_params):
+                new_params[i] = param
+            new_states.append(self.to_host(state))
+        return jtu.tree_unflatten(tree_def, new_params), new_states
+
+    def _update_group_fn(self, state, grads, params):
+        updates, state = self.optimizer.update(grads, state, params)
+        return optax.apply_updates(params, updates), state
+
+    def host_sharding(self, sharding):
+        device = next(iter(sharding.device_set))
+        memory_kinds = {memory.kind for memory in device.addressable_memories()}
+        if "pinned_host" in memory_kinds and isinstance(sharding, shrd.NamedSharding):
+            return sharding.with_memory_kind("pinned_host")
+        return shrd.SingleDeviceSharding(self.dist_manager.cpu_device)
+
+    def to_host(self, state):
+        return jtu.tree_map(lambda x: jax.device_put(x, self.host_sharding(x.sharding)), state)
+
+    def to_device(self, state, shardings):
+        return jtu.tree_map(lambda x, sharding: jax.device_put(x, sharding), state, shardings)
+
@@ -0,0 +1,142 @@
+"""Data-parallel gradient reduction in reduced precision.
+
+Each dp replica's gradient is computed separately (the batch is split along
+a leading dp axis and the loss vmapped over it), compressed, and only then
+summed across dp, so the collectives carry bf16 or int8 rather than float32.
+The rounding error of each replica is kept and added to its next gradient
+(error feedback), so it is delayed rather than lost.
+"""
+import jax
+import jax.numpy as jnp
+import jax.lax as lax
+import jax.sharding as shrd
+import jax.tree_util as jtu
+import numpy as np
+
+MODES = ("bf16", "int8")
+
+class GradCompressor:
+    """Computes gradients with a compressed reduction across dp.
+
+    The replicas' gradients are encoded (mode "bf16": rounded to bfloat16,
+    mode "int8": quantized with one scale per replica and leaf), exchanged
+    with an all-to-all so every device holds one slice of every replica,
+    decoded and summed in float32, and the sums all-gathered as bfloat16. The
+    slice is taken along the axis zero1_sharding would partition.
+
+    Leaves smaller than `min_bytes`, or with no axis that splits evenly over
+    dp, are reduced in float32 as usual."""
+
+    def __init__(self, dist_manager, mode="bf16", min_bytes=2**16):
+        if mode not in MODES:
+            raise ValueError(f"Unsupported gradient compression {mode}, expected one of {MODES}")
+        self.dist_manager = dist_manager
+        self.mode = mode
+        self.min_bytes = min_bytes
+
+    @property
+    def dp(self):
+        return self.dist_manager.mesh.shape["dp"]
+
+    def init(self, params):
+        """Zero error feedback state: a [dp, *shape] float32 residual per
+        compressed leaf, each device holding its own replica's, None for the
+        rest. Also records the parameter layout value_and_grad reduces to.
+        Abstract params (see DistManager.eval_model) give abstract state."""
+        self.specs = jtu.tree_map(self._spec, params)
+
+        def init_error(x):
+            if not self._compressed(x):
+                return None
+            shape = (self.dp,) + x.shape
+            sharding = self._stacked_sharding(self._spec(x))
+            if isinstance(x, jax.ShapeDtypeStruct):
+                return jax.ShapeDtypeStruct(shape, jnp.float32, sharding=sharding)
+            return jax.device_put(jnp.zeros(shape, jnp.float32), sharding)
+        return jtu.tree_map(init_error, params)
+
+    def _compressed(self, x):
+        if x.size * x.dtype.itemsize < self.min_bytes:
+            return False
+        sharding = self.dist_manager.sharding(shrd.PartitionSpec(*self._spec(x)))
+        return self.dist_manager.zero1_sharding(sharding, x.shape) != sharding
+
+    def _spec(self, x):
+        spec = getattr(x.sharding, "spec", shrd.PartitionSpec())
+        return tuple(spec) + (None,) * (x.ndim - len(spec))
+
+    def _stacked_sharding(self, spec):
+        return self.dist_manager.sharding(shrd.PartitionSpec("dp", *spec))
+
+    def value_and_grad(self, loss_fn, model, data, key, error):
+        """loss_fn(model, data, key) and its gradient, averaged over dp
+        replicas. `data` leaves must have a leading batch axis divisible by
+        dp, and `loss_fn` should be a mean over its batch. Returns the loss,
+        gradients and the new error feedback state. Call under jit, with the
+        model laid out as it was in init."""
+        dp = self.dp
+
+        def split(x):
+            x = x.reshape((dp, x.shape[0] // dp) + x.shape[1:])
+            return lax.with_sharding_constraint(x, self._stacked_sharding((None,) * (x.ndim - 1)))
+        replica_data = jtu.tree_map(split, data)
+        replica_keys = jax.random.split(key, dp)
+
+        grad_fn = jax.value_and_grad(loss_fn)
+        losses, grads = jax.vmap(grad_fn, in_axes=(None, 0, 0))(model, replica_data, replica_keys)
+        grads = jtu.tree_map(
+            lambda g, spec: lax.with_sharding_constraint(g, self._stacked_sharding(spec)),
+            grads, self.specs)
+
+        reduced, new_error = [], []
+        flat_grads, tree_def = jtu.tree_flatten(grads)
+        flat_specs = tree_def.flatten_up_to(self.specs)
+        flat_error = tree_def.flatten_up_to(error)
+        for g, spec, e in zip(flat_grads, flat_specs, flat_error):
+            if e is None:
+                reduced.append(jnp.sum(g, axis=0) / dp)
+                new_error.append(None)
+                continue
+            g, e = self._reduce(g + e, spec)
+            reduced.append(g / dp)
+            new_error.append(e)
+        return (jnp.mean(losses), jtu.tree_unflatten(tree_def, reduced),
+                jtu.tree_unflatten(tree_def, new_error))
+
+    def _reduce(self, g, spec):
+        """Sum of the compressed replicas of `g` ([dp, *shape]), and each
+        replica's encoding error. Encoded values cross devices bitcast to
+        integers, so XLA can't widen them back to float32 (the CPU backend
+        does that to bfloat16 collectives)."""
+        param_sharding = self.dist_manager.sharding(shrd.PartitionSpec(*spec))
+        split_sharding = self.dist_manager.zero1_sharding(param_sharding, g.shape[1:])
+        split_spec = tuple(split_sharding.spec) + (None,) * (g.ndim - 1 - len(split_sharding.spec))
+
+        if self.mode == "bf16":
+            payload = to_bits(g)
+            error = g - lax.reduce_precision(g, exponent_bits=8, mantissa_bits=7)
+            decode = from_bits
+        else:
+            axes = tuple(range(1, g.ndim))
+            scale = jnp.max(jnp.abs(g), axis=axes, keepdims=True) / 127
+            scale = jnp.where(scale == 0, 1, scale)
+            q = jnp.clip(jnp.round(g / scale), -127, 127).astype(jnp.int8)
+            error = g - q.astype(jnp.float32) * scale
+            payload = lax.bitcast_convert_type(q, jnp.uint8)
+            scale = lax.with_sharding_constraint(scale, self.dist_manager.uniform_sharding)
+            decode = lambda p: lax.bitcast_convert_type(p, jnp.int8).astype(jnp.float32) * scale
+
+        # All-to-all: every device receives its slice of every replica
+        payload = lax.with_sharding_constraint(
+            payload, self.dist_manager.sharding(shrd.PartitionSpec(None, *split_spec)))
+        total = jnp.sum(decode(payload), axis=0)
+        # All-gather of the sums back to the parameter's layout
+        total = lax.with_sharding_constraint(to_bits(total), param_sharding)
+        return from_bits(total), error
+
+def to_bits(x):
+    """float32 -> bfloat16, as uint16."""
+    return lax.bitcast_convert_type(x.astype(jnp.bfloat16), jnp.uint16)
+
+def from_bits(x):
+    return lax.bitcast_convert_type(x, jnp.bfloat16).astype(jnp.float32)
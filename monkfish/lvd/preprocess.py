@@ -0,0 +1,172 @@
+import io
+import os
+import json
+import socket
+import functools
+import collections
+import multiprocessing
+
+import numpy as np
+
+import PIL.Image as Image
+import cv2
+
+import monkfish.lvd.shrd_data_loader as sdl
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+VIDEO_EXTENSIONS = ('.mp4',)
+MANIFEST_DIR = 'manifest'
+
+# Stands in for a DistManager when all ShardedDataUploader needs is the host layout
+HostInfo = collections.namedtuple('HostInfo', ['pid', 'nodes'])
+
+def resize_and_crop(image, resolution):
+    """Scale a [height x width x 3] image to cover `resolution` (width, height)
+    and center crop the overflow."""
+    width, height = resolution
+    in_height, in_width = image.shape[:2]
+
+    scale = max(width / in_width, height / in_height)
+    new_width = max(width, round(in_width * scale))
+    new_height = max(height, round(in_height * scale))
+    resized = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
+
+    top = (new_height - height) // 2
+    left = (new_width - width) // 2
+    return resized[top:top + height, left:left + width]
+
+def to_model_layout(array):
+    """[... x height x width x 3] -> [... x 3 x width x height], the layout
+    ImageShardInterface feeds to the autoencoder."""
+    return np.ascontiguousarray(np.swapaxes(np.moveaxis(array, -1, -3), -1, -2))
+
+def input_files(in_fs, kind):
+    extensions = IMAGE_EXTENSIONS if kind == "image" else VIDEO_EXTENSIONS
+    return sorted([f for f in in_fs.listdir('/') if f.lower().endswith(extensions)])
+
+def shard_name(file_name):
+    return f"{file_name}.npz"
+
+def load_manifest(out_fs):
+    """Names of every input already converted, across all manifest files."""
+    completed = set()
+    if not out_fs.exists(MANIFEST_DIR):
+        return completed
+
+    for manifest_name in out_fs.listdir(MANIFEST_DIR):
+        with out_fs.open(f"{MANIFEST_DIR}/{manifest_name}", 'r') as manifest_file:
+            for line in manifest_file:
+                if line.strip():
+                    completed.add(json.loads(line)["input"])
+    return completed
+
+def append_manifest(out_fs, manifest_name, entry):
+    out_fs.makedirs(MANIFEST_DIR, recreate=True)
+    with out_fs.open(f"{MANIFEST_DIR}/{manifest_name}", 'a') as manifest_file:
+        manifest_file.write(json.dumps(entry) + "\n")
+
+def pending_inputs(in_fs, out_fs, kind):
+    completed = load_manifest(out_fs)
+    return [f for f in input_files(in_fs, kind) if f not in completed]
+
+def preprocess_file(in_fs, out_fs, file_name, kind, resolution):
+    """Convert one raw input into a uint8 tensor shard in model layout.
+    Returns the manifest entry for it."""
+    if kind == "image":
+        with in_fs.open(file_name, 'rb') as image_file:
+            image = Image.open(io.BytesIO(image_file.read())).convert('RGB')
+        array = to_model_layout(resize_and_crop(np.array(image), resolution))
+        description = ""
+    elif kind == "video":
+        frames, description = sdl.read_video(in_fs, file_name)
+        frames = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in frames]
+        array = to_model_layout(np.stack([resize_and_crop(f, resolution) for f in frames]))
+    else:
+        raise ValueError(f"Unsupported input kind {kind}")
+
+    with io.BytesIO() as buffer:
+        np.savez(buffer, data=array.astype(np.uint8), description=np.array(description))
+        with out_fs.open(shard_name(file_name), 'wb') as shard_file:
+            shard_file.write(buffer.getvalue())
+
+    return {"input": file_name, "output": shard_name(file_name), "shape": list(array.shape)}
+
+_pool_fs = None
+
+def _init_pool_worker(in_fs_args, out_fs_args):
+    global _pool_fs
+    _pool_fs = (sdl.fs_initializer(in_fs_args), sdl.fs_initializer(out_fs_args))
+
+def _pool_preprocess(file_name, kind, resolution):
+    in_fs, out_fs = _pool_fs
+    return preprocess_file(in_fs, out_fs, file_name, kind, resolution)
+
+def preprocess_local(in_fs_args, out_fs_args, kind, resolution, workers):
+    """Convert every input not yet in the manifest using a local process pool."""
+    in_fs = sdl.fs_initializer(in_fs_args)
+    out_fs = sdl.fs_initializer(out_fs_args)
+
+    todo = pending_inputs(in_fs, out_fs, kind)
+    print(f"Preprocessing {len(todo)} inputs with {workers} workers...")
+
+    manifest_name = f"{socket.gethostname()}_{os.getpid()}.jsonl"
+    f = functools.partial(_pool_preprocess, kind=kind, resolution=resolution)
+    with multiprocessing.Pool(workers, _init_pool_worker, (in_fs_args, out_fs_args)) as pool:
+        for i, entry in enumerate(pool.imap_unordered(f, todo)):
+            append_manifest(out_fs, manifest_name, entry)
+            if (i + 1) % 100 == 0:
+                print(f"Preprocessed {i + 1}/{len(todo)} inputs")
+    return len(todo)
+
+class PreprocessWorkerInterface:
+    """Worker interface for ShardedDataUploader, each uploaded example is the
+    name of a raw input file to convert into a tensor shard."""
+
+    def __init__(self, fs, in_fs_args, kind, resolution):
+        self.fs = fs
+        self.in_fs = sdl.fs_initializer(in_fs_args)
+        self.kind = kind
+        self.resolution = resolution
+        self.manifest_name = f"{socket.gethostname()}_{os.getpid()}.jsonl"
+
+    def upload_example(self, example_id, file_name):
+        entry = preprocess_file(self.in_fs, self.fs, file_name, self.kind, self.resolution)
+        append_manifest(self.fs, self.manifest_name, entry)
+
+class HostShardInterface:
+    """Shard interface for data that never leaves the host."""
+
+    def host_to_accelerator(self, local_data, batch_size):
+        return local_data
+
+    def accelerator_to_host(self, global_data):
+        return global_data
+
+def preprocess_distributed(in_fs_args, out_fs_args, kind, resolution, host,
+                           workers_per_node=1, batch_size=32, queue_depth=5):
+    """Convert every input not yet in the manifest, splitting them across hosts
+    and feeding each host's share to the workers of a ShardedDataUploader."""
+    in_fs = sdl.fs_initializer(in_fs_args)
+    out_fs = sdl.fs_initializer(out_fs_args)
+
+    # Split the full input list rather than the pending one, so hosts agree
+    # on the split even if they read the manifest at different times
+    completed = load_manifest(out_fs)
+    local_todo = [f for f in input_files(in_fs, kind)[host.pid::host.nodes] if f not in completed]
+    print(f"Host {host.pid} preprocessing {len(local_todo)} inputs...")
+
+    worker_interface_factory = functools.partial(
+        PreprocessWorkerInterface, in_fs_args=in_fs_args, kind=kind, resolution=resolution)
+    uploader = sdl.ShardedDataUploader(
+        out_fs_args, worker_interface_factory, HostShardInterface, host,
+        workers_per_node=workers_per_node, batch_size=batch_size, queue_depth=queue_depth)
+
+    local_batch_size = batch_size // host.nodes
+    uploader.start(0)
+    try:
+        for i in range(0, len(local_todo), local_batch_size):
+            uploader.step(local_todo[i:i + local_batch_size])
+            uploader.ack()
+    finally:
+        uploader.stop()
+    return len(local_todo)
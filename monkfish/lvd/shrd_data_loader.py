@@ -3,11 +3,16 @@ import io
 import sys
 import time
 import pickle
+import shutil
+import subprocess
+import threading
+import concurrent.futures
 
 import numpy as np
 
 import multiprocessing
 import multiprocessing.queues
+import multiprocessing.shared_memory
 
 import fs
 import fs.osfs
@@ -71,6 +76,19 @@ def fs_initializer(args):
     else:
         raise ValueError(f"Unsupported filesystem type: {fs_type}")
 
+def ffmpeg_executable():
+    """Locate ffmpeg, falling back on the binary bundled with imageio-ffmpeg."""
+    executable = shutil.which("ffmpeg")
+    if executable is None:
+        try:
+            import imageio_ffmpeg
+        except ImportError:
+            raise RuntimeError("ffmpeg is required to encode videos but was not found.")
+        executable = imageio_ffmpeg.get_ffmpeg_exe()
+    return executable
+
+STOP_SENTINEL = "stop"
+
 def sdu_worker(start_index, queue, stop_event, workers_per_node, nodes, 
                worker_interface_cls, fs_init_args):
     counter = start_index
@@ -78,18 +96,19 @@ def sdu_worker(start_index, queue, stop_event, workers_per_node, nodes,
     fs = fs_initializer(fs_init_args)
     worker_interface = worker_interface_cls(fs)
     
+    # stop_event aborts, dropping whatever is still queued. A normal stop is
+    # the sentinel, which comes after everything queued before it
     while not stop_event.is_set():
         try:
             # Add a timeout to allow checking stop_event
-            example, _ = queue.get(timeout=0.2)
-            worker_interface.upload_example(counter, example)
-            counter += workers_per_node * nodes
+            example, tag = queue.get(timeout=0.2)
         except multiprocessing.queues.Empty:
             continue
-    
-    # Drain remaining queue once stop signal is sent
-    while not queue.empty():
-        example, _ = queue.get()
+
+        # Everything queued before the stop sentinel has been uploaded
+        if tag == STOP_SENTINEL:
+            break
+
         worker_interface.upload_example(counter, example)
         counter += workers_per_node * nodes
 
@@ -142,12 +161,18 @@ class ShardedDataUploader:
         self.processed = True
 
     def stop(self):
+        # Queue.empty() can't see items still in the feeder thread's buffer,
+        # so signal the end of the stream in-band instead
+        for queue in self.queues:
+            queue.put((None, STOP_SENTINEL))
+        self._join()
+
+    def abort(self):
+        """Stop the workers without waiting for queued examples to upload."""
         self.stop_event.set()
+        self._join()
 
-        # Wait for queues to drain before shutting down workers
-        while any(not queue.empty() for queue in self.queues):
-            time.sleep(0.1)
-        
+    def _join(self):
         for worker in self.workers:
             worker.join()
         
@@ -178,20 +203,190 @@ class ShardedDataUploader:
         self.processed = True
 
 
+class SharedExampleCache:
+    """LRU cache of decoded examples in host shared memory.
+
+    Every entry is pickled with protocol 5, the out-of-band buffers (numpy
+    arrays) are stored in their own shared memory block and the small pickle
+    header is kept in a manager dict alongside the LRU bookkeeping. The cache
+    is passed to the worker processes, so all workers on a node share it.
+    """
+    HITS, MISSES, EVICTIONS, BYTES = range(4)
+
+    def __init__(self, max_bytes, manager):
+        self.max_bytes = max_bytes
+        self.prefix = f"sdc_{os.getpid()}_{time.time_ns()}"
+
+        # key -> (shm_name, header, buffer_sizes, nbytes, last_used)
+        self.index = manager.dict()
+        # last_used -> key, the LRU order. Ticks only grow, so the least 
+        # recently used entry is the first one found counting up from oldest
+        self.order = manager.dict()
+        self.oldest = multiprocessing.Value('q', 1, lock=False)
+        # shm_name -> readers copying out of it. A pinned block evicted from 
+        # the index is unlinked by its last reader instead
+        self.pins = manager.dict()
+        # Held for the bookkeeping only, the copies in and out of shared 
+        # memory happen outside it so workers don't wait on each other's
+        self.lock = multiprocessing.Lock()
+        self.tick = multiprocessing.Value('q', 0, lock=False)
+        self.counters = multiprocessing.Array('q', 4, lock=False)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                self.counters[self.MISSES] += 1
+                return None
+            shm_name, header, buffer_sizes, nbytes, last_used = entry
+            tick = self._next_tick()
+            self.index[key] = (shm_name, header, buffer_sizes, nbytes, tick)
+            del self.order[last_used]
+            self.order[tick] = key
+            self.counters[self.HITS] += 1
+            self.pins[shm_name] = self.pins.get(shm_name, 0) + 1
+
+        try:
+            shm = multiprocessing.shared_memory.SharedMemory(name=shm_name)
+            try:
+                buffers = []
+                offset = 0
+                for size in buffer_sizes:
+                    buffers.append(bytearray(shm.buf[offset:offset + size]))
+                    offset += size
+                return pickle.loads(header, buffers=buffers)
+            finally:
+                shm.close()
+        finally:
+            self._unpin(key, shm_name)
+
+    def put(self, key, data):
+        buffers = []
+        header = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+        raw_buffers = [buffer.raw() for buffer in buffers]
+        buffer_sizes = [raw.nbytes for raw in raw_buffers]
+        nbytes = len(header) + sum(buffer_sizes)
+
+        if nbytes > self.max_bytes:
+            return False
+
+        # The block is filled before it's indexed, so no reader can see it 
+        # part written
+        shm_name = f"{self.prefix}_{os.getpid()}_{time.time_ns()}"
+        shm = multiprocessing.shared_memory.SharedMemory(
+            name=shm_name, create=True, size=max(sum(buffer_sizes), 1))
+        offset = 0
+        for raw in raw_buffers:
+            shm.buf[offset:offset + raw.nbytes] = raw.cast('B')
+            offset += raw.nbytes
+        shm.close()
+
+        with self.lock:
+            # Another worker may have cached the same key meanwhile
+            inserted = key not in self.index
+            if inserted:
+                self._evict(nbytes)
+                tick = self._next_tick()
+                self.index[key] = (shm_name, header, buffer_sizes, nbytes, tick)
+                self.order[tick] = key
+                self.counters[self.BYTES] += nbytes
+        if not inserted:
+            _unlink_shared_memory(shm_name)
+        return True
+
+    def stats(self):
+        hits = self.counters[self.HITS]
+        misses = self.counters[self.MISSES]
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "evictions": self.counters[self.EVICTIONS],
+            "bytes": self.counters[self.BYTES],
+            "entries": len(self.index),
+            "hit_rate": hits / lookups if lookups else 0.0
+        }
+
+    def close(self):
+        with self.lock:
+            for key in list(self.index.keys()):
+                self._remove(key)
+
+    def _next_tick(self):
+        self.tick.value += 1
+        return self.tick.value
+
+    def _evict(self, nbytes):
+        # Caller holds the lock
+        while self.index and self.counters[self.BYTES] + nbytes > self.max_bytes:
+            self._remove(self._lru_key())
+            self.counters[self.EVICTIONS] += 1
+
+    def _lru_key(self):
+        # Caller holds the lock. Every tick is stepped over at most once, so
+        # this is O(1) manager round trips amortized over the cache's use
+        while True:
+            key = self.order.get(self.oldest.value)
+            if key is not None:
+                return key
+            self.oldest.value += 1
+
+    def _remove(self, key):
+        # Caller holds the lock
+        shm_name, _, _, nbytes, last_used = self.index.pop(key)
+        del self.order[last_used]
+        self.counters[self.BYTES] -= nbytes
+        if shm_name not in self.pins:
+            _unlink_shared_memory(shm_name)
+
+    def _unpin(self, key, shm_name):
+        with self.lock:
+            pins = self.pins.pop(shm_name) - 1
+            if pins:
+                self.pins[shm_name] = pins
+                return
+            entry = self.index.get(key)
+            evicted = entry is None or entry[0] != shm_name
+        if evicted:
+            _unlink_shared_memory(shm_name)
+
+def _unlink_shared_memory(shm_name):
+    try:
+        shm = multiprocessing.shared_memory.SharedMemory(name=shm_name)
+        shm.close()
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+def cached_get_example(worker_interface, example_id, cache):
+    """get_example, served from `cache` when the underlying file was already decoded."""
+    if cache is None:
+        return worker_interface.get_example(example_id)
+    
+    key = worker_interface.cache_key(example_id)
+    data = cache.get(key)
+    if data is None:
+        data, _ = worker_interface.get_example(example_id)
+        cache.put(key, data)
+    return data, example_id
+
 def sdd_worker(start_index, queue, stop_event, workers_per_node, nodes, 
-               worker_interface_cls, fs_init_args):
+               worker_interface_cls, fs_init_args, cache=None):
     print(f"sdd worker started with  start_index: {start_index}")
     counter = start_index
 
     fs = fs_initializer(fs_init_args)
     worker_interface = worker_interface_cls(fs)
     
+    example = None
     while not stop_event.is_set():
-        example = worker_interface.get_example(counter)
+        if example is None:
+            example = cached_get_example(worker_interface, counter, cache)
         try:
             # Try to put the item in the queue with a timeout
             queue.put((example, counter), timeout=0.1)
             counter += workers_per_node * nodes
+            example = None
         except multiprocessing.queues.Full:
             # If the queue is full, just continue to the next iteration
             continue
@@ -201,7 +396,7 @@ def sdd_worker(start_index, queue, stop_event, workers_per_node, nodes,
 
 class ShardedDataDownloader:
     def __init__(self, worker_fs_args, worker_interface_cls, shard_interface_factory, dist_manager, 
-                 workers_per_node=1, batch_size=32, queue_depth=5):
+                 workers_per_node=1, batch_size=32, queue_depth=5, cache_bytes=0):
         assert batch_size % dist_manager.nodes == 0
 
         #Start workers
@@ -214,12 +409,16 @@ class ShardedDataDownloader:
         self.worker_interface_cls = worker_interface_cls
         self.worker_fs_args = worker_fs_args
         self.shard_interface_factory = shard_interface_factory
+        self.cache_bytes = cache_bytes
 
         self.shard_interface = self.shard_interface_factory()
 
         self.counter = None 
         self.round_robin_index = None
 
+        self.cache_manager = None
+        self.cache = None
+
         self.stop_event = None
         self.workers = []
         self.queues = []
@@ -230,6 +429,10 @@ class ShardedDataDownloader:
         self.counter = counter
         self.round_robin_index = 0
 
+        if self.cache_bytes > 0:
+            self.cache_manager = multiprocessing.Manager()
+            self.cache = SharedExampleCache(self.cache_bytes, self.cache_manager)
+
         self.stop_event = multiprocessing.Event()
         for i in range(self.workers_per_node):
             start_index = self.counter + i*self.nodes + self.pid
@@ -238,7 +441,8 @@ class ShardedDataDownloader:
             worker = multiprocessing.Process(
                 target=sdd_worker, args=(
                     start_index, queue, self.stop_event, 
-                    self.workers_per_node, self.nodes, self.worker_interface_cls, self.worker_fs_args)
+                    self.workers_per_node, self.nodes, self.worker_interface_cls, self.worker_fs_args,
+                    self.cache)
             )
 
             self.queues.append(queue)
@@ -265,9 +469,22 @@ class ShardedDataDownloader:
         for worker in self.workers:
             worker.join()
         
+        if self.cache is not None:
+            print(f"Example cache stats: {self.cache.stats()}")
+            self.cache.close()
+            self.cache_manager.shutdown()
+            self.cache = None
+            self.cache_manager = None
+
         self.queues = None
         self.stop_event = None
 
+    def cache_stats(self):
+        """Hit/miss counts of the shared example cache, None if caching is disabled."""
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
     def step(self):
         assert self.processed
 
@@ -332,6 +549,12 @@ class ImageWorkerInterface:
         """
         return self.files
 
+    def cache_key(self, example_id):
+        """
+        Key identifying the decoded example in a SharedExampleCache.
+        """
+        return self.files[example_id % len(self.files)]
+
     def upload_example(self, example_id, image_data):
         """
         Upload a processed image back to the filesystem.
@@ -378,9 +601,52 @@ class ImageShardInterface:
         pass
 
 
+def read_video(fs, file_name):
+    """
+    Decode a video file into a [frames x height x width x 3] BGR array and its text description.
+    """
+    # Create a temporary file
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_file:
+        temp_path = temp_file.name
+        
+        # Read the file into the temporary file
+        with fs.open(file_name, 'rb') as video_file:
+            temp_file.write(video_file.read())
+    
+    try:
+        # Read metadata
+        mp4 = mutagen.mp4.MP4(temp_path)
+        description = mp4.get('\xa9des', [''])[0]  # '©des' is the iTunes description tag
+        
+        # Read video data with OpenCV
+        cap = cv2.VideoCapture(temp_path)
+        
+        frames = []
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+        
+        cap.release()
+        video_array = np.array(frames)
+        
+        return video_array, description
+    
+    finally:
+        # Clean up the temporary file
+        os.unlink(temp_path)
+
 class VideoWorkerInterface:
     """Interface to Video data, folder is a dataset, 1 train example per file"""
 
+    # Encoder settings for upload_example
+    fps = 30
+    codec = "mpeg4"
+    codec_args = ("-q:v", "2")
+    segment_frames = 240
+    encode_workers = 4
+
     def __init__(self, fs):
         self.fs = fs
         self.files = sorted([f for f in self.fs.listdir('/') if f.lower().endswith('.mp4')])
@@ -397,37 +663,7 @@ class VideoWorkerInterface:
         file_index = example_id % num_files  # Ensure looping over the videos
         file_name = self.files[file_index]
         
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_file:
-            temp_path = temp_file.name
-            
-            # Read the file into the temporary file
-            with self.fs.open(file_name, 'rb') as video_file:
-                temp_file.write(video_file.read())
-        
-        try:
-            # Read metadata
-            mp4 = mutagen.mp4.MP4(temp_path)
-            description = mp4.get('\xa9des', [''])[0]  # '©des' is the iTunes description tag
-            
-            # Read video data with OpenCV
-            cap = cv2.VideoCapture(temp_path)
-            
-            frames = []
-            while True:
-                ret, frame = cap.read()
-                if not ret:
-                    break
-                frames.append(frame)
-            
-            cap.release()
-            video_array = np.array(frames)
-            
-            return (video_array, description), example_id
-        
-        finally:
-            # Clean up the temporary file
-            os.unlink(temp_path)
+        return read_video(self.fs, file_name), example_id
 
     def list_dir(self):
         """
@@ -435,33 +671,119 @@ class VideoWorkerInterface:
         """
         return self.files
 
+    def cache_key(self, example_id):
+        """
+        Key identifying the decoded example in a SharedExampleCache.
+        """
+        return self.files[example_id % len(self.files)]
+
     def upload_example(self, example_id, video_array, description):
         """
         Upload a processed video back to the filesystem with its description as metadata.
+        `video_array` can be an array or any iterable of [height x width x 3] BGR frames.
+        Frames are piped to ffmpeg in independently encoded segments, so only
+        `encode_workers` segments are ever held in memory at once.
         """
         file_name = f'video_{example_id}.mp4'
-        
-        # Create an in-memory buffer
-        buffer = io.BytesIO()
-        
-        # Write video to buffer using OpenCV
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter()
-        out.open(buffer, fourcc, 30, (video_array.shape[2], video_array.shape[1]), True)
-        for frame in video_array:
-            out.write(frame)
-        out.release()
-        
-        # Add metadata
-        buffer.seek(0)
-        mp4 = MP4(buffer)
-        mp4['\xa9des'] = description
-        mp4.save(buffer)
-        
-        # Upload to filesystem
-        buffer.seek(0)
-        with self.fs.open(file_name, 'wb') as fs_file:
-            fs_file.write(buffer.getvalue())
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            segment_paths = self._encode_segments(video_array, temp_dir)
+
+            if len(segment_paths) == 1:
+                video_path = segment_paths[0]
+            else:
+                video_path = os.path.join(temp_dir, "video.mp4")
+                self._concat_segments(segment_paths, video_path)
+
+            # Add metadata
+            mp4 = mutagen.mp4.MP4(video_path)
+            mp4['\xa9des'] = description
+            mp4.save()
+
+            # Stream to filesystem
+            with open(video_path, 'rb') as video_file:
+                with self.fs.open(file_name, 'wb') as fs_file:
+                    shutil.copyfileobj(video_file, fs_file, 1 << 20)
+
+    def _encode_segments(self, frames, temp_dir):
+        """Encode `frames` into one mp4 per `segment_frames` frames, in parallel."""
+        segment_paths = []
+        futures = []
+        # Bounds the number of buffered segments
+        slots = threading.Semaphore(self.encode_workers)
+
+        def encode(segment, path):
+            try:
+                self._encode_segment(segment, path)
+            finally:
+                slots.release()
+
+        with concurrent.futures.ThreadPoolExecutor(self.encode_workers) as executor:
+            for segment in self._segments(frames):
+                slots.acquire()
+                path = os.path.join(temp_dir, f"segment_{len(segment_paths)}.mp4")
+                segment_paths.append(path)
+                futures.append(executor.submit(encode, segment, path))
+            
+            for future in futures:
+                future.result()
+
+        if not segment_paths:
+            raise ValueError("Cannot encode a video with no frames.")
+        return segment_paths
+
+    def _segments(self, frames):
+        if isinstance(frames, np.ndarray):
+            # Slicing an array is free, no need to buffer
+            for i in range(0, len(frames), self.segment_frames):
+                yield frames[i:i + self.segment_frames]
+            return
+
+        segment = []
+        for frame in frames:
+            segment.append(frame)
+            if len(segment) == self.segment_frames:
+                yield segment
+                segment = []
+        if segment:
+            yield segment
+
+    def _encode_segment(self, segment, path):
+        height, width = segment[0].shape[:2]
+        command = [
+            ffmpeg_executable(), "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24",
+            "-s", f"{width}x{height}", "-r", str(self.fps),
+            "-i", "-", "-an",
+            "-c:v", self.codec, *self.codec_args,
+            "-pix_fmt", "yuv420p", path
+        ]
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            for frame in segment:
+                proc.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        except BrokenPipeError:
+            pass
+        finally:
+            proc.stdin.close()
+        err = proc.stderr.read()
+        if proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to encode {path}: {err.decode(errors='replace')}")
+
+    def _concat_segments(self, segment_paths, path):
+        list_path = os.path.join(os.path.dirname(path), "segments.txt")
+        with open(list_path, 'w') as list_file:
+            for segment_path in segment_paths:
+                list_file.write(f"file '{segment_path}'\n")
+
+        command = [
+            ffmpeg_executable(), "-y", "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            "-c", "copy", "-movflags", "+faststart", path
+        ]
+        result = subprocess.run(command, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed to concatenate segments: {result.stderr.decode(errors='replace')}")
 
 class VideoShardInterface:
     def host_to_accelerator(self, local_data, batch_size):
@@ -501,6 +823,12 @@ class LatentWorkerInterface:
         """
         return self.files
 
+    def cache_key(self, example_id):
+        """
+        Key identifying the decoded example in a SharedExampleCache.
+        """
+        return self.files[example_id % len(self.files)]
+
     def upload_example(self, example_id, data):
         """
         Upload a processed latent example back to the filesystem.
@@ -545,3 +873,72 @@ class LatentShardInterface:
         
         return local_data
 
+
+
+class TensorWorkerInterface:
+    """Interface to preprocessed tensor shards (see monkfish.lvd.preprocess), 1 train example per file"""
+
+    def __init__(self, fs):
+        self.fs = fs
+        self.files = sorted([f for f in self.fs.listdir('/') if f.lower().endswith('.npz')])
+        if not self.files:
+            raise ValueError("The directory is empty or contains no tensor shards.")
+
+    def get_example(self, example_id):
+        """
+        Fetch a tensor shard and handle looping through files.
+        Returns a tuple containing the uint8 array, already in model layout, and its text description.
+        """
+        num_files = len(self.files)
+        file_index = example_id % num_files  # Ensure looping over the files
+        file_name = self.files[file_index]
+        
+        with self.fs.open(file_name, 'rb') as shard_file:
+            shard = np.load(io.BytesIO(shard_file.read()))
+            data = (shard["data"], str(shard["description"]))
+        
+        return data, example_id
+
+    def list_dir(self):
+        """
+        List all examples in the folder.
+        """
+        return self.files
+
+    def cache_key(self, example_id):
+        """
+        Key identifying the decoded example in a SharedExampleCache.
+        """
+        return self.files[example_id % len(self.files)]
+
+    def upload_example(self, example_id, data):
+        """
+        Upload a (uint8 array, description) example as a tensor shard.
+        """
+        array, description = data
+        file_name = f'{example_id}.npz'
+
+        with io.BytesIO() as buffer:
+            np.savez(buffer, data=array, description=np.array(description))
+            with self.fs.open(file_name, 'wb') as fs_file:
+                fs_file.write(buffer.getvalue())
+
+class TensorShardInterface:
+    """Interface to preprocessed uint8 tensor shards for sharding"""
+
+    def __init__(self, dist_manager):
+        self.dist_manager = dist_manager
+
+    def host_to_accelerator(self, local_data, batch_size):
+        # Shards are already resized and in model layout, only normalization is left
+        np_array = np.stack([x[0][0] for x in local_data])
+
+        mesh = self.dist_manager.mesh
+        p_spec = shrd.PartitionSpec("dp")
+        sharding = shrd.NamedSharding(mesh, p_spec)
+        scatter_fn = self.dist_manager.scatter(sharding, jnp.float32)
+        sharded_array = scatter_fn(np_array)/255 - 0.5
+        return sharded_array
+    
+    def accelerator_to_host(self, global_data):
+        pass
@@ -5,6 +5,11 @@ import multiprocessing
 
 import monkfish.lvd.diffusion_ae as dae
 import monkfish.lvd.diffusion_ar as dar
+import monkfish.lvd.preprocess as pp
+import monkfish.lvd.mesh_tuner as mt
+import monkfish.lvd.memory_planner as mplan
+import monkfish.lvd.models.dist_layers as dl
+import monkfish.lvd.models.dist_utils as du
 
 def configure_globals():
     multiprocessing.set_start_method('spawn')
@@ -23,6 +28,43 @@ def parse_args():
     train_dae_parser = subparsers.add_parser("train_dae", help="Train the diffusion autoencoder")
     train_dae_parser.add_argument("--ckpt", default=None, help="Path to checkpoint to resume training from")
     
+    # Preprocessing raw datasets
+    preprocess_parser = subparsers.add_parser("preprocess", help="Convert a raw image or video folder into training-ready tensor shards")
+    preprocess_parser.add_argument("input_dir", help="Folder of raw images or videos")
+    preprocess_parser.add_argument("output_dir", help="Folder to write tensor shards and the manifest to")
+    preprocess_parser.add_argument("--kind", choices=["image", "video"], default="image", help="Type of the raw inputs")
+    preprocess_parser.add_argument("--resolution", type=int, nargs=2, default=None, help="Target width and height, defaults to the autoencoder resolution")
+    preprocess_parser.add_argument("--fs_type", choices=["local", "gcp"], default="local", help="Filesystem holding both folders")
+    preprocess_parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="Worker processes per node")
+    preprocess_parser.add_argument("--batch_size", type=int, default=32, help="Inputs handed out per step in distributed mode")
+
+    # Tuning the device mesh
+    tune_mesh_parser = subparsers.add_parser("tune_mesh", help="Time a training step under each dp/mp/fsdp mesh shape and keep the fastest")
+    tune_mesh_parser.add_argument("--model", choices=["dae", "ardm"], default="dae", help="Model to tune the mesh for")
+    tune_mesh_parser.add_argument("--steps", type=int, default=3, help="Timed training steps per mesh shape")
+    tune_mesh_parser.add_argument("--batch_size", type=int, default=None, help="Defaults to the data_loader batch size")
+    tune_mesh_parser.add_argument("--seq_len", type=int, default=256, help="ARDM sequence length")
+    tune_mesh_parser.add_argument("--dry_run", action="store_true", help="Report without writing the best mesh shape to the config")
+
+    # Comparing remat policies
+    tune_remat_parser = subparsers.add_parser("tune_remat", help="Report the per-device memory and step time of training under each remat policy")
+    tune_remat_parser.add_argument("--model", choices=["dae", "ardm"], default="dae", help="Model to compare remat policies of")
+    tune_remat_parser.add_argument("--steps", type=int, default=3, help="Timed training steps per policy")
+    tune_remat_parser.add_argument("--batch_size", type=int, default=None, help="Defaults to the data_loader batch size")
+    tune_remat_parser.add_argument("--seq_len", type=int, default=256, help="ARDM sequence length")
+
+    # Memory planning
+    plan_memory_parser = subparsers.add_parser("plan_memory", help="Estimate per-device memory of the configured training run without allocating it")
+    plan_memory_parser.add_argument("--model", choices=["dae", "ardm"], default="dae", help="Model to plan for")
+    plan_memory_parser.add_argument("--batch_size", type=int, default=None, help="Defaults to the data_loader batch size")
+    plan_memory_parser.add_argument("--seq_len", type=int, default=256, help="ARDM sequence length")
+    plan_memory_parser.add_argument("--no_compile", action="store_true", help="Skip compiling the training step for XLA's memory analysis")
+
+    # Converting checkpoints
+    fuse_qkv_parser = subparsers.add_parser("fuse_qkv", help="Convert an ARDM checkpoint with separate q, k and v attention weights to the fused qkv layout")
+    fuse_qkv_parser.add_argument("src", help="Checkpoint directory, sharded or pickle, relative to the checkpoint root")
+    fuse_qkv_parser.add_argument("dst", help="Directory to write the converted checkpoint to")
+
     # Lifting videos
     lift_parser = subparsers.add_parser("lift", help="Lift videos into the diffusion latent space")
     lift_parser.add_argument("input_videos", nargs="+", help="Input video files")
@@ -54,6 +96,16 @@ def main():
     # Process the arguments and call appropriate functions
     if args.operation == "train_dae":
         train_diffusion_autoencoder(config, args)
+    elif args.operation == "preprocess":
+        preprocess_dataset(config, args)
+    elif args.operation == "tune_mesh":
+        tune_mesh(config, args)
+    elif args.operation == "tune_remat":
+        tune_remat(config, args)
+    elif args.operation == "plan_memory":
+        plan_memory(config, args)
+    elif args.operation == "fuse_qkv":
+        fuse_qkv(config, args)
     elif args.operation == "lift":
         lift_videos(config, args)
     elif args.operation == "train_adm":
@@ -102,6 +154,98 @@ def train_diffusion_autoencoder(config, args):
     else:
         print(f"Mode {args.mode} and backend {backend} is not supported for train_dae")
 
+def preprocess_dataset(config, args):
+    print(f"Preprocessing {args.kind} folder {args.input_dir} into {args.output_dir} in {args.mode} mode")
+
+    def fs_args(root_path):
+        if args.fs_type == "local":
+            return {"fs_type": "os", "root_path": root_path}
+        gcp_conf = config["gcp"]
+        return {
+            "fs_type": "gcp",
+            "bucket_name": gcp_conf["gcp_bucket_name"],
+            "root_path": root_path,
+            "credentials_path": gcp_conf["gcp_credentials_path"]
+        }
+
+    in_fs_args = fs_args(args.input_dir)
+    out_fs_args = fs_args(args.output_dir)
+    resolution = args.resolution or config["diffusion_auto_encoder"]["resolution"]
+
+    if args.mode == "local":
+        n = pp.preprocess_local(
+            in_fs_args, out_fs_args, args.kind, resolution, args.workers)
+        print(f"Preprocessed {n} inputs")
+    elif args.mode == "distributed":
+        import jax
+        host = pp.HostInfo(pid=jax.process_index(), nodes=jax.process_count())
+        n = pp.preprocess_distributed(
+            in_fs_args, out_fs_args, args.kind, resolution, host,
+            workers_per_node=args.workers, batch_size=args.batch_size)
+        print(f"Host {host.pid} preprocessed {n} inputs")
+    elif args.mode == "swarm":
+        # TODO: Implement swarm preprocessing
+        pass
+    else:
+        print(f"Mode {args.mode} is not supported for preprocess")
+
+def tune_mesh(config, args):
+    print(f"Tuning the mesh shape of {args.model} in {args.mode} mode")
+
+    if args.mode in ["local", "distributed"]:
+        import jax
+        results = mt.tune_mesh(
+            args.model, config, batch_size=args.batch_size, steps=args.steps, seq_len=args.seq_len)
+        if not results:
+            print("No mesh shape could run a training step")
+            return
+        best = results[0]["mesh_shape"]
+        print(f"Best mesh_shape: {best}")
+        if not args.dry_run and jax.process_index() == 0:
+            mt.write_mesh_shape(args.config, args.model, best)
+            print(f"Wrote mesh_shape {best} to {args.config}")
+    elif args.mode == "swarm":
+        # TODO: Implement swarm mesh tuning
+        pass
+    else:
+        print(f"Mode {args.mode} is not supported for tune_mesh")
+
+def tune_remat(config, args):
+    print(f"Comparing the remat policies of {args.model} in {args.mode} mode")
+
+    if args.mode in ["local", "distributed"]:
+        plans = mplan.tune_remat(
+            args.model, config, batch_size=args.batch_size, steps=args.steps, seq_len=args.seq_len)
+        print(mplan.format_remat_plans(plans))
+    else:
+        print(f"Mode {args.mode} is not supported for tune_remat")
+
+def plan_memory(config, args):
+    print(f"Planning the memory of {args.model} in {args.mode} mode")
+
+    if args.mode in ["local", "distributed"]:
+        plan = mplan.plan_memory(
+            args.model, config, batch_size=args.batch_size, 
+            compile=not args.no_compile, seq_len=args.seq_len)
+        print(mplan.format_plan(plan))
+    else:
+        print(f"Mode {args.mode} is not supported for plan_memory")
+
+def fuse_qkv(config, args):
+    print(f"Fusing the attention weights of {args.src} into {args.dst} in {args.mode} mode")
+
+    if args.mode in ["local", "distributed"]:
+        mesh_shape = config["transformer_ardm"]["dist_manager"]["mesh_shape"]
+        dist_manager = du.DistManager(mesh_shape, dar.ckpt_filesystem(config))
+        # A pickle checkpoint is read into the state the harness would train
+        state = None
+        if not dist_manager.is_sharded_checkpoint(args.src):
+            state = dar.init_state(dist_manager, config)
+        fused = dl.fuse_qkv_checkpoint(dist_manager, args.src, args.dst, state)
+        print(f"Fused {len(fused)} attention weights")
+    else:
+        print(f"Mode {args.mode} is not supported for fuse_qkv")
+
 def lift_videos(config, args):
     print(f"Lifting videos {args.input_videos} with config {config} in {args.mode} mode")
 
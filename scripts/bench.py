@@ -0,0 +1,407 @@
+"""Benchmarks for the distributed utilities and layers.
+
+Run on CPU-emulated devices with e.g.
+
+    XLA_FLAGS=--xla_force_host_platform_device_count=8 python scripts/bench.py checkpoint
+"""
+import argparse
+import time
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import optax
+import fs.memoryfs
+
+import monkfish.lvd.models.dist_utils as du
+import monkfish.lvd.models.dist_layers as dl
+import monkfish.lvd.models.grad_compression as gc
+import monkfish.lvd.diffusion_core as dc
+import monkfish.lvd.diffusion_ar as dar
+import monkfish.lvd.models.dist_autoreg_diffusion as dard
+import monkfish.lvd.models.dist_autoencoding_diffusion as daed
+
+
+def timed(f, *args, repeats=1):
+    """Best wall time of `repeats` calls to f, blocking on the result."""
+    best = float("inf")
+    for _ in range(repeats):
+        t1 = time.perf_counter()
+        out = f(*args)
+        jax.block_until_ready(out)
+        best = min(best, time.perf_counter() - t1)
+    return best, out
+
+def make_state(dist_manager, args):
+    """Model, optimizer state and key, laid out like the harness state."""
+    state = {"prng_key": dist_manager.get_key(0)}
+    if args.model == "ardm":
+        state["model"] = dard.TransformerARDM(
+            dist_manager, jax.random.PRNGKey(0), res_dim=args.res_dim,
+            io_dim=args.res_dim, vocab=args.vocab, n_layers=args.n_layers,
+            mlp_dim=args.mlp_dim, qk_dim=args.qk_dim, v_dim=args.qk_dim, n_head=args.n_head)
+    else:
+        enc_key, dec_key = jax.random.split(jax.random.PRNGKey(0))
+        state["model"] = (
+            daed.Encoder(dist_manager, key=enc_key, k=args.k, n_layers=args.n_layers),
+            daed.Decoder(dist_manager, key=dec_key, k=args.k, n_layers=args.n_layers))
+    state["opt_state"] = optax.adam(1e-4).init(state["model"])
+    return state
+
+def bench_init(args):
+    dist_manager = du.DistManager(args.mesh_shape, fs.memoryfs.MemoryFS())
+    make_model = lambda key: dard.TransformerARDM(
+        dist_manager, key, res_dim=args.res_dim, io_dim=args.res_dim, vocab=args.vocab,
+        n_layers=args.n_layers, mlp_dim=args.mlp_dim, qk_dim=args.qk_dim,
+        v_dim=args.qk_dim, n_head=args.n_head)
+
+    key = dist_manager.get_key(0)
+    if not args.skip_eager:
+        t, _ = timed(make_model, key)
+        print(f"eager init of {args.n_layers} layers: {t:.2f}s")
+    t, _ = timed(dist_manager.init_model, make_model, key)
+    print(f"init_model of {args.n_layers} layers: {t:.2f}s")
+
+def peak_device_bytes():
+    """Peak bytes in use on the first device, where the backend reports it."""
+    stats = jax.devices()[0].memory_stats()
+    return None if stats is None else stats.get("peak_bytes_in_use")
+
+def bench_gather(args):
+    dist_manager = du.DistManager(args.mesh_shape, fs.memoryfs.MemoryFS())
+    state = make_state(dist_manager, args)
+    leaves = jax.tree_util.tree_leaves(state)
+    state_bytes = sum(leaf.nbytes for leaf in leaves)
+    print(f"{args.model} state with {args.n_layers} layers, {len(leaves)} leaves, "
+          f"{state_bytes / 2**20:.1f}MiB")
+
+    # The previous path: replicate every leaf onto every device, then fetch one copy
+    replicate = jax.jit(lambda *xs: xs, out_shardings=(dist_manager.uniform_sharding,) * len(leaves))
+    replicate = replicate.lower(*leaves).compile()
+    replicated = lambda: [np.asarray(x.addressable_data(0)) for x in replicate(*leaves)]
+    shardwise = lambda: [dist_manager.gather_shards(leaf) for leaf in leaves]
+
+    for name, f in [("replicated", replicated), ("shard-wise", shardwise)]:
+        peak = peak_device_bytes()
+        t, _ = timed(f, repeats=args.repeats)
+        line = f"{name} gather: {t:.2f}s ({state_bytes / 2**20 / t:.0f}MiB/s)"
+        if peak is not None:
+            line += f", peak device memory grew by {(peak_device_bytes() - peak) / 2**20:.1f}MiB"
+        print(line)
+
+    memory = replicate.memory_analysis()
+    print(f"replicated gather holds an extra {memory.output_size_in_bytes / 2**20:.1f}MiB "
+          f"per device, shard-wise gather none")
+
+def device_bytes(pytree, device):
+    """Bytes of the leaves of `pytree` held on `device`."""
+    return sum(shard.data.nbytes for leaf in jax.tree_util.tree_leaves(pytree) 
+               for shard in leaf.addressable_shards if shard.device == device)
+
+def bench_offload(args):
+    dist_manager = du.DistManager(args.mesh_shape, fs.memoryfs.MemoryFS())
+    params = make_state(dist_manager, args)["model"]
+    # The parameters stand in for gradients, only the optimizer step is timed
+    grads = params
+    param_bytes = sum(leaf.nbytes for leaf in jax.tree_util.tree_leaves(params))
+    device = jax.devices()[0]
+
+    optimizer = optax.adam(1e-4)
+    opt_state = optimizer.init(params)
+    @jax.jit
+    def update(params, opt_state):
+        updates, opt_state = optimizer.update(grads, opt_state, params)
+        return optax.apply_updates(params, updates), opt_state
+    t, _ = timed(update, params, opt_state, repeats=args.repeats)
+    print(f"on device: step {t*1000:.0f}ms, optimizer state on device {device_bytes(opt_state, device) / 2**20:.1f}MiB")
+
+    for group_bytes in args.group_bytes:
+        offloaded = du.OffloadedOptimizer(dist_manager, optax.adam(1e-4), group_bytes=group_bytes)
+        states = offloaded.init(params)
+        host_sharding = offloaded.host_sharding(dist_manager.uniform_sharding)
+        t, _ = timed(offloaded.update, grads, states, params, repeats=args.repeats)
+        # Each step streams the state in and back out
+        state_bytes = sum(leaf.nbytes for leaf in jax.tree_util.tree_leaves(states))
+        # Adam holds two moments per parameter, and two groups are on device at once
+        leaves = jax.tree_util.tree_leaves(params)
+        group_device_bytes = [2 * device_bytes([leaves[i] for i in group], device) for group in offloaded.groups]
+        peak = max(a + b for a, b in zip(group_device_bytes, group_device_bytes[1:] + [0]))
+        print(f"offloaded in {len(offloaded.groups)} groups of <= {group_bytes / 2**20:.0f}MiB: "
+              f"step {t*1000:.0f}ms, {2 * state_bytes / 2**20 / t:.0f}MiB/s streamed, "
+              f"at most {peak / 2**20:.1f}MiB of optimizer state on device, "
+              f"held in {host_sharding.memory_kind or host_sharding}")
+    print(f"parameters: {param_bytes / 2**20:.1f}MiB")
+
+def bench_grads(args):
+    dist_manager = du.DistManager(args.mesh_shape, fs.memoryfs.MemoryFS())
+    args.model = "ardm"
+    state = make_state(dist_manager, args)
+    batch_sharding = dist_manager.sharding(jax.sharding.PartitionSpec("dp"))
+    key = jax.random.PRNGKey(1)
+    true_x = jax.random.normal(key, (args.batch_size, args.seq_len, args.res_dim))
+    txt = jax.random.randint(key, (args.batch_size, args.seq_len), 0, args.vocab)
+    data = (jax.device_put(true_x, batch_sharding), jax.device_put(txt, batch_sharding))
+    optimizer = optax.adam(1e-3)
+
+    def run(mode):
+        # min_bytes=inf reduces every leaf in float32, with the same per-replica
+        # split of the batch, which makes it the reference for the gradients
+        min_bytes = float("inf") if mode is None else args.min_bytes
+        compressor = gc.GradCompressor(dist_manager, mode or "bf16", min_bytes=min_bytes)
+        s = dict(state, grad_error=compressor.init(state["model"]))
+        grad_step = jax.jit(lambda s: compressor.value_and_grad(
+            dar.ardm_loss, s["model"], data, s["prng_key"], s["grad_error"])[1])
+        step = dc.update_state_dict_compressed.lower(
+            s, data, optimizer, dar.ardm_loss, compressor).compile()
+        collectives = du.collective_stats(step.as_text())
+        t, _ = timed(lambda: step(s, data)[0], repeats=args.repeats)
+        grads = grad_step(s)
+        for _ in range(args.steps):
+            loss, s = step(s, data)
+        return t, collectives, grads, float(loss)
+
+    def describe(collectives):
+        return ", ".join(f"{op} {entry['bytes'] / 2**20:.2f}MiB" for op, entry in collectives.items())
+
+    t, collectives, expected, loss = run(None)
+    print(f"float32: step {t*1000:.0f}ms, loss after {args.steps} steps {loss:.5f}, {describe(collectives)}")
+    norm = sum(float(jnp.sum(g**2)) for g in jax.tree_util.tree_leaves(expected))**0.5
+    for mode in gc.MODES:
+        t, collectives, grads, loss = run(mode)
+        error = sum(float(jnp.sum((g - e)**2)) for g, e in zip(
+            jax.tree_util.tree_leaves(grads), jax.tree_util.tree_leaves(expected)))**0.5
+        print(f"{mode}: step {t*1000:.0f}ms, loss after {args.steps} steps {loss:.5f}, "
+              f"gradient relative error {error / norm:.2e}, {describe(collectives)}")
+
+def bench_pipeline(args):
+    n_devices = len(jax.devices())
+    for pp in args.stages:
+        dist_manager = du.DistManager((pp, n_devices // pp, 1, 1), fs.memoryfs.MemoryFS())
+        model = dist_manager.init_model(lambda key: dard.TransformerARDM(
+            dist_manager, key, res_dim=args.res_dim, io_dim=args.res_dim, vocab=args.vocab,
+            n_layers=args.n_layers, mlp_dim=args.mlp_dim, qk_dim=args.qk_dim,
+            v_dim=args.qk_dim, n_head=args.n_head, n_microbatches=args.n_microbatches),
+            jax.random.PRNGKey(0))
+        batch_sharding = dist_manager.sharding(jax.sharding.PartitionSpec("dp"))
+        key = jax.random.PRNGKey(1)
+        true_x = jax.random.normal(key, (args.batch_size, args.seq_len, args.res_dim))
+        txt = jax.random.randint(key, (args.batch_size, args.seq_len), 0, args.vocab)
+        data = (jax.device_put(true_x, batch_sharding), jax.device_put(txt, batch_sharding))
+
+        grad_step = jax.jit(jax.value_and_grad(dar.ardm_loss))
+        grad_step(model, data, key)
+        t, _ = timed(grad_step, model, data, key, repeats=args.repeats)
+        bubble = du.bubble_fraction(pp, args.n_microbatches) if pp > 1 else 0
+        print(f"{pp} stages x dp {n_devices // pp}: forward and backward {t*1000:.0f}ms, "
+              f"{args.batch_size / t:.1f} examples/s, bubble fraction {bubble:.1%}")
+
+def bench_attention(args):
+    n_devices = len(jax.devices())
+    dist_manager = du.DistManager((n_devices, 1, 1), fs.memoryfs.MemoryFS())
+    batch_sharding = dist_manager.sharding(jax.sharding.PartitionSpec("dp"))
+    key = jax.random.PRNGKey(0)
+    for seq_len in args.seq_lens:
+        x = jax.device_put(jax.random.normal(key, (n_devices, seq_len, args.res_dim)), batch_sharding)
+        line = [f"seq_len {seq_len}:"]
+        for block_size in [None] + args.block_sizes:
+            layer = dl.ShrdMHAttention(dist_manager, key, args.res_dim, args.n_head,
+                                       args.qk_dim, args.qk_dim, block_size=block_size)
+            loss = lambda layer, x: jnp.sum(jax.vmap(layer)(x)**2)
+            step = jax.jit(jax.grad(loss)).lower(layer, x).compile()
+            t, _ = timed(step, layer, x, repeats=args.repeats)
+            temp = step.memory_analysis().temp_size_in_bytes
+            name = "dense" if block_size is None else f"block {block_size}"
+            line.append(f"{name} {t*1000:.0f}ms {temp / 2**20:.1f}MiB")
+        print(" ".join(line[:1]) + " " + ", ".join(line[1:]))
+
+def bench_ring(args):
+    n_devices = len(jax.devices())
+    key = jax.random.PRNGKey(0)
+    for seq_len in args.seq_lens:
+        line = [f"seq_len {seq_len}:"]
+        for sp in args.sp_sizes:
+            # One example per dp row, its positions split over sp
+            dp = n_devices // sp
+            dist_manager = du.DistManager((1, dp, sp, 1, 1), fs.memoryfs.MemoryFS())
+            x_sharding = dist_manager.sharding(jax.sharding.PartitionSpec("dp", "sp"))
+            x = jax.device_put(jax.random.normal(key, (dp, seq_len, args.res_dim)), x_sharding)
+            layer = dl.ShrdMHAttention(dist_manager, key, args.res_dim, args.n_head,
+                                       args.qk_dim, args.qk_dim)
+            loss = lambda layer, x: jnp.sum(jax.vmap(layer, spmd_axis_name="dp")(x)**2)
+            step = jax.jit(jax.grad(loss)).lower(layer, x).compile()
+            t, _ = timed(step, layer, x, repeats=args.repeats)
+            temp = step.memory_analysis().temp_size_in_bytes
+            line.append(f"sp {sp} {t*1000:.0f}ms {temp / 2**20:.1f}MiB")
+        print(" ".join(line[:1]) + " " + ", ".join(line[1:]))
+
+def bench_cache(args):
+    n_devices = len(jax.devices())
+    dist_manager = du.DistManager((n_devices, 1, 1), fs.memoryfs.MemoryFS())
+    model = dist_manager.init_model(lambda key: dard.TransformerARDM(
+        dist_manager, key, res_dim=args.res_dim, io_dim=args.res_dim, vocab=args.vocab,
+        n_layers=args.n_layers, mlp_dim=args.mlp_dim, qk_dim=args.qk_dim,
+        v_dim=args.qk_dim, n_head=args.n_head), jax.random.PRNGKey(0))
+    batch_sharding = dist_manager.sharding(jax.sharding.PartitionSpec("dp"))
+    key = jax.random.PRNGKey(1)
+    n_x = args.n_frames * args.frame_len
+    txt = jax.device_put(jax.random.randint(key, (n_devices, args.txt_len), 0, args.vocab), batch_sharding)
+    true_x = jax.device_put(jax.random.normal(key, (n_devices, n_x, args.res_dim)), batch_sharding)
+
+    # One denoising step of frame t, given frames before it
+    full = jax.jit(lambda model, true_x, txt: jax.vmap(model)(true_x, true_x, txt))
+    extend = jax.jit(lambda model, cache, x: jax.vmap(model.extend)(cache, x, x))
+    prefill = jax.jit(lambda model, txt: jax.vmap(lambda txt: model.prefill(txt, args.txt_len + n_x))(txt))
+
+    cache = prefill(model, txt)
+    for t in range(args.n_frames):
+        x = true_x[:, :(t + 1)*args.frame_len]
+        full(model, x, txt)
+        t_full, _ = timed(full, model, x, txt, repeats=args.repeats)
+        frame = true_x[:, t*args.frame_len:(t + 1)*args.frame_len]
+        extend(model, cache, frame)
+        t_cached, (_, cache) = timed(extend, model, cache, frame, repeats=args.repeats)
+        print(f"frame {t}: full sequence {t_full*1000:.0f}ms, cached {t_cached*1000:.0f}ms")
+
+def checkpoint_bytes(filesystem):
+    return sum(info.size for _, info in filesystem.walk.info(namespaces=["details"]) if info.is_file)
+
+def bench_checkpoint(args):
+    dist_manager = du.DistManager(
+        args.mesh_shape, fs.memoryfs.MemoryFS(), compression=args.compression)
+
+    t, state = timed(make_state, dist_manager, args)
+    leaves = jax.tree_util.tree_leaves(state)
+    state_bytes = sum(leaf.nbytes for leaf in leaves)
+    print(f"{args.model} state with {args.n_layers} layers, {len(leaves)} leaves, "
+          f"{state_bytes / 2**20:.1f}MiB, built in {t:.2f}s")
+
+    sharding = dist_manager.get_pytree_sharding(state)
+    if args.sharded:
+        save = lambda: dist_manager.save_pytree_sharded(state, sharding, "/ckpt")
+        load = lambda: dist_manager.load_pytree_sharded(sharding, "/ckpt")
+    else:
+        save = lambda: dist_manager.save_pytree(state, sharding, "/ckpt.pkl")
+        load = lambda: dist_manager.load_pytree(sharding, "/ckpt.pkl")
+
+    # The first call includes compilation, later ones hit the compile cache
+    for name, f in [("save", save), ("load", load)]:
+        first, _ = timed(f)
+        warm, _ = timed(f, repeats=args.repeats)
+        print(f"{name}: first {first:.2f}s, warm {warm:.2f}s "
+              f"({state_bytes / 2**20 / warm:.0f}MiB/s)")
+    print(f"checkpoint size: {checkpoint_bytes(dist_manager.fs) / 2**20:.1f}MiB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mesh_shape", type=int, nargs=3, default=[8, 1, 1])
+    parser.add_argument("--repeats", type=int, default=3)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    checkpoint_parser = subparsers.add_parser("checkpoint", help="save and load of a training state")
+    checkpoint_parser.add_argument("--model", choices=["ardm", "dae"], default="ardm")
+    checkpoint_parser.add_argument("--compression", default=None, help="e.g. zlib")
+    checkpoint_parser.add_argument("--n_layers", type=int, default=64)
+    checkpoint_parser.add_argument("--res_dim", type=int, default=256)
+    checkpoint_parser.add_argument("--mlp_dim", type=int, default=512)
+    checkpoint_parser.add_argument("--qk_dim", type=int, default=32)
+    checkpoint_parser.add_argument("--n_head", type=int, default=8)
+    checkpoint_parser.add_argument("--vocab", type=int, default=256)
+    checkpoint_parser.add_argument("--k", type=int, default=4, help="DAE width multiplier")
+    checkpoint_parser.add_argument("--sharded", action="store_true", help="use the sharded checkpoint format")
+    checkpoint_parser.set_defaults(f=bench_checkpoint)
+
+    gather_parser = subparsers.add_parser("gather", help="device to host copy of a training state")
+    gather_parser.add_argument("--model", choices=["ardm", "dae"], default="ardm")
+    gather_parser.add_argument("--n_layers", type=int, default=64)
+    gather_parser.add_argument("--res_dim", type=int, default=256)
+    gather_parser.add_argument("--mlp_dim", type=int, default=512)
+    gather_parser.add_argument("--qk_dim", type=int, default=32)
+    gather_parser.add_argument("--n_head", type=int, default=8)
+    gather_parser.add_argument("--vocab", type=int, default=256)
+    gather_parser.add_argument("--k", type=int, default=4, help="DAE width multiplier")
+    gather_parser.set_defaults(f=bench_gather)
+
+    offload_parser = subparsers.add_parser("offload", help="optimizer step with host offloaded state")
+    offload_parser.add_argument("--model", choices=["ardm", "dae"], default="ardm")
+    offload_parser.add_argument("--n_layers", type=int, default=64)
+    offload_parser.add_argument("--res_dim", type=int, default=256)
+    offload_parser.add_argument("--mlp_dim", type=int, default=512)
+    offload_parser.add_argument("--qk_dim", type=int, default=32)
+    offload_parser.add_argument("--n_head", type=int, default=8)
+    offload_parser.add_argument("--vocab", type=int, default=256)
+    offload_parser.add_argument("--k", type=int, default=4, help="DAE width multiplier")
+    offload_parser.add_argument("--group_bytes", type=int, nargs="+", default=[2**22, 2**24, 2**26])
+    offload_parser.set_defaults(f=bench_offload)
+
+    grads_parser = subparsers.add_parser("grads", help="TransformerARDM step with compressed gradient reduction")
+    grads_parser.add_argument("--n_layers", type=int, default=8)
+    grads_parser.add_argument("--res_dim", type=int, default=256)
+    grads_parser.add_argument("--mlp_dim", type=int, default=512)
+    grads_parser.add_argument("--qk_dim", type=int, default=32)
+    grads_parser.add_argument("--n_head", type=int, default=8)
+    grads_parser.add_argument("--vocab", type=int, default=256)
+    grads_parser.add_argument("--batch_size", type=int, default=16)
+    grads_parser.add_argument("--seq_len", type=int, default=64)
+    grads_parser.add_argument("--steps", type=int, default=20)
+    grads_parser.add_argument("--min_bytes", type=int, default=2**16)
+    grads_parser.set_defaults(f=bench_grads)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="TransformerARDM training step per pipeline stage count")
+    pipeline_parser.add_argument("--stages", type=int, nargs="+", default=[1, 2, 4, 8])
+    pipeline_parser.add_argument("--n_microbatches", type=int, default=8)
+    pipeline_parser.add_argument("--n_layers", type=int, default=16)
+    pipeline_parser.add_argument("--res_dim", type=int, default=256)
+    pipeline_parser.add_argument("--mlp_dim", type=int, default=512)
+    pipeline_parser.add_argument("--qk_dim", type=int, default=32)
+    pipeline_parser.add_argument("--n_head", type=int, default=8)
+    pipeline_parser.add_argument("--vocab", type=int, default=256)
+    pipeline_parser.add_argument("--batch_size", type=int, default=64)
+    pipeline_parser.add_argument("--seq_len", type=int, default=64)
+    pipeline_parser.set_defaults(f=bench_pipeline)
+
+    attention_parser = subparsers.add_parser("attention", help="ShrdMHAttention forward and backward per sequence length")
+    attention_parser.add_argument("--seq_lens", type=int, nargs="+", default=[256, 512, 1024, 2048])
+    attention_parser.add_argument("--block_sizes", type=int, nargs="+", default=[128, 256])
+    attention_parser.add_argument("--res_dim", type=int, default=256)
+    attention_parser.add_argument("--qk_dim", type=int, default=64)
+    attention_parser.add_argument("--n_head", type=int, default=8)
+    attention_parser.add_argument("--repeats", type=int, default=3)
+    attention_parser.set_defaults(f=bench_attention)
+
+    ring_parser = subparsers.add_parser("ring", help="ShrdMHAttention forward and backward per sequence parallel size")
+    ring_parser.add_argument("--seq_lens", type=int, nargs="+", default=[1024, 2048])
+    ring_parser.add_argument("--sp_sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    ring_parser.add_argument("--res_dim", type=int, default=256)
+    ring_parser.add_argument("--qk_dim", type=int, default=64)
+    ring_parser.add_argument("--n_head", type=int, default=8)
+    ring_parser.add_argument("--repeats", type=int, default=3)
+    ring_parser.set_defaults(f=bench_ring)
+
+    cache_parser = subparsers.add_parser("cache", help="TransformerARDM step per frame with and without the key/value cache")
+    cache_parser.add_argument("--n_frames", type=int, default=16)
+    cache_parser.add_argument("--frame_len", type=int, default=64)
+    cache_parser.add_argument("--txt_len", type=int, default=64)
+    cache_parser.add_argument("--n_layers", type=int, default=8)
+    cache_parser.add_argument("--res_dim", type=int, default=256)
+    cache_parser.add_argument("--mlp_dim", type=int, default=512)
+    cache_parser.add_argument("--qk_dim", type=int, default=32)
+    cache_parser.add_argument("--n_head", type=int, default=8)
+    cache_parser.add_argument("--vocab", type=int, default=256)
+    cache_parser.add_argument("--repeats", type=int, default=3)
+    cache_parser.set_defaults(f=bench_cache)
+
+    init_parser = subparsers.add_parser("init", help="TransformerARDM construction")
+    init_parser.add_argument("--n_layers", type=int, default=64)
+    init_parser.add_argument("--res_dim", type=int, default=256)
+    init_parser.add_argument("--mlp_dim", type=int, default=512)
+    init_parser.add_argument("--qk_dim", type=int, default=32)
+    init_parser.add_argument("--n_head", type=int, default=8)
+    init_parser.add_argument("--vocab", type=int, default=256)
+    init_parser.add_argument("--skip_eager", action="store_true")
+    init_parser.set_defaults(f=bench_init)
+
+    args = parser.parse_args()
+    args.f(args)
+
+if __name__ == "__main__":
+    main()
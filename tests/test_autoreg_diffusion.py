@@ -1,6 +1,9 @@
+import pickle
 import pytest
+import numpy as np
 import jax
 import jax.numpy as jnp
+import fs.memoryfs
 
 import monkfish.lvd.models.dist_layers as dl
 import monkfish.lvd.models.dist_utils as du
@@ -51,4 +54,142 @@ def test_save_load_consistency(dist_manager, prng_key, input_image):
     denoise_reloaded = transformer_ardm_reloaded(true_x, noise_x, txt)
 
     # Check that the outputs after reload are consistent with the initial outputs
-    assert jnp.allclose(denoise_initial, denoise_reloaded, atol=1e-5), "TransformerARDM outputs do not match after reload."
\ No newline at end of file
+    assert jnp.allclose(denoise_initial, denoise_reloaded, atol=1e-5), "TransformerARDM outputs do not match after reload."
+
+def test_transformer_ardm_init_model(dist_manager, prng_key):
+    make_model = lambda key: dad.TransformerARDM(dist_manager, key, res_dim=128, 
+            io_dim=128, vocab=128, n_layers=2, mlp_dim=256, qk_dim=128, v_dim=128, n_head=8)
+    eager = make_model(prng_key)
+    traced = dist_manager.init_model(make_model, prng_key)
+
+    for x, y in zip(jax.tree_util.tree_leaves(eager), jax.tree_util.tree_leaves(traced)):
+        assert x.shape == y.shape
+        assert x.sharding == y.sharding
+
+    txt = jnp.ones((128,))
+    noise_x = jax.random.normal(prng_key,(128, 128))
+    true_x = jax.random.normal(prng_key,(128, 128))
+    assert traced(true_x, noise_x, txt).shape == eager(true_x, noise_x, txt).shape
+
+def test_transformer_ardm_pipeline(prng_key):
+    dist_manager = du.DistManager((2, 4, 1, 1), fs.memoryfs.MemoryFS())
+    make_model = lambda key: dad.TransformerARDM(dist_manager, key, res_dim=64, 
+            io_dim=32, vocab=16, n_layers=4, mlp_dim=128, qk_dim=16, v_dim=16, n_head=2,
+            n_microbatches=2)
+    model = dist_manager.init_model(make_model, prng_key)
+    assert model.pipelined
+    assert model.layers.attn.qkv.shape == (2, 2, 2, 64, 48)
+    assert model.layers.attn.qkv.sharding.spec[0] == "pp"
+
+    txt = jax.random.randint(prng_key, (8, 5), 0, 16)
+    noise_x = jax.random.normal(prng_key, (8, 12, 32))
+    true_x = jax.random.normal(prng_key, (8, 12, 32))
+    pipelined = jax.jit(lambda model: model.apply_batch(true_x, noise_x, txt))(model)
+    sequential = jax.jit(lambda model: jax.vmap(model)(true_x, noise_x, txt))(model)
+    assert jnp.allclose(pipelined, sequential, rtol=1e-4, atol=1e-3)
+
+@pytest.mark.parametrize("mesh_shape", [(4, 2, 1), (2, 1, 4, 1)])
+def test_transformer_ardm_cache(prng_key, mesh_shape):
+    dist_manager = du.DistManager(mesh_shape, fs.memoryfs.MemoryFS())
+    make_model = lambda key: dad.TransformerARDM(dist_manager, key, res_dim=64, 
+            io_dim=32, vocab=16, n_layers=4, mlp_dim=128, qk_dim=16, v_dim=16, n_head=4)
+    model = dist_manager.init_model(make_model, prng_key)
+
+    txt = jax.random.randint(prng_key, (5,), 0, 16)
+    noise_x = jax.random.normal(prng_key, (12, 32))
+    true_x = jax.random.normal(jax.random.split(prng_key)[0], (12, 32))
+    expected = jax.jit(lambda model: model(true_x, noise_x, txt))(model)
+
+    cache = jax.jit(lambda model: model.prefill(txt, 20))(model)
+    extend = jax.jit(lambda model, cache, true_x, noise_x: model.extend(cache, true_x, noise_x))
+    # Running a frame without keeping its cache leaves the cache as it was
+    extend(model, cache, true_x[:4], jnp.zeros((4, 32)))
+    outputs = []
+    for frame in range(3):
+        y, cache = extend(model, cache, true_x[4*frame:4*frame + 4], noise_x[4*frame:4*frame + 4])
+        outputs.append(y)
+    assert cache["length"] == 17
+    assert jnp.allclose(jnp.concatenate(outputs), expected, rtol=1e-4, atol=1e-4 * jnp.max(jnp.abs(expected)))
+
+    layer_cache = cache["layers"] if model.pipelined else cache["layers"][0]
+    assert layer_cache["k"].shape[-3:] == (4, 20, 16)
+    assert "mp" in layer_cache["k"].sharding.spec
+
+    # Positions past max_len would be clamped into the cache, they're NaN 
+    # instead and the cache is left as it was
+    y, overflowed = extend(model, cache, true_x[:4], noise_x[:4])
+    assert jnp.all(jnp.isnan(y))
+    for x, y in zip(jax.tree_util.tree_leaves(cache), jax.tree_util.tree_leaves(overflowed)):
+        assert jnp.array_equal(x, y)
+    with pytest.raises(ValueError):
+        model.prefill(jnp.zeros((21,), jnp.int32), 20)
+
+def test_transformer_ardm_sequence_parallel(prng_key):
+    dist_manager = du.DistManager((1, 2, 4, 1, 1), fs.memoryfs.MemoryFS())
+    make_model = lambda key: dad.TransformerARDM(dist_manager, key, res_dim=64, 
+            io_dim=32, vocab=16, n_layers=2, mlp_dim=128, qk_dim=16, v_dim=16, n_head=4)
+    model = dist_manager.init_model(make_model, prng_key)
+    assert model.sequence_parallel
+
+    txt = jax.random.randint(prng_key, (2, 5), 0, 16)
+    noise_x = jax.random.normal(prng_key, (2, 14, 32))
+    true_x = jax.random.normal(jax.random.split(prng_key)[0], (2, 14, 32))
+    y = jax.jit(lambda model: model.apply_batch(true_x, noise_x, txt))(model)
+
+    # The cache path attends densely
+    def dense(model, true_x, noise_x, txt):
+        return model.extend(model.prefill(txt, 19), true_x, noise_x)[0]
+    expected = jax.jit(jax.vmap(dense, in_axes=(None, 0, 0, 0)))(model, true_x, noise_x, txt)
+    assert jnp.allclose(y, expected, rtol=1e-4, atol=1e-4 * jnp.max(jnp.abs(expected)))
+
+    grads = jax.jit(jax.grad(lambda model: jnp.mean(model.apply_batch(true_x, noise_x, txt)**2)))(model)
+    assert all(jnp.all(jnp.isfinite(g)) for g in jax.tree_util.tree_leaves(grads))
+
+def test_fuse_qkv_checkpoint(dist_manager, prng_key):
+    model = dad.TransformerARDM(dist_manager, prng_key, res_dim=64, 
+            io_dim=32, vocab=16, n_layers=2, mlp_dim=128, qk_dim=16, v_dim=8, n_head=4)
+    state = {"model": model, "opt_state": model}
+
+    # The same state with the earlier separate q, k and v attention weights
+    separate = {}
+    for path, leaf in jax.tree_util.tree_flatten_with_path(state)[0]:
+        name = du.leaf_path(path)
+        if name.endswith("/qkv"):
+            for part, array in zip("qkv", jnp.split(leaf, [16, 32], axis=-1)):
+                separate[name[:-3] + part] = array
+        else:
+            separate[name] = leaf
+    assert "model/layers/0/attn/q" in separate
+    dist_manager.save_pytree_sharded(separate, dist_manager.get_pytree_sharding(separate), "/separate")
+
+    fused = dl.fuse_qkv_checkpoint(dist_manager, "/separate", "/fused")
+    assert fused == sorted(f"{tree}/layers/{i}/attn/qkv" for tree in state for i in range(2))
+    sharding_pytree = dist_manager.get_pytree_sharding(state)
+    loaded = dist_manager.load_pytree_sharded(sharding_pytree, "/fused")
+    for x, y in zip(jax.tree_util.tree_leaves(state), jax.tree_util.tree_leaves(loaded)):
+        assert jnp.array_equal(x, y)
+        assert x.sharding.is_equivalent_to(y.sharding, x.ndim)
+
+def test_fuse_qkv_checkpoint_pickle(dist_manager, prng_key):
+    model = dad.TransformerARDM(dist_manager, prng_key, res_dim=64, 
+            io_dim=32, vocab=16, n_layers=2, mlp_dim=128, qk_dim=16, v_dim=8, n_head=4)
+    state = {"model": model, "opt_state": model}
+
+    # ckpt.pkl as the earlier layout's save_pytree wrote it: a pickled list of
+    # float32 leaves, the attention modules' q, k and v first of their fields
+    old_leaves = []
+    for path, leaf in jax.tree_util.tree_flatten_with_path(state)[0]:
+        if du.leaf_path(path).endswith("/qkv"):
+            old_leaves.extend(jnp.split(leaf, [16, 32], axis=-1))
+        else:
+            old_leaves.append(leaf)
+    with dist_manager.fs.makedirs("/separate").openbin("ckpt.pkl", "w") as blob:
+        blob.write(pickle.dumps([np.asarray(leaf, np.float32) for leaf in old_leaves]))
+
+    with pytest.raises(ValueError):
+        dl.fuse_qkv_checkpoint(dist_manager, "/separate", "/fused")
+    fused = dl.fuse_qkv_checkpoint(dist_manager, "/separate", "/fused", state)
+    assert fused == sorted(f"{tree}/layers/{i}/attn/qkv" for tree in state for i in range(2))
+    loaded = dist_manager.load_pytree(dist_manager.get_pytree_sharding(state), "/fused/ckpt.pkl")
+    for x, y in zip(jax.tree_util.tree_leaves(state), jax.tree_util.tree_leaves(loaded)):
+        assert jnp.array_equal(x, y)
@@ -1,9 +1,15 @@
+import json
+import pickle
+
 import pytest
+import numpy as np
+import optax
 import jax
 import jax.numpy as jnp
 import jax.sharding as shrd
 import equinox as eqx
 import fs.memoryfs
+import fs.osfs
 import monkfish.lvd.models.dist_utils as du
 
 @pytest.fixture
@@ -147,4 +153,630 @@ def test_get_pytree_sharding_spec(dist_manager):
     assert sharding_spec_pytree['c'] is None
     
     assert isinstance(sharding_spec_pytree['d']['e'], shrd.PartitionSpec)
-    assert sharding_spec_pytree['d']['e'] == shrd.PartitionSpec('mp')
\ No newline at end of file
+    assert sharding_spec_pytree['d']['e'] == shrd.PartitionSpec('mp')
+
+
+@pytest.mark.parametrize("spec", [
+    shrd.PartitionSpec(),
+    shrd.PartitionSpec("dp", None),
+    shrd.PartitionSpec(None, "dp"),
+])
+def test_scatter_gather_chunked(dist_manager, spec):
+    sharding = dist_manager.sharding(spec)
+    x = np.arange(16*24, dtype=np.float32).reshape(16, 24)
+
+    # 3 rows per chunk, so chunks straddle shard boundaries
+    scattered = dist_manager.scatter_chunked(sharding, jnp.float32, chunk_bytes=3*24*4)(x)
+    assert scattered.sharding == sharding
+    assert jnp.array_equal(scattered, x)
+
+    chunks = list(dist_manager.gather_chunks(scattered, sharding, jnp.float32, chunk_bytes=3*24*4))
+    assert [len(c) for c in chunks] == [3, 3, 3, 3, 3, 1]
+
+    gathered = dist_manager.gather_chunked(sharding, jnp.float32, chunk_bytes=3*24*4)(scattered)
+    assert np.array_equal(gathered, x)
+
+def test_scatter_gather_chunked_scalar(dist_manager):
+    sharding = dist_manager.uniform_sharding
+    x = np.array(3.5, dtype=np.float32)
+    scattered = dist_manager.scatter_chunked(sharding, jnp.float32, chunk_bytes=1)(x)
+    gathered = dist_manager.gather_chunked(sharding, jnp.float32, chunk_bytes=1)(scattered)
+    assert gathered.shape == ()
+    assert gathered == 3.5
+
+def test_save_load_pytree_chunked(dist_manager, tmp_path):
+    dist_manager.chunk_bytes = 64
+    file_name = str(tmp_path / "test_pytree.pkl")
+    sharding = dist_manager.sharding(shrd.PartitionSpec("dp"))
+    pytree = {
+        "a": jax.device_put(jnp.arange(64*3, dtype=jnp.float32).reshape(64, 3), sharding),
+        "b": jax.device_put(jnp.float32(2.0), dist_manager.uniform_sharding)
+    }
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+
+    dist_manager.save_pytree(pytree, sharding_pytree, file_name)
+    loaded_pytree = dist_manager.load_pytree(sharding_pytree, file_name)
+
+    assert jnp.array_equal(pytree["a"], loaded_pytree["a"])
+    assert loaded_pytree["a"].sharding == sharding
+    assert loaded_pytree["b"] == 2.0
+
+def test_load_pytree_legacy_pickle(dist_manager):
+    with dist_manager.fs.openbin("legacy.pkl", "w") as blob:
+        blob.write(pickle.dumps([np.ones(4, dtype=np.float32), np.zeros((2, 2), dtype=np.float32)]))
+    sharding_pytree = {"a": dist_manager.uniform_sharding, "b": dist_manager.uniform_sharding}
+
+    loaded_pytree = dist_manager.load_pytree(sharding_pytree, "legacy.pkl")
+    assert jnp.array_equal(loaded_pytree["a"], jnp.ones(4))
+    assert jnp.array_equal(loaded_pytree["b"], jnp.zeros((2, 2)))
+
+def test_scatter_gather_pytree(dist_manager):
+    dp_sharding = dist_manager.sharding(shrd.PartitionSpec("dp"))
+    pytree = {
+        "a": np.arange(16*4, dtype=np.float32).reshape(16, 4),
+        "b": np.ones((8,), dtype=np.float16),
+        "c": np.float32(1.5),
+        "big": np.arange(64*8, dtype=np.float32).reshape(64, 8),
+    }
+    sharding_pytree = {"a": dp_sharding, "b": dist_manager.uniform_sharding,
+                       "c": dist_manager.uniform_sharding, "big": dp_sharding}
+
+    # "a", "b" and "c" share one bucket, "big" is streamed on its own
+    buckets = list(dist_manager._buckets([256, 32, 2048, 4], 512))
+    assert buckets == [([0, 1], False), ([2], True), ([3], False)]
+
+    scattered = dist_manager.scatter_pytree(pytree, sharding_pytree, chunk_bytes=512)
+    assert scattered["a"].sharding == dp_sharding
+    assert scattered["b"].dtype == jnp.float32
+    assert scattered["big"].sharding == dp_sharding
+
+    gathered = dist_manager.gather_pytree(scattered, sharding_pytree, chunk_bytes=512)
+    for k in pytree:
+        assert isinstance(gathered[k], np.ndarray)
+        assert np.array_equal(gathered[k], pytree[k])
+
+def test_transfer_cache_reused(dist_manager, tmp_path):
+    file_name = str(tmp_path / "test_pytree.pkl")
+    sharding = dist_manager.sharding(shrd.PartitionSpec("dp"))
+    pytree = [jax.device_put(jnp.full((8, 2), i, dtype=jnp.float32), sharding) for i in range(10)]
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+
+    dist_manager.save_pytree(pytree, sharding_pytree, file_name)
+    dist_manager.load_pytree(sharding_pytree, file_name)
+    n_compiled = len(dist_manager._transfer_cache)
+
+    dist_manager.save_pytree(pytree, sharding_pytree, file_name)
+    loaded = dist_manager.load_pytree(sharding_pytree, file_name)
+    assert len(dist_manager._transfer_cache) == n_compiled
+    assert all(jnp.array_equal(x, y) for x, y in zip(pytree, loaded))
+
+def make_sharded_state(dist_manager):
+    dp_sharding = dist_manager.sharding(shrd.PartitionSpec("dp", None))
+    return {
+        "model": {
+            "w": jax.device_put(jnp.arange(16*3, dtype=jnp.float32).reshape(16, 3), dp_sharding),
+            "b": jax.device_put(jnp.ones((3,), dtype=jnp.bfloat16), dist_manager.uniform_sharding),
+        },
+        "count": jax.device_put(jnp.int32(7), dist_manager.uniform_sharding),
+    }
+
+def test_save_load_pytree_sharded(dist_manager):
+    pytree = make_sharded_state(dist_manager)
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+
+    dist_manager.save_pytree_sharded(pytree, sharding_pytree, "/ckpt_1")
+    assert dist_manager.is_sharded_checkpoint("/ckpt_1")
+
+    with dist_manager.fs.open("/ckpt_1/model/w/meta.json", "r") as f:
+        meta = json.load(f)
+    assert meta == {"shape": [16, 3], "dtype": "float32", "chunks": [2, 3], "spec": ["dp", None],
+                    "compression": None}
+    with dist_manager.fs.open("/ckpt_1/index.json", "r") as f:
+        assert json.load(f)["arrays"]["count"]["dtype"] == "int32"
+
+    # One chunk per shard, replicated arrays are written once
+    assert sorted(dist_manager.fs.listdir("/ckpt_1/model/w")) == [f"{i}.0.npy" for i in range(8)] + ["meta.json"]
+    assert sorted(dist_manager.fs.listdir("/ckpt_1/model/b")) == ["0.npy", "meta.json"]
+    assert dist_manager.fs.exists("/ckpt_1/count/0.npy")
+
+    loaded = dist_manager.load_pytree_sharded(sharding_pytree, "/ckpt_1")
+    for x, y in zip(jax.tree_util.tree_leaves(pytree), jax.tree_util.tree_leaves(loaded)):
+        assert x.dtype == y.dtype
+        assert x.sharding == y.sharding
+        assert jnp.array_equal(x, y)
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_load_pytree_sharded_reshard(tmp_path, compression, on_disk):
+    filesystem = fs.osfs.OSFS(str(tmp_path)) if on_disk else fs.memoryfs.MemoryFS()
+    dist_manager = du.DistManager((8, 1, 1), filesystem, compression=compression)
+    pytree = make_sharded_state(dist_manager)
+    pytree["model"]["v"] = jax.device_put(
+        jnp.arange(8*8, dtype=jnp.bfloat16).reshape(8, 8), 
+        dist_manager.sharding(shrd.PartitionSpec(None, "dp")))
+    dist_manager.save_pytree_sharded(pytree, dist_manager.get_pytree_sharding(pytree), "/ckpt_1")
+
+    # Resume on a different mesh layout, with rows of w spanning two chunks 
+    # and the column chunks of v cut into blocks
+    new_manager = du.DistManager((2, 2, 2), filesystem)
+    sharding_pytree = {
+        "model": {
+            "w": new_manager.sharding(shrd.PartitionSpec(("mp", "fsdp"), None)),
+            "b": new_manager.uniform_sharding,
+            "v": new_manager.sharding(shrd.PartitionSpec("dp", ("mp", "fsdp"))),
+        },
+        "count": new_manager.uniform_sharding,
+    }
+    loaded = new_manager.load_pytree_sharded(sharding_pytree, "/ckpt_1")
+    for name in ["w", "b", "v"]:
+        assert loaded["model"][name].sharding == sharding_pytree["model"][name]
+        assert loaded["model"][name].dtype == pytree["model"][name].dtype
+        assert jnp.array_equal(loaded["model"][name], pytree["model"][name])
+    assert loaded["count"] == 7
+
+    # Fewer, larger chunks read back into smaller shards
+    new_manager.save_pytree_sharded(loaded, sharding_pytree, "/ckpt_2")
+    resharded = dist_manager.load_pytree_sharded(
+        dist_manager.get_pytree_sharding(pytree), "/ckpt_2")
+    assert jnp.array_equal(resharded["model"]["w"], pytree["model"]["w"])
+    assert jnp.array_equal(resharded["model"]["v"], pytree["model"]["v"])
+
+def test_read_rows(dist_manager):
+    data = np.arange(6 * 4 * 2, dtype=np.float32).reshape(6, 4, 2)
+    with dist_manager.fs.openbin("/chunk.npy", "w") as f:
+        np.save(f, data)
+
+    index = (slice(2, 5), slice(1, 3), slice(None))
+    rows, rows_index = dist_manager._read_rows("/chunk.npy", index)
+    assert rows.shape == (3, 4, 2)
+    assert np.array_equal(rows[rows_index], data[index])
+
+def test_async_checkpointer(dist_manager):
+    pytree = make_sharded_state(dist_manager)
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+    checkpointer = du.AsyncCheckpointer(dist_manager, max_in_flight=2, poll_interval=0.01)
+
+    for step in range(3):
+        checkpointer.save(pytree, sharding_pytree, f"/ckpt_{step}")
+        assert len(checkpointer.in_flight) <= 2
+        # Training carries on, the snapshot already taken is unaffected
+        pytree = jax.tree_util.tree_map(lambda x: x + 1, pytree)
+    checkpointer.close()
+
+    for step in range(3):
+        assert dist_manager.is_committed(f"/ckpt_{step}")
+        assert dist_manager.fs.exists(f"/ckpt_{step}/done_0")
+    loaded = dist_manager.load_pytree_sharded(sharding_pytree, "/ckpt_1")
+    assert loaded["count"] == 8
+    assert jnp.array_equal(loaded["model"]["w"], jnp.arange(16*3).reshape(16, 3) + 1)
+
+def test_async_checkpointer_stale_attempt(dist_manager):
+    pytree = make_sharded_state(dist_manager)
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+    # An earlier attempt at the same checkpoint crashed after some markers
+    dist_manager.fs.makedirs("/ckpt_5/stale")
+    dist_manager.fs.writetext("/ckpt_5/done_0", "")
+    dist_manager.fs.writetext("/ckpt_5/stale/0.npy", "")
+
+    checkpointer = du.AsyncCheckpointer(dist_manager, poll_interval=0.01)
+    checkpointer.save(pytree, sharding_pytree, "/ckpt_5")
+    checkpointer.close()
+    assert not dist_manager.fs.exists("/ckpt_5/stale")
+    assert dist_manager.is_committed("/ckpt_5")
+
+def test_async_checkpointer_resave_committed(dist_manager, monkeypatch):
+    pytree = make_sharded_state(dist_manager)
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+    checkpointer = du.AsyncCheckpointer(dist_manager, poll_interval=0.01)
+    checkpointer.save(pytree, sharding_pytree, "/ckpt_7")
+    checkpointer.wait()
+
+    # Re-saving the checkpoint resumed from, with an upload that dies half 
+    # way, keeps the committed one loadable
+    write_shards = dist_manager.write_shards
+    def fail(snapshot, dir_name):
+        write_shards({"arrays": snapshot["arrays"], "shards": snapshot["shards"][:1]}, dir_name)
+        raise OSError("upload failed")
+    monkeypatch.setattr(dist_manager, "write_shards", fail)
+    checkpointer.save(jax.tree_util.tree_map(lambda x: x + 1, pytree), sharding_pytree, "/ckpt_7")
+    checkpointer.close()
+
+    assert dist_manager.is_committed("/ckpt_7")
+    loaded = dist_manager.load_pytree_sharded(sharding_pytree, "/ckpt_7")
+    assert jnp.array_equal(loaded["model"]["w"], pytree["model"]["w"])
+
+def test_async_checkpointer_wait_error(dist_manager, monkeypatch):
+    pytree = make_sharded_state(dist_manager)
+    checkpointer = du.AsyncCheckpointer(dist_manager, poll_interval=0.01)
+    barriers = []
+    monkeypatch.setattr(dist_manager, "barrier", barriers.append)
+    def fail(snapshot, dir_name):
+        raise OSError("upload failed")
+    monkeypatch.setattr(dist_manager, "write_shards", fail)
+
+    checkpointer.save(pytree, dist_manager.get_pytree_sharding(pytree), "/ckpt_6")
+    with pytest.raises(OSError):
+        checkpointer.wait()
+    # The other processes are released even though this one failed
+    assert barriers[-1] == "async_checkpoint_wait"
+    checkpointer.executor.shutdown()
+
+def test_uncommitted_sharded_checkpoint(dist_manager):
+    pytree = make_sharded_state(dist_manager)
+    snapshot = dist_manager.snapshot_pytree_sharded(pytree, dist_manager.get_pytree_sharding(pytree))
+    dist_manager.write_shards(snapshot, "/ckpt_1")
+    assert not dist_manager.is_committed("/ckpt_1")
+    assert not dist_manager.is_sharded_checkpoint("/ckpt_1")
+
+    dist_manager.commit_sharded(snapshot, "/ckpt_1")
+    assert dist_manager.is_committed("/ckpt_1")
+
+def test_save_pytree_sharded_interrupted(dist_manager, monkeypatch):
+    pytree = make_sharded_state(dist_manager)
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+    dist_manager.save_pytree_sharded(pytree, sharding_pytree, "/ckpt_1")
+
+    # A re-save that dies after its first chunk leaves the committed one alone
+    write_shards = dist_manager.write_shards
+    def fail(snapshot, dir_name):
+        write_shards({"arrays": snapshot["arrays"], "shards": snapshot["shards"][:1]}, dir_name)
+        raise OSError("upload failed")
+    monkeypatch.setattr(dist_manager, "write_shards", fail)
+    newer = jax.tree_util.tree_map(lambda x: x + 1, pytree)
+    dist_manager.save_pytree_sharded(newer, sharding_pytree, "/ckpt_1")
+    loaded = dist_manager.load_pytree_sharded(sharding_pytree, "/ckpt_1")
+    assert jnp.array_equal(loaded["model"]["w"], pytree["model"]["w"])
+
+    # An attempt that dies before committing isn't a checkpoint, and a new
+    # attempt starts from an empty directory
+    with pytest.raises(OSError):
+        dist_manager.save_pytree_sharded(newer, sharding_pytree, "/ckpt_2")
+    assert not dist_manager.is_committed("/ckpt_2")
+    monkeypatch.setattr(dist_manager, "write_shards", write_shards)
+    dist_manager.fs.writetext("/ckpt_2/done_0", "")
+    dist_manager.save_pytree_sharded(newer, sharding_pytree, "/ckpt_2")
+    assert not dist_manager.fs.exists("/ckpt_2/done_0")
+    loaded = dist_manager.load_pytree_sharded(sharding_pytree, "/ckpt_2")
+    assert jnp.array_equal(loaded["model"]["w"], newer["model"]["w"])
+
+def test_load_pytree_sharded_filter(dist_manager):
+    pytree = make_sharded_state(dist_manager)
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+    dist_manager.save_pytree_sharded(pytree, sharding_pytree, "/ckpt_1")
+
+    loaded = dist_manager.load_pytree_sharded(sharding_pytree, "/ckpt_1", path_filter="model")
+    assert loaded["count"] is None
+    assert jnp.array_equal(loaded["model"]["w"], pytree["model"]["w"])
+
+    loaded = dist_manager.load_pytree_sharded(
+        sharding_pytree, "/ckpt_1", path_filter=lambda path: path.endswith("/b"))
+    assert loaded["model"]["w"] is None and loaded["count"] is None
+    assert loaded["model"]["b"].dtype == jnp.bfloat16
+
+    # Restore a subtree on its own
+    subtree = dist_manager.load_pytree_sharded(sharding_pytree["model"], "/ckpt_1", prefix="model")
+    assert jnp.array_equal(subtree["w"], pytree["model"]["w"])
+
+def test_load_pytree_sharded_memory_mapped(tmp_path, monkeypatch):
+    dist_manager = du.DistManager((8, 1, 1), fs.osfs.OSFS(str(tmp_path)))
+    pytree = make_sharded_state(dist_manager)
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+    dist_manager.save_pytree_sharded(pytree, sharding_pytree, "/ckpt_1")
+
+    mmap_modes = []
+    np_load = np.load
+    def load(*args, mmap_mode=None, **kwargs):
+        mmap_modes.append(mmap_mode)
+        return np_load(*args, mmap_mode=mmap_mode, **kwargs)
+    monkeypatch.setattr(np, "load", load)
+
+    loaded = dist_manager.load_pytree_sharded(sharding_pytree, "/ckpt_1")
+    assert mmap_modes and all(mode == "r" for mode in mmap_modes)
+    assert jnp.array_equal(loaded["model"]["w"], pytree["model"]["w"])
+
+def test_load_pytree_filter(dist_manager):
+    sharding = dist_manager.sharding(shrd.PartitionSpec("dp"))
+    pytree = {"model": jax.device_put(jnp.arange(64.), sharding),
+              "opt_state": jax.device_put(jnp.ones(64), sharding)}
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+    dist_manager.save_pytree(pytree, sharding_pytree, "ckpt.pkl")
+
+    loaded = dist_manager.load_pytree(sharding_pytree, "ckpt.pkl", path_filter="model")
+    assert loaded["opt_state"] is None
+    assert jnp.array_equal(loaded["model"], pytree["model"])
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_save_load_pytree_dtypes(dist_manager, compression):
+    dist_manager.compression = compression
+    dist_manager.chunk_bytes = 64
+    pytree = make_sharded_state(dist_manager)
+    pytree["key"] = dist_manager.get_key(3)
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+
+    dist_manager.save_pytree(pytree, sharding_pytree, "ckpt.pkl")
+    loaded = dist_manager.load_pytree(sharding_pytree, "ckpt.pkl")
+    for x, y in zip(jax.tree_util.tree_leaves(pytree), jax.tree_util.tree_leaves(loaded)):
+        assert x.dtype == y.dtype
+        assert jnp.array_equal(x, y)
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_save_load_array_dtypes(dist_manager, compression):
+    dist_manager.compression = compression
+    array = jnp.arange(8, dtype=jnp.int32)
+    dist_manager.save_array(array, dist_manager.uniform_sharding, "array.pkl")
+    loaded = dist_manager.load_array(dist_manager.uniform_sharding, "array.pkl")
+    assert loaded.dtype == jnp.int32
+    assert jnp.array_equal(loaded, array)
+
+def test_save_load_pytree_sharded_compressed(dist_manager):
+    dist_manager.compression = "zlib"
+    pytree = make_sharded_state(dist_manager)
+    pytree["zeros"] = jax.device_put(jnp.zeros((64, 64)), dist_manager.uniform_sharding)
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+    dist_manager.save_pytree_sharded(pytree, sharding_pytree, "/ckpt_1")
+
+    assert dist_manager.fs.getsize("/ckpt_1/zeros/0.0.npy.zlib") < 64 * 64 * 4 // 10
+    loaded = dist_manager.load_pytree_sharded(sharding_pytree, "/ckpt_1")
+    for x, y in zip(jax.tree_util.tree_leaves(pytree), jax.tree_util.tree_leaves(loaded)):
+        assert x.dtype == y.dtype
+        assert jnp.array_equal(x, y)
+
+def test_compressor():
+    compress, decompress = du.compressor("zlib")
+    assert decompress(compress(b"abc" * 100)) == b"abc" * 100
+    with pytest.raises(ValueError):
+        du.compressor("rar")
+
+def test_init_model():
+    dist_manager = du.DistManager((2, 2, 2), fs.memoryfs.MemoryFS())
+    row_sharding = dist_manager.sharding(shrd.PartitionSpec(("mp", "fsdp"), None))
+
+    class Model(eqx.Module):
+        w: jax.Array
+        v: jax.Array
+        b: jax.Array
+        c: jax.Array
+        scale: float = eqx.field(static=True)
+
+        def __init__(self, key):
+            key1, key2, key3 = jax.random.split(key, 3)
+            self.w = dist_manager.init_randn_array((8, 16), 1, row_sharding, key1)
+            self.v = dist_manager.init_randn_array((8, 16), 1, row_sharding, key2)
+            self.b = dist_manager.init_randn_array((16,), 0, dist_manager.uniform_sharding, key3)
+            self.c = self.b + 1
+            self.scale = 0.5
+
+    key = dist_manager.get_key(0)
+    model = dist_manager.init_model(Model, key)
+    assert model.w.sharding == row_sharding
+    assert model.c.sharding == dist_manager.uniform_sharding
+    assert model.scale == 0.5
+    assert jnp.all(model.b == 0) and jnp.all(model.c == 1)
+
+    # Each shard has its own key, replicas of a shard (along dp) agree
+    shards = {}
+    for shard in model.w.addressable_shards:
+        rows = shard.index[0].indices(8)[:2]
+        shards.setdefault(rows, []).append(np.asarray(shard.data))
+    assert len(shards) == 4
+    for replicas in shards.values():
+        assert all(np.array_equal(replicas[0], r) for r in replicas)
+    first, second = [replicas[0] for replicas in list(shards.values())[:2]]
+    assert not np.array_equal(first, second)
+    # Parameters generated in the same group still differ
+    assert not jnp.array_equal(model.w, model.v)
+
+    # Deterministic for a given key
+    again = dist_manager.init_model(Model, key)
+    assert jnp.array_equal(model.w, again.w)
+
+def test_hlo_shape_bytes():
+    assert du.hlo_shape_bytes("f32[128,64]{1,0}") == 128 * 64 * 4
+    assert du.hlo_shape_bytes("(bf16[8]{0}, s32[])") == 8 * 2 + 4
+
+def test_collective_stats(dist_manager):
+    sharding = dist_manager.sharding(shrd.PartitionSpec("dp"))
+    x = jax.device_put(jnp.ones((64, 16)), sharding)
+    compiled = jax.jit(lambda x: x.sum(axis=0), out_shardings=dist_manager.uniform_sharding
+                       ).lower(x).compile()
+
+    stats = du.collective_stats(compiled.as_text())
+    assert stats["all-reduce"]["count"] >= 1
+    assert stats["all-reduce"]["bytes"] >= 16 * 4
+    assert du.collective_stats(jax.jit(lambda x: x + 1).lower(x).compile().as_text()) == {}
+
+def test_collective_stats_in_loop(dist_manager):
+    sharding = dist_manager.sharding(shrd.PartitionSpec("dp"))
+    x = jax.device_put(jnp.ones((64, 16)), sharding)
+    def f(x):
+        # The all-reduce depends on the carry, so it stays in the loop body
+        def body(c, _):
+            c = c + jax.lax.with_sharding_constraint((x * c).sum(axis=0), dist_manager.uniform_sharding)
+            return c, None
+        return jax.lax.scan(body, jnp.ones(16), None, length=5)[0]
+    compiled = jax.jit(f, out_shardings=dist_manager.uniform_sharding).lower(x).compile()
+
+    stats = du.collective_stats(compiled.as_text())
+    assert 1 <= stats["all-reduce"]["in_loop"] <= stats["all-reduce"]["count"]
+    assert "in loop bodies" in du.format_comm_report(
+        {"collectives": stats, "barriers": {}, "transfers": {}})
+
+def test_comm_report(dist_manager):
+    pytree = make_sharded_state(dist_manager)
+    sharding_pytree = dist_manager.get_pytree_sharding(pytree)
+    host_pytree = dist_manager.gather_pytree(pytree, sharding_pytree)
+    dist_manager.scatter_pytree(host_pytree, sharding_pytree)
+    dist_manager.save_pytree_sharded(pytree, sharding_pytree, "/ckpt_1")
+
+    report = dist_manager.comm_report()
+    assert report["transfers"]["gather_pytree"]["count"] == 1
+    assert report["transfers"]["scatter_pytree"]["bytes"] == (16 * 3 + 3 + 1) * 4
+    assert report["transfers"]["snapshot_pytree_sharded"]["seconds"] >= 0
+    assert report["barriers"]["commit_pytree_sharded_sync"]["count"] == 1
+    assert "collectives" not in report
+    assert "scatter_pytree" in du.format_comm_report(report)
+
+    # Timings are reset by each report
+    assert dist_manager.comm_report() == {"barriers": {}, "transfers": {}}
+
+def test_gather_shards():
+    dist_manager = du.DistManager((2, 2, 2), fs.memoryfs.MemoryFS())
+    x = jnp.arange(8 * 4, dtype=jnp.bfloat16).reshape(8, 4)
+    for spec in [shrd.PartitionSpec("dp", ("mp", "fsdp")), shrd.PartitionSpec(None, "mp"), shrd.PartitionSpec()]:
+        sharded = jax.device_put(x, dist_manager.sharding(spec))
+        assert np.array_equal(dist_manager.gather_shards(sharded), np.asarray(x))
+        host = dist_manager.gather_shards(sharded, np.float32)
+        assert host.dtype == np.float32 and np.array_equal(host, np.asarray(x, np.float32))
+
+        # Blocks of rows that cut across shards
+        blocks = list(dist_manager.gather_chunks(sharded, sharded.sharding, jnp.float32, chunk_bytes=3 * 4 * 4))
+        assert [len(block) for block in blocks] == [3, 3, 2]
+        assert np.array_equal(np.concatenate(blocks), np.asarray(x, np.float32))
+
+def test_gather_pytree_without_replication(dist_manager):
+    pytree = make_sharded_state(dist_manager)
+    host_pytree = dist_manager.gather_pytree(pytree, dist_manager.get_pytree_sharding(pytree), dtype=None)
+
+    # No program replicating the leaves across devices was compiled
+    assert dist_manager._transfer_cache == {}
+    assert host_pytree["model"]["b"].dtype == pytree["model"]["b"].dtype
+    for x, y in zip(jax.tree_util.tree_leaves(pytree), jax.tree_util.tree_leaves(host_pytree)):
+        assert np.array_equal(np.asarray(x), y)
+
+def test_zero1_sharding():
+    dist_manager = du.DistManager((2, 2, 2), fs.memoryfs.MemoryFS())
+    P = shrd.PartitionSpec
+    zero1 = lambda spec, shape: dist_manager.zero1_sharding(dist_manager.sharding(spec), shape).spec
+
+    assert zero1(P(), (8, 4)) == P("dp", None)
+    assert zero1(P("mp"), (8, 4)) == P(("dp", "mp"), None)
+    # Axes that don't divide are passed over, and arrays that can't be split kept as they are
+    assert zero1(P(), (3, 4)) == P(None, "dp")
+    assert zero1(P(), (3,)) == P()
+    assert zero1(P("dp"), (8,)) == P("dp")
+
+def test_zero1(dist_manager):
+    params = {"w": jax.device_put(jnp.linspace(-1, 1, 16 * 8).reshape(16, 8), dist_manager.uniform_sharding),
+              "b": jax.device_put(jnp.ones(3), dist_manager.uniform_sharding)}
+    data = jnp.linspace(0, 1, 8)
+    loss_fn = lambda params: jnp.sum((params["w"] @ data) ** 2) + jnp.sum(params["b"] ** 2)
+
+    def train(optimizer):
+        opt_state = optimizer.init(params)
+        step = jax.jit(lambda p, s: optimizer.update(jax.grad(loss_fn)(p), s, p))
+        p = params
+        for _ in range(3):
+            updates, opt_state = step(p, opt_state)
+            p = optax.apply_updates(p, updates)
+        return p, opt_state
+
+    expected, adam_state = train(optax.adam(1e-2))
+    updated, zero1_state = train(dist_manager.zero1(optax.adam(1e-2)))
+    assert updated["w"].sharding == params["w"].sharding
+    assert jnp.allclose(updated["w"], expected["w"], atol=1e-6)
+    assert jnp.allclose(updated["b"], expected["b"], atol=1e-6)
+
+    # The moments of w are split 8 ways along dp, b doesn't divide and stays replicated
+    mu = zero1_state[0].mu
+    assert mu["w"].sharding.is_equivalent_to(dist_manager.sharding(shrd.PartitionSpec("dp", None)), 2)
+    assert mu["w"].addressable_shards[0].data.nbytes * 8 == adam_state[0].mu["w"].addressable_shards[0].data.nbytes
+    assert mu["b"].sharding == dist_manager.uniform_sharding
+
+def test_offloaded_optimizer(dist_manager):
+    w_sharding = dist_manager.sharding(shrd.PartitionSpec("dp"))
+    params = {"w": jax.device_put(jnp.linspace(-1, 1, 16 * 8).reshape(16, 8), w_sharding),
+              "b": jax.device_put(jnp.ones(3), dist_manager.uniform_sharding),
+              "c": jax.device_put(jnp.ones((8, 8)), dist_manager.uniform_sharding)}
+    data = jnp.linspace(0, 1, 8)
+    loss_fn = lambda params: (jnp.sum((params["w"] @ data) ** 2) + jnp.sum(params["b"] ** 2) 
+                              + jnp.sum(params["c"] @ data))
+    grad_fn = jax.jit(jax.grad(loss_fn))
+
+    optimizer = optax.adam(1e-2)
+    expected, opt_state = params, optimizer.init(params)
+    for _ in range(3):
+        updates, opt_state = optimizer.update(grad_fn(expected), opt_state, expected)
+        expected = optax.apply_updates(expected, updates)
+
+    # Groups of at most 256 bytes, so each parameter's state streams separately
+    offloaded = du.OffloadedOptimizer(dist_manager, optax.adam(1e-2), group_bytes=256)
+    updated, states = params, offloaded.init(params)
+    assert len(offloaded.groups) == 3
+    for _ in range(3):
+        updated, states = offloaded.update(grad_fn(updated), states, updated)
+
+    for name in params:
+        assert updated[name].sharding == params[name].sharding
+        assert jnp.allclose(updated[name], expected[name], atol=1e-6)
+    # Between steps the state is held on the host
+    for x in jax.tree_util.tree_leaves(states):
+        assert x.sharding == offloaded.host_sharding(w_sharding)
+
+def test_offloaded_zero1_optimizer():
+    dist_manager = du.DistManager((2, 2, 2), fs.memoryfs.MemoryFS())
+    # Leaves of mixed rank, each in its own group with its own zero1 layout
+    params = {"w": jax.device_put(jnp.linspace(-1, 1, 16 * 8).reshape(16, 8), dist_manager.uniform_sharding),
+              "b": jax.device_put(jnp.ones(4), dist_manager.uniform_sharding),
+              "k": jax.device_put(jnp.ones((2, 4, 4)), dist_manager.sharding(shrd.PartitionSpec("mp")))}
+    data = jnp.linspace(0, 1, 8)
+    loss_fn = lambda params: (jnp.sum((params["w"] @ data) ** 2) + jnp.sum(params["b"] ** 2)
+                              + jnp.sum(params["k"] ** 3))
+    grad_fn = jax.jit(jax.grad(loss_fn))
+
+    optimizer = optax.adam(1e-2)
+    expected, opt_state = params, optimizer.init(params)
+    for _ in range(2):
+        updates, opt_state = optimizer.update(grad_fn(expected), opt_state, expected)
+        expected = optax.apply_updates(expected, updates)
+
+    offloaded = du.OffloadedOptimizer(dist_manager, dist_manager.zero1(optax.adam(1e-2)), group_bytes=64)
+    updated, states = params, offloaded.init(params)
+    assert len(offloaded.groups) == 3
+    for _ in range(2):
+        updated, states = offloaded.update(grad_fn(updated), states, updated)
+
+    for name in params:
+        assert updated[name].sharding == params[name].sharding
+        assert jnp.allclose(updated[name], expected[name], atol=1e-6)
+
+def test_bubble_fraction():
+    assert du.bubble_fraction(1, 4) == 0
+    assert du.bubble_fraction(4, 1) == 3 / 4
+    assert du.bubble_fraction(4, 13) == 3 / 16
+
+def test_pipeline(prng_key):
+    dist_manager = du.DistManager((4, 2, 1, 1), fs.memoryfs.MemoryFS())
+    assert dist_manager.axis_size("pp") == 4
+    assert du.DistManager((8, 1, 1), fs.memoryfs.MemoryFS()).axis_size("pp") == 1
+
+    keys = jax.random.split(prng_key, 9)
+    layers = [{"w": jax.random.normal(key, (16, 16)) / 4} for key in keys[:8]]
+    stages = dist_manager.stack_stages(layers)
+    assert stages["w"].shape == (4, 2, 16, 16)
+    assert stages["w"].sharding.spec == shrd.PartitionSpec("pp", None)
+    with pytest.raises(ValueError):
+        dist_manager.stack_stages(layers[:6])
+
+    def stage_fn(stage, h):
+        h, _ = jax.lax.scan(lambda h, layer: (jnp.tanh(h @ layer["w"]), None), h, stage)
+        return h
+
+    def sequential(stages, x):
+        for layer in jax.tree_util.tree_leaves(stages)[0].reshape(8, 16, 16):
+            x = jnp.tanh(x @ layer)
+        return x
+
+    def pipelined(stages, x):
+        return dist_manager.pipeline(stage_fn, stages, x, n_microbatches=3)
+
+    x = jax.random.normal(keys[8], (6, 16))
+    assert jnp.allclose(jax.jit(pipelined)(stages, x), sequential(stages, x), atol=1e-5)
+    loss = lambda f: lambda stages: jnp.sum(f(stages, x) ** 2)
+    assert jnp.allclose(jax.jit(jax.grad(loss(pipelined)))(stages)["w"],
+                        jax.grad(loss(sequential))(stages)["w"], atol=1e-5)
+
+    # Activations move between stages with collective permutes
+    compiled = jax.jit(pipelined).lower(stages, x).compile()
+    assert "collective-permute" in du.collective_stats(compiled.as_text())
+    with pytest.raises(ValueError):
+        pipelined(stages, x[:5])
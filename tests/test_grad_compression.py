@@ -0,0 +1,68 @@
+import functools
+
+import pytest
+import jax
+import jax.numpy as jnp
+import jax.sharding as shrd
+import fs.memoryfs
+
+import monkfish.lvd.models.dist_utils as du
+import monkfish.lvd.models.grad_compression as gc
+
+@pytest.fixture
+def dist_manager():
+    return du.DistManager((4, 2, 1), fs.memoryfs.MemoryFS())
+
+@pytest.fixture
+def params(dist_manager, prng_key):
+    return {
+        "w": jax.device_put(jax.random.normal(prng_key, (64, 32)),
+                            dist_manager.sharding(shrd.PartitionSpec(None, "mp"))),
+        "b": jax.device_put(jnp.zeros((32,)), dist_manager.uniform_sharding)
+    }
+
+def loss_fn(params, x, key):
+    return jnp.mean((x @ params["w"] + params["b"]) ** 2)
+
+@pytest.mark.parametrize("mode,rtol", [("bf16", 1e-2), ("int8", 5e-2)])
+def test_grad_compression(dist_manager, params, prng_key, mode, rtol):
+    x = jax.device_put(jax.random.normal(prng_key, (16, 64)), dist_manager.sharding(shrd.PartitionSpec("dp")))
+    expected_loss, expected = jax.jit(jax.value_and_grad(loss_fn))(params, x, prng_key)
+
+    compressor = gc.GradCompressor(dist_manager, mode, min_bytes=1024)
+    error = compressor.init(params)
+    # b is under min_bytes and reduced in float32
+    assert error["b"] is None
+    assert error["w"].shape == (4, 64, 32)
+    assert error["w"].sharding.spec == shrd.PartitionSpec("dp", None, "mp")
+
+    step = jax.jit(functools.partial(compressor.value_and_grad, loss_fn)).lower(
+        params, x, prng_key, error).compile()
+    loss, grads, error = step(params, x, prng_key, error)
+    assert jnp.allclose(loss, expected_loss, rtol=1e-5)
+    assert jnp.allclose(grads["b"], expected["b"], rtol=1e-5, atol=1e-6)
+    scale = jnp.max(jnp.abs(expected["w"]))
+    assert 0 < jnp.max(jnp.abs(grads["w"] - expected["w"])) < rtol * scale
+    for name in params:
+        assert grads[name].sharding.is_equivalent_to(params[name].sharding, params[name].ndim)
+
+    # With error feedback the rounding error doesn't accumulate over steps
+    total = grads["w"]
+    for _ in range(7):
+        _, grads, error = step(params, x, prng_key, error)
+        total = total + grads["w"]
+    assert jnp.max(jnp.abs(total / 8 - expected["w"])) < rtol * scale / 4
+
+    # w crosses devices in its compressed encoding
+    all_to_all = [line for line in step.as_text().splitlines() if "all-to-all(" in line]
+    assert all_to_all and not any("f32[" in line for line in all_to_all)
+
+def test_grad_compression_fallback(dist_manager):
+    # No axis of w splits over dp=4, so it's reduced in float32
+    params = {"w": jax.device_put(jnp.ones((3, 333)), dist_manager.uniform_sharding)}
+    compressor = gc.GradCompressor(dist_manager, "int8", min_bytes=0)
+    assert compressor.init(params)["w"] is None
+
+def test_grad_compression_mode(dist_manager):
+    with pytest.raises(ValueError):
+        gc.GradCompressor(dist_manager, "fp8")
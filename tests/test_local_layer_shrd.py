@@ -6,6 +6,7 @@ import equinox as eqx
 
 import monkfish.lvd.models.dist_layers as dl
 import monkfish.lvd.models.dist_utils as du
+import monkfish.lvd.memory_planner as mplan
 
 def test_shrd_mh_attention_save_load(dist_manager, prng_key):
     n_head, d_model, d_qk, d_v = 8, 128, 64, 64
@@ -32,6 +33,104 @@ def test_shrd_mh_attention_save_load(dist_manager, prng_key):
     assert jnp.allclose(y1, y2), "Attention outputs do not match after reload."
 
 
+@pytest.mark.parametrize("block_size", [4, 7, 16])
+def test_shrd_mh_attention_blockwise(dist_manager, prng_key, block_size):
+    n_head, d_model, d_qk, d_v = 4, 32, 16, 16
+    x = jax.random.normal(prng_key, (2, 21, d_model))
+
+    dense_layer = dl.ShrdMHAttention(dist_manager, prng_key, d_model, n_head, d_qk, d_v)
+    blockwise_layer = dl.ShrdMHAttention(dist_manager, prng_key, d_model, n_head, d_qk, d_v,
+                                         block_size=block_size)
+    apply = jax.jit(jax.vmap(lambda layer, x: layer(x), in_axes=(None, 0)))
+    y1 = apply(dense_layer, x)
+    y2 = apply(blockwise_layer, x)
+    scale = jnp.max(jnp.abs(y1))
+    assert jnp.allclose(y1, y2, atol=1e-5 * scale), "Blockwise attention outputs do not match."
+
+    # Causal: changing the last position leaves the others alone
+    y3 = apply(blockwise_layer, x.at[:, -1].add(1))
+    assert jnp.allclose(y2[:, :-1], y3[:, :-1])
+
+    loss = lambda layer: jnp.sum(jnp.sin(apply(layer, x)))
+    grads1 = jax.grad(loss)(dense_layer)
+    grads2 = jax.grad(loss)(blockwise_layer)
+    for g1, g2 in zip(jax.tree_util.tree_leaves(grads1), jax.tree_util.tree_leaves(grads2)):
+        assert jnp.allclose(g1, g2, atol=1e-3 * jnp.max(jnp.abs(g1))), "Blockwise attention gradients do not match."
+
+
+@pytest.mark.parametrize("mesh_shape", [(1, 1, 8, 1, 1), (1, 1, 2, 2, 2), (1, 2, 4, 1, 1)])
+def test_shrd_mh_attention_ring(dist_manager, prng_key, mesh_shape):
+    n_head, d_model, d_qk, d_v = 4, 32, 16, 16
+    x = jax.random.normal(prng_key, (2, 21, d_model))
+    sp_manager = du.DistManager(mesh_shape, dist_manager.fs)
+
+    dense_layer = dl.ShrdMHAttention(dist_manager, prng_key, d_model, n_head, d_qk, d_v)
+    ring_layer = dl.ShrdMHAttention(sp_manager, prng_key, d_model, n_head, d_qk, d_v)
+    # Same parameters, laid out on the sequence parallel mesh
+    names = ["qkv", "o", "theta_factor"]
+    ring_layer = eqx.tree_at(
+        lambda layer: [getattr(layer, name) for name in names], ring_layer,
+        [jax.device_put(getattr(dense_layer, name), ring_layer._f_dict()[name]["sharding"])
+         for name in names])
+    apply = jax.jit(jax.vmap(lambda layer, x: layer(x), in_axes=(None, 0)))
+    y1 = apply(dense_layer, x)
+    y2 = apply(ring_layer, x)
+    scale = jnp.max(jnp.abs(y1))
+    assert jnp.allclose(y1, y2, atol=1e-5 * scale), "Ring attention outputs do not match."
+
+    loss = lambda layer: jnp.sum(jnp.sin(apply(layer, x)))
+    grads1 = jax.grad(loss)(dense_layer)
+    grads2 = jax.grad(loss)(ring_layer)
+    for g1, g2 in zip(jax.tree_util.tree_leaves(grads1), jax.tree_util.tree_leaves(grads2)):
+        assert jnp.allclose(g1, g2, atol=1e-3 * jnp.max(jnp.abs(g1))), "Ring attention gradients do not match."
+
+
+def test_shrd_mh_attention_rope_tables(dist_manager, prng_key):
+    d_qk = 16
+    attention_layer = dl.ShrdMHAttention(dist_manager, prng_key, 32, 4, d_qk, d_qk, theta_factor=2.0)
+    x = jax.random.normal(prng_key, (10, d_qk))
+    y = attention_layer._rope_embed(x, attention_layer._rope_tables(10))
+
+    # Rotation of each pair (x[i], x[i + d_qk/2]) by position * rate, and the qk norm
+    rate = 2.0 * -jnp.arange(d_qk // 2) / (d_qk // 2)
+    angle = jnp.arange(10)[:, None] * rate
+    x1, x2 = x[:, :d_qk // 2], x[:, d_qk // 2:]
+    expected = jnp.concatenate([jnp.cos(angle)*x1 - jnp.sin(angle)*x2,
+                                jnp.sin(angle)*x1 + jnp.cos(angle)*x2], axis=1) / d_qk**(1/4)
+    assert jnp.allclose(y, expected, atol=1e-5)
+
+    # Tables from an offset are the rows of the full ones
+    for full, offset in zip(attention_layer._rope_tables(10), attention_layer._rope_tables(4, 6)):
+        assert jnp.allclose(full[6:], offset)
+
+
+@pytest.mark.parametrize("block", ["transformer", "conv"])
+def test_remat_policies(dist_manager, prng_key, block):
+    def make_block(policy):
+        if block == "transformer":
+            return dl.TransformerBlock(dist_manager, prng_key, 32, 64, 16, 16, 4, remat_policy=policy)
+        return dl.ConvResBlock(dist_manager, prng_key, 8, 16, remat_policy=policy)
+    x = jax.random.normal(prng_key, (12, 32) if block == "transformer" else (8, 6, 6))
+    loss = lambda layer, x, key: jnp.sum(jnp.sin(layer(x)))
+
+    expected = jax.grad(loss)(make_block("none"), x, None)
+    kept = {}
+    for policy in dl.REMAT_POLICIES:
+        layer = make_block(policy)
+        grads = jax.jit(jax.grad(loss))(layer, x, None)
+        for g1, g2 in zip(jax.tree_util.tree_leaves(expected), jax.tree_util.tree_leaves(grads)):
+            assert jnp.allclose(g1, g2, atol=1e-4 * jnp.max(jnp.abs(g1))), f"Gradients under {policy} do not match."
+        kept[policy] = mplan.activation_bytes(loss, layer, x, None)
+
+    assert kept["full"] < kept["save_matmuls"] < kept["none"]
+    # CPU devices have no pinned host memory to offload to
+    assert kept["offload"] == kept["save_matmuls"]
+
+    # A bad policy fails when the block is built, not on its first call
+    with pytest.raises(ValueError):
+        make_block("everything")
+
+
 def test_shrd_conv_save_load(dist_manager, prng_key):
     x = jax.random.normal(prng_key, (8, 10, 10))  # Example input for convolution
     key1, key2 = jax.random.split(prng_key)
@@ -0,0 +1,58 @@
+import jax
+import jax.numpy as jnp
+import jax.sharding as shrd
+import fs.memoryfs
+
+import monkfish.lvd.models.dist_utils as du
+import monkfish.lvd.models.dist_autoreg_diffusion as dad
+import monkfish.lvd.memory_planner as mplan
+
+def ardm_config():
+    return {
+        "seed": 0,
+        "transformer_ardm": {
+            "dist_manager": {"mesh_shape": [8, 1, 1]},
+            "data_loader": {"batch_size": 8},
+            "model": {"res_dim": 64, "io_dim": 64, "vocab": 32, "n_layers": 2,
+                      "mlp_dim": 128, "qk_dim": 32, "v_dim": 32, "n_head": 8},
+            "train": {"lr": 0.0001, "zero1": True},
+        },
+    }
+
+def test_device_bytes():
+    dist_manager = du.DistManager((2, 4, 1), fs.memoryfs.MemoryFS())
+    split = jax.ShapeDtypeStruct((8, 16), jnp.float32, 
+                                 sharding=dist_manager.sharding(shrd.PartitionSpec(("dp", "mp"))))
+    replicated = jax.ShapeDtypeStruct((10,), jnp.float32, sharding=dist_manager.uniform_sharding)
+    assert mplan.device_bytes([split, replicated, None]) == 16 * 4 + 10 * 4
+
+def test_eval_model(dist_manager):
+    make_model = lambda key: dad.TransformerARDM(dist_manager, key, res_dim=64, 
+            io_dim=32, vocab=16, n_layers=2, mlp_dim=128, qk_dim=16, v_dim=16, n_head=8)
+    abstract = dist_manager.eval_model(make_model, jax.ShapeDtypeStruct((2,), jnp.uint32))
+    model = dist_manager.init_model(make_model, jax.random.PRNGKey(0))
+    for x, y in zip(jax.tree_util.tree_leaves(abstract), jax.tree_util.tree_leaves(model)):
+        assert isinstance(x, jax.ShapeDtypeStruct)
+        assert x.shape == y.shape and x.sharding == y.sharding
+
+def test_plan_memory():
+    plan = mplan.plan_memory("ardm", ardm_config(), batch_size=8, seq_len=16, txt_len=8)
+
+    # Parameters are replicated over 8-way dp and Adam's two moments split 
+    # over it, but for a few scalars (the step count, theta_factor)
+    assert 0 < plan["opt_state"] - plan["params"] // 4 < 64
+    assert plan["activations"] > 0
+    assert plan["estimate"] == (plan["params"] + plan["grads"] + plan["opt_state"] 
+                                + plan["grad_error"] + plan["activations"])
+    assert plan["compiled"] > plan["params"]
+    assert "params" in mplan.format_plan(plan)
+
+def test_tune_remat():
+    plans = mplan.tune_remat("ardm", ardm_config(), batch_size=8, steps=1, seq_len=32, txt_len=8)
+
+    assert [plan["remat_policy"] for plan in plans] == ["none", "full", "save_matmuls", "offload"]
+    activations = {plan["remat_policy"]: plan["activations"] for plan in plans}
+    assert activations["full"] < activations["save_matmuls"] < activations["none"]
+    for plan in plans:
+        assert plan["step_time"] > 0 and plan["compiled"] > 0
+    assert "save_matmuls" in mplan.format_remat_plans(plans)
@@ -0,0 +1,75 @@
+import json
+import inspect
+
+import pytest
+
+import monkfish.lvd.mesh_tuner as mt
+import monkfish.lvd.diffusion_ar as dar
+import monkfish.lvd.shrd_data_loader as sdl
+
+def ardm_config():
+    return {
+        "seed": 0,
+        "transformer_ardm": {
+            "dist_manager": {"mesh_shape": [8, 1, 1]},
+            "data_loader": {"batch_size": 8},
+            "model": {"res_dim": 64, "io_dim": 64, "vocab": 32, "n_layers": 2,
+                      "mlp_dim": 128, "qk_dim": 32, "v_dim": 32, "n_head": 8},
+            "train": {"lr": 0.0001},
+        },
+    }
+
+def test_mesh_factorizations():
+    shapes = mt.mesh_factorizations(8)
+    assert len(shapes) == 10
+    assert all(dp * mp * fsdp == 8 for dp, mp, fsdp in shapes)
+    assert (8, 1, 1) in shapes and (2, 2, 2) in shapes
+    assert mt.mesh_factorizations(1) == [(1, 1, 1)]
+
+def test_tune_mesh():
+    # A batch of 4 can't be split over 8-way data parallelism, so that shape is left out
+    mesh_shapes = [(8, 1, 1), (1, 8, 1), (2, 2, 2)]
+    results = mt.tune_mesh("ardm", ardm_config(), batch_size=4, steps=1, 
+                           mesh_shapes=mesh_shapes, seq_len=16, txt_len=8)
+
+    assert {tuple(r["mesh_shape"]) for r in results} == {(1, 8, 1), (2, 2, 2)}
+    assert results[0]["step_time"] <= results[-1]["step_time"]
+    for result in results:
+        assert result["step_time"] > 0 and result["memory_bytes"] > 0
+
+def test_write_mesh_shape(tmp_path):
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(ardm_config()))
+
+    mt.write_mesh_shape(str(config_path), "ardm", (2, 2, 2))
+    cfg = json.loads(config_path.read_text())
+    assert cfg["transformer_ardm"]["dist_manager"]["mesh_shape"] == [2, 2, 2]
+    assert cfg["transformer_ardm"]["model"] == ardm_config()["transformer_ardm"]["model"]
+
+def test_write_mesh_shape_keeps_formatting(tmp_path):
+    # Only the ardm mesh_shape changes, the dae one and the layout stay
+    text = ('{\n  "diffusion_auto_encoder": {"dist_manager": {"mesh_shape": [8,1,1]}},\n'
+            '  "transformer_ardm": {\n    "dist_manager": {"mesh_shape": [8,1,1]}, "x": 1\n  }\n}\n')
+    config_path = tmp_path / "config.json"
+    config_path.write_text(text)
+
+    mt.write_mesh_shape(str(config_path), "ardm", (2, 2, 2))
+    assert config_path.read_text() == text.replace(
+        '"mesh_shape": [8,1,1]}, "x"', '"mesh_shape": [2,2,2]}, "x"')
+
+def test_tune_mesh_unexpected_error(monkeypatch):
+    def time_mesh(*args, **kwargs):
+        raise RuntimeError("not a mesh shape problem")
+    monkeypatch.setattr(mt, "time_mesh", time_mesh)
+    with pytest.raises(RuntimeError):
+        mt.tune_mesh("ardm", ardm_config(), batch_size=4, mesh_shapes=[(8, 1, 1)])
+
+def test_ckpt_filesystem_gcp(monkeypatch):
+    # Called the way gcp_filesystem's signature accepts
+    signature = inspect.signature(sdl.gcp_filesystem)
+    monkeypatch.setattr(sdl, "gcp_filesystem", 
+                        lambda *args, **kwargs: signature.bind(*args, **kwargs).arguments)
+    cfg = {"gcp": {"gcp_bucket_name": "bucket", "gcp_credentials_path": "key.json"},
+           "transformer_ardm": {"checkpoints": {"fs_type": "gcp", "ckpt_root_directory": "ckpts"}}}
+    assert dar.ckpt_filesystem(cfg) == {"bucket_name": "bucket", "root_path": "ckpts", 
+                                        "credentials_path": "key.json"}
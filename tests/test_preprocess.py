@@ -0,0 +1,86 @@
+import io
+
+import pytest
+import numpy as np
+import PIL.Image as Image
+
+import monkfish.lvd.shrd_data_loader as sdl
+import monkfish.lvd.preprocess as pp
+
+@pytest.fixture
+def raw_image_dir(tmp_path):
+    raw_dir = tmp_path / "raw"
+    raw_dir.mkdir()
+    for i in range(4):
+        img = Image.new('RGB', (120, 80), color=(i*50, 10, 200))
+        img.save(raw_dir / f"image_{i}.png")
+    (raw_dir / "notes.txt").write_text("not an image")
+    return raw_dir
+
+@pytest.fixture
+def fs_args(raw_image_dir, tmp_path):
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    in_fs_args = {"fs_type": "os", "root_path": str(raw_image_dir)}
+    out_fs_args = {"fs_type": "os", "root_path": str(out_dir)}
+    return in_fs_args, out_fs_args
+
+def test_resize_and_crop():
+    image = np.zeros((80, 120, 3), dtype=np.uint8)
+    assert pp.resize_and_crop(image, (64, 32)).shape == (32, 64, 3)
+    assert pp.resize_and_crop(image, (32, 64)).shape == (64, 32, 3)
+
+def test_to_model_layout():
+    image = np.random.randint(0, 255, (32, 64, 3), dtype=np.uint8)
+    expected = np.transpose(image[np.newaxis], (0, 3, 2, 1))[0]
+    np.testing.assert_array_equal(pp.to_model_layout(image), expected)
+
+    video = np.random.randint(0, 255, (5, 32, 64, 3), dtype=np.uint8)
+    assert pp.to_model_layout(video).shape == (5, 3, 64, 32)
+
+def test_preprocess_local(fs_args):
+    in_fs_args, out_fs_args = fs_args
+    n = pp.preprocess_local(in_fs_args, out_fs_args, "image", (64, 32), workers=2)
+    assert n == 4
+
+    out_fs = sdl.fs_initializer(out_fs_args)
+    assert pp.load_manifest(out_fs) == {f"image_{i}.png" for i in range(4)}
+
+    worker = sdl.TensorWorkerInterface(out_fs)
+    (array, description), _ = worker.get_example(1)
+    assert array.dtype == np.uint8
+    assert array.shape == (3, 64, 32)
+    assert description == ""
+    assert np.all(array[0] == 50)
+
+def test_preprocess_resumes_from_manifest(fs_args, raw_image_dir):
+    in_fs_args, out_fs_args = fs_args
+    pp.preprocess_local(in_fs_args, out_fs_args, "image", (64, 32), workers=2)
+
+    Image.new('RGB', (120, 80)).save(raw_image_dir / "image_4.png")
+    n = pp.preprocess_local(in_fs_args, out_fs_args, "image", (64, 32), workers=2)
+    assert n == 1
+
+    out_fs = sdl.fs_initializer(out_fs_args)
+    assert "image_4.png" in pp.load_manifest(out_fs)
+    assert pp.preprocess_local(in_fs_args, out_fs_args, "image", (64, 32), workers=2) == 0
+
+def test_preprocess_distributed(fs_args):
+    in_fs_args, out_fs_args = fs_args
+    hosts = [pp.HostInfo(pid=i, nodes=2) for i in range(2)]
+    counts = [
+        pp.preprocess_distributed(in_fs_args, out_fs_args, "image", (64, 32), host,
+                                  workers_per_node=2, batch_size=2)
+        for host in hosts]
+    assert counts == [2, 2]
+
+    out_fs = sdl.fs_initializer(out_fs_args)
+    assert pp.load_manifest(out_fs) == {f"image_{i}.png" for i in range(4)}
+    assert len(sdl.TensorWorkerInterface(out_fs).files) == 4
+
+def test_tensor_shard_interface(dist_manager):
+    local_data = [((np.full((3, 16, 8), 255, dtype=np.uint8), ""), i) for i in range(8)]
+    tsi = sdl.TensorShardInterface(dist_manager)
+    sharded = tsi.host_to_accelerator(local_data, 8)
+    assert sharded.shape == (8, 3, 16, 8)
+    assert np.allclose(np.asarray(sharded), 0.5)
@@ -1,5 +1,10 @@
 import os
+import collections
+import multiprocessing
+import multiprocessing.shared_memory
+
 import pytest
+import numpy as np
 from unittest.mock import MagicMock, patch
 import monkfish.lvd.shrd_data_loader as sdl
 
@@ -26,6 +31,8 @@ def mock_worker_interface_cls():
             self.fs = fs
         def get_example(self, x):
             return f"data_{x}", x
+        def cache_key(self, x):
+            return x
     return MockWorkerInterface
 
 @pytest.fixture
@@ -95,6 +102,20 @@ def test_round_robin_scheduling(sharded_downloader):
 
     sharded_downloader.stop()
 
+def test_downloader_with_cache(sharded_downloader):
+    sharded_downloader.cache_bytes = 1 << 20
+    sharded_downloader.start(0)
+
+    for _ in range(3):
+        batch = sharded_downloader.step()
+        assert len(batch) == sharded_downloader.batch_size // sharded_downloader.nodes
+        sharded_downloader.ack()
+
+    stats = sharded_downloader.cache_stats()
+    assert stats["misses"] >= 3 * len(batch)
+    sharded_downloader.stop()
+    assert sharded_downloader.cache_stats() is None
+
 def test_worker_shutdown(sharded_downloader):
     sharded_downloader.start(0)
     sharded_downloader.stop()
@@ -128,3 +149,112 @@ def test_batch_elements_distribution(mock_fs_initializer, sharded_downloaders):
 
     for downloader in sharded_downloaders:
         downloader.stop()
+
+def _cache_put_worker(cache, key, value):
+    cache.put(key, value)
+
+@pytest.fixture
+def example_cache():
+    manager = multiprocessing.Manager()
+    cache = sdl.SharedExampleCache(4096, manager)
+    yield cache
+    cache.close()
+    manager.shutdown()
+
+def test_example_cache_round_trip(example_cache):
+    data = (np.arange(100, dtype=np.float32).reshape(10, 10), "description")
+    assert example_cache.get("a") is None
+    assert example_cache.put("a", data)
+
+    cached = example_cache.get("a")
+    np.testing.assert_array_equal(cached[0], data[0])
+    assert cached[1] == "description"
+
+    stats = example_cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == 0.5
+
+def test_example_cache_lru_eviction(example_cache):
+    # Each entry is a bit over 1KB, so only three fit in the 4KB budget
+    for key in ["a", "b", "c"]:
+        example_cache.put(key, np.zeros(256, dtype=np.float32))
+    example_cache.get("a")
+    example_cache.put("d", np.zeros(256, dtype=np.float32))
+
+    assert example_cache.get("b") is None
+    assert example_cache.get("a") is not None
+    assert example_cache.stats()["evictions"] == 1
+    assert example_cache.stats()["bytes"] <= example_cache.max_bytes
+
+def test_example_cache_lru_order(example_cache):
+    # Three entries fit, checked against an OrderedDict kept in LRU order
+    rng = np.random.default_rng(0)
+    expected = collections.OrderedDict()
+    for _ in range(200):
+        key = str(rng.integers(6))
+        if rng.random() < 0.5:
+            hit = example_cache.get(key) is not None
+            assert hit == (key in expected)
+            if hit:
+                expected.move_to_end(key)
+        elif key not in expected:
+            example_cache.put(key, np.zeros(256, dtype=np.float32))
+            expected[key] = None
+            if len(expected) > 3:
+                expected.popitem(last=False)
+        assert sorted(example_cache.index.keys()) == sorted(expected)
+    assert len(example_cache.order) == len(example_cache.index)
+
+def test_example_cache_pinned_eviction(example_cache):
+    example_cache.put("a", np.arange(256, dtype=np.float32))
+    shm_name = example_cache.index["a"][0]
+    # A reader part way through copying "a" out when it's evicted
+    example_cache.pins[shm_name] = 1
+    for key in "bcd":
+        example_cache.put(key, np.zeros(256, dtype=np.float32))
+    assert "a" not in example_cache.index
+    shm = multiprocessing.shared_memory.SharedMemory(name=shm_name)
+    np.testing.assert_array_equal(np.frombuffer(shm.buf, np.float32)[:256], np.arange(256))
+    shm.close()
+
+    # The last reader to finish unlinks it
+    example_cache._unpin("a", shm_name)
+    assert len(example_cache.pins) == 0
+    with pytest.raises(FileNotFoundError):
+        multiprocessing.shared_memory.SharedMemory(name=shm_name)
+
+    # Reads leave nothing pinned
+    example_cache.get("b")
+    assert len(example_cache.pins) == 0
+
+def test_example_cache_rejects_oversized(example_cache):
+    assert not example_cache.put("big", np.zeros(4096, dtype=np.float32))
+    assert example_cache.get("big") is None
+
+def test_example_cache_shared_across_processes(example_cache):
+    value = np.arange(16, dtype=np.int64)
+    process = multiprocessing.Process(
+        target=_cache_put_worker, args=(example_cache, "shared", value))
+    process.start()
+    process.join()
+
+    np.testing.assert_array_equal(example_cache.get("shared"), value)
+
+def test_cached_get_example(example_cache, mock_worker_interface_cls):
+    class CountingInterface(mock_worker_interface_cls):
+        calls = 0
+        def get_example(self, x):
+            CountingInterface.calls += 1
+            return f"data_{x % 4}", x
+        def cache_key(self, x):
+            return x % 4
+
+    interface = CountingInterface(None)
+    for example_id in range(12):
+        data, data_id = sdl.cached_get_example(interface, example_id, example_cache)
+        assert data == f"data_{example_id % 4}"
+        assert data_id == example_id
+
+    assert CountingInterface.calls == 4
+    assert example_cache.stats()["hits"] == 8
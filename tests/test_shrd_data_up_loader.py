@@ -157,3 +157,25 @@ def test_upload_example_count(mock_fs_initializer, sharded_uploader):
     expected_calls = uploader.batch_size // uploader.dist_manager.nodes
 
     assert number_of_examples_uploaded == expected_calls, f"upload_example not called expected number of times. Expected {expected_calls}, got {number_of_examples_uploaded}"
+
+def test_stop_uploads_queued_examples(sharded_uploader, tmp_path):
+    uploader, upload_count = sharded_uploader
+    uploader.worker_fs_args = {'fs_type': 'os', 'root_path': str(tmp_path)}
+    uploader.start(0)
+
+    processed_count = 0
+    for _ in range(3):
+        processed_count += uploader.step([1] * uploader.batch_size)
+        uploader.ack()
+    # Stopping straight away still uploads everything queued before it
+    uploader.stop()
+    assert upload_count.value == processed_count
+
+def test_abort(sharded_uploader, tmp_path):
+    uploader, _ = sharded_uploader
+    uploader.worker_fs_args = {'fs_type': 'os', 'root_path': str(tmp_path)}
+    uploader.start(0)
+    uploader.abort()
+
+    for worker in uploader.workers:
+        assert not worker.is_alive(), "Worker did not abort"
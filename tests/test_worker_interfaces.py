@@ -166,6 +166,29 @@ def test_video_empty_directory():
     with pytest.raises(ValueError, match="The directory is empty or contains no MP4 files."):
         sdl.VideoWorkerInterface(empty_fs)
 
+def test_video_upload_example(video_worker, mock_video_fs):
+    video_worker.segment_frames = 16
+    frames = np.full((40, 64, 80, 3), 100, dtype=np.uint8)
+    video_worker.upload_example(7, frames, "Uploaded video")
+
+    assert 'video_7.mp4' in mock_video_fs.listdir('/')
+
+    worker = sdl.VideoWorkerInterface(mock_video_fs)
+    (video_array, description), _ = worker.get_example(worker.files.index('video_7.mp4'))
+    assert video_array.shape == (40, 64, 80, 3)
+    assert description == "Uploaded video"
+    assert np.abs(video_array.astype(np.float32) - 100).mean() < 4
+
+def test_video_upload_example_from_iterator(video_worker, mock_video_fs):
+    video_worker.segment_frames = 8
+    frames = (np.full((32, 32, 3), 50, dtype=np.uint8) for _ in range(20))
+    video_worker.upload_example(8, frames, "Streamed video")
+
+    worker = sdl.VideoWorkerInterface(mock_video_fs)
+    (video_array, description), _ = worker.get_example(worker.files.index('video_8.mp4'))
+    assert video_array.shape == (20, 32, 32, 3)
+    assert description == "Streamed video"
+
 def test_latent_init(mock_latent_fs):
     worker = sdl.LatentWorkerInterface(mock_latent_fs)
     assert len(worker.files) == 5